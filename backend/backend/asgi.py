@@ -5,6 +5,10 @@ It exposes the ASGI callable as a module-level variable named ``application``.
 
 For more information on this file, see
 https://docs.djangoproject.com/en/5.2/howto/deployment/asgi/
+
+Serve with an ASGI server (e.g. ``uvicorn backend.asgi:application``) so the
+long-poll/SSE payment status endpoint (pharmacy_app/streams.py) waits without
+tying up a worker thread.
 """
 
 import os
@@ -41,6 +41,7 @@ INSTALLED_APPS = [
 
 MIDDLEWARE = [
     'corsheaders.middleware.CorsMiddleware',   # must be FIRST
+    'pharmacy_app.metrics.MetricsMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -155,6 +156,21 @@ MPESA_CALLBACK_URL = config(
     default='https://0704-2c0f-6300-d09-fd00-5903-b0a3-f440-d4a7.ngrok-free.app/api/mpesa/callback/'
 )
 MPESA_ENVIRONMENT = config('MPESA_ENVIRONMENT', default='sandbox')
+MPESA_BASE_URL = config('MPESA_BASE_URL', default='')            # e.g. http://127.0.0.1:8900 for `manage.py fake_daraja`
+MPESA_DISPATCH_MODE = config('MPESA_DISPATCH_MODE', default='sync')  # sync | async
+MPESA_DISPATCH_WORKERS = config('MPESA_DISPATCH_WORKERS', default=8, cast=int)
+MPESA_POOL_SIZE = config('MPESA_POOL_SIZE', default=16, cast=int)
+MPESA_TOKEN_CACHE = 'default'                                     # CACHES alias holding the OAuth token
+
+# The default cache is per-process; point it at a shared backend (e.g.
+# CACHE_BACKEND=django.core.cache.backends.redis.RedisCache,
+# CACHE_LOCATION=redis://127.0.0.1:6379) so all workers share one M-Pesa token.
+CACHES = {
+    'default': {
+        'BACKEND': config('CACHE_BACKEND', default='django.core.cache.backends.locmem.LocMemCache'),
+        'LOCATION': config('CACHE_LOCATION', default=''),
+    }
+}
 
 LOGGING = {
     'version': 1,
@@ -171,4 +187,16 @@ LOGGING = {
             'propagate': True,
         },
     },
-}
\ No newline at end of file
+}
+# ─── Receipt numbers (pharmacy_app/receipts.py) ────────────────────────────────
+# 0-255; give every app server that shares the database its own value. Unset,
+# receipt numbers are told apart by a hash of hostname and pid instead.
+RECEIPT_INSTANCE_ID = config('RECEIPT_INSTANCE_ID', default='', cast=lambda v: int(v) if v != '' else None)
+
+# ─── Payment status push (pharmacy_app/events.py) ─────────────────────────────
+# Swap for a broker shared by all workers when running more than one process
+PAYMENT_EVENTS_BROKER = 'pharmacy_app.events.InProcessBroker'
+
+# ─── Request metrics (pharmacy_app/metrics.py, GET /api/metrics/) ─────────────
+METRICS_SAMPLE_RATE = config('METRICS_SAMPLE_RATE', default=0.1, cast=float)
+METRICS_TOKEN = config('METRICS_TOKEN', default='')               # bearer token for Prometheus scrapes
@@ -0,0 +1,103 @@
+"""
+Per-SKU sales analytics: revenue, gross margin, velocity and ABC class.
+
+Completed sale lines in the window are pulled as plain columns with one
+values_list query and reduced per medicine with NumPy (np.unique +
+np.bincount), so the cost is a single pass over the lines whatever the
+number of SKUs. Gross margin uses the medicine's current cost_price.
+
+NumPy is an optional dependency (``pip install numpy``); without it
+``numpy_available()`` is False and the analytics endpoint answers 503.
+"""
+
+from django.db.models import FloatField
+from django.db.models.functions import Cast
+
+from .models import Medicine, SaleItem
+
+try:
+    import numpy as np
+except ImportError:  # optional dependency
+    np = None
+
+# ABC classification by cumulative share of revenue
+A_SHARE = 0.80
+B_SHARE = 0.95
+
+
+def numpy_available():
+    return np is not None
+
+
+def sale_lines(start, end):
+    """(medicine_id, quantity, revenue, unit_cost) for completed sales in [start, end)"""
+    return SaleItem.objects.filter(
+        sale__status='completed',
+        sale__created_at__gte=start,
+        sale__created_at__lt=end,
+        medicine__isnull=False,
+    ).values_list(
+        'medicine_id',
+        'quantity',
+        Cast('total_price', FloatField()),
+        Cast('medicine__cost_price', FloatField()),
+    ).order_by()
+
+
+def abc_classes(revenue):
+    """'A'/'B'/'C' per element: A covers the top A_SHARE of revenue, B the next slice"""
+    classes = np.full(revenue.shape, 'C', dtype='<U1')
+    total = revenue.sum()
+    if total <= 0:
+        return classes
+    order = np.argsort(-revenue, kind='stable')
+    # Share of revenue held by the SKUs ranked above each one
+    before = (np.cumsum(revenue[order]) - revenue[order]) / total
+    ranked = np.where(before < A_SHARE, 'A', np.where(before < B_SHARE, 'B', 'C'))
+    classes[order] = ranked
+    return classes
+
+
+def sku_metrics(start, end, days):
+    """
+    Metrics for every medicine sold in [start, end), highest revenue first,
+    plus window totals. ``days`` is the window length used for velocity.
+    """
+    rows = list(sale_lines(start, end))
+    totals = {'units': 0, 'revenue': 0.0, 'cost': 0.0, 'gross_margin': 0.0}
+    if not rows:
+        return [], totals
+
+    data = np.array(rows, dtype=np.float64)
+    ids, inverse = np.unique(data[:, 0].astype(np.int64), return_inverse=True)
+    units = np.bincount(inverse, weights=data[:, 1])
+    revenue = np.bincount(inverse, weights=data[:, 2])
+    cost = np.bincount(inverse, weights=data[:, 1] * data[:, 3])
+    margin = revenue - cost
+    margin_pct = np.divide(margin * 100, revenue, out=np.zeros_like(margin), where=revenue > 0)
+    per_day = units / max(days, 1)
+    classes = abc_classes(revenue)
+
+    names = dict(Medicine.objects.filter(pk__in=ids.tolist()).values_list('id', 'name'))
+    results = [
+        {
+            'medicine_id': med_id,
+            'name': names.get(med_id, ''),
+            'units': int(units[i]),
+            'revenue': round(float(revenue[i]), 2),
+            'cost': round(float(cost[i]), 2),
+            'gross_margin': round(float(margin[i]), 2),
+            'margin_pct': round(float(margin_pct[i]), 2),
+            'units_per_day': round(float(per_day[i]), 3),
+            'abc_class': str(classes[i]),
+        }
+        for i, med_id in enumerate(ids.tolist())
+    ]
+    results.sort(key=lambda r: r['revenue'], reverse=True)
+    totals = {
+        'units': int(units.sum()),
+        'revenue': round(float(revenue.sum()), 2),
+        'cost': round(float(cost.sum()), 2),
+        'gross_margin': round(float(margin.sum()), 2),
+    }
+    return results, totals
@@ -0,0 +1,98 @@
+"""
+HTTP conditional GET (ETag / Last-Modified) for catalogue endpoints.
+
+Validators come from one aggregate query over the filtered queryset (row
+count and newest ``updated_at``, plus anything else the serializer reads),
+so an unchanged list or object is answered with 304 before any row is
+loaded or serialized. The aggregate's count is handed to the paginator,
+which then skips its own COUNT(*).
+
+The ETag covers the row count and sub-second changes, so it is the validator
+that counts: If-None-Match wins over If-Modified-Since, and a list is never
+answered 304 on If-Modified-Since alone because a deleted row does not move
+the newest ``updated_at``. A single object answers If-Modified-Since too; if
+it is deleted it is a 404 instead.
+"""
+
+import hashlib
+from datetime import timedelta
+
+from django.core.exceptions import ValidationError
+from django.db.models import Count, Max
+from django.utils import timezone
+from django.utils.cache import get_conditional_response
+from django.utils.http import http_date, quote_etag
+
+# HTTP dates have whole-second resolution. A Last-Modified is only sent once
+# the newest change is this old, so a later write cannot share its date.
+LAST_MODIFIED_SETTLE = timedelta(seconds=1)
+
+
+class ConditionalGetMixin:
+    """
+    For ModelViewSets whose model has ``updated_at``. Views add extra
+    validators by overriding ``get_validator_aggregates()``.
+    """
+
+    known_count = None
+
+    def get_validator_aggregates(self):
+        return {'count': Count('pk'), 'last': Max('updated_at')}
+
+    def get_validators(self, queryset):
+        state = queryset.order_by().aggregate(**self.get_validator_aggregates())
+        stamps = [v for v in state.values() if hasattr(v, 'timestamp')]
+        last_modified = max(stamps) if stamps else None
+        # Date-dependent fields (is_expired) change at midnight without a write
+        parts = [self.request.accepted_renderer.format, str(timezone.localdate())]
+        parts += [f"{key}={value.isoformat() if hasattr(value, 'isoformat') else value}"
+                  for key, value in sorted(state.items())]
+        etag = quote_etag(hashlib.md5('|'.join(parts).encode()).hexdigest())
+        return etag, last_modified, state['count']
+
+    def conditional_response(self, request, get_queryset, respond, allow_empty=True):
+        try:
+            etag, last_modified, count = self.get_validators(get_queryset())
+        except (TypeError, ValueError, ValidationError):
+            return respond()  # malformed lookup; let the view produce its 404
+        if not count and not allow_empty:
+            return respond()
+        if last_modified is not None and last_modified <= timezone.now() - LAST_MODIFIED_SETTLE:
+            last_modified = int(last_modified.timestamp())
+        else:
+            last_modified = None
+        if request.headers.get('If-None-Match'):
+            not_modified = get_conditional_response(request, etag=etag)
+        elif allow_empty:
+            not_modified = None   # deletions are only visible to the ETag
+        else:
+            not_modified = get_conditional_response(request, last_modified=last_modified)
+        if not_modified is not None:
+            return not_modified
+        self.known_count = count
+        response = respond()
+        response['ETag'] = etag
+        if last_modified is not None:
+            response['Last-Modified'] = http_date(last_modified)
+        response['Cache-Control'] = 'private, no-cache'
+        return response
+
+    def list(self, request, *args, **kwargs):
+        def queryset():
+            return self.filter_queryset(self.get_queryset())
+
+        def respond():
+            return super(ConditionalGetMixin, self).list(request, *args, **kwargs)
+
+        return self.conditional_response(request, queryset, respond)
+
+    def retrieve(self, request, *args, **kwargs):
+        lookup = kwargs[self.lookup_url_kwarg or self.lookup_field]
+
+        def queryset():
+            return self.filter_queryset(self.get_queryset()).filter(**{self.lookup_field: lookup})
+
+        def respond():
+            return super(ConditionalGetMixin, self).retrieve(request, *args, **kwargs)
+
+        return self.conditional_response(request, queryset, respond, allow_empty=False)
@@ -0,0 +1,83 @@
+"""
+Pub/sub used to push M-Pesa payment status changes to waiting clients.
+
+The default ``InProcessBroker`` delivers messages to waiters in the same
+process, which is enough for a single ASGI worker. Any class with the same
+``publish(channel, message)`` / ``subscribe(channel)`` interface can be swapped
+in through the ``PAYMENT_EVENTS_BROKER`` setting (e.g. one backed by a local
+Redis or NATS instance when running several workers). Waiters also re-check
+the database periodically, so a missed message only delays them.
+"""
+
+import asyncio
+import threading
+from collections import defaultdict
+
+from django.conf import settings
+from django.utils.module_loading import import_string
+
+
+class Subscription:
+    """Handle returned by InProcessBroker.subscribe(); use as a context manager"""
+
+    def __init__(self, broker, channel):
+        self.broker = broker
+        self.channel = channel
+        self.loop = asyncio.get_running_loop()
+        self.queue = asyncio.Queue()
+
+    def __enter__(self):
+        self.broker._add(self)
+        return self
+
+    def __exit__(self, *exc):
+        self.broker._discard(self)
+
+    async def get(self, timeout):
+        """Next message, or None if nothing arrives within ``timeout`` seconds"""
+        try:
+            return await asyncio.wait_for(self.queue.get(), timeout)
+        except asyncio.TimeoutError:
+            return None
+
+
+class InProcessBroker:
+    """Thread-safe fan-out from sync publishers to asyncio subscribers"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._subscribers = defaultdict(set)
+
+    def subscribe(self, channel):
+        return Subscription(self, channel)
+
+    def publish(self, channel, message):
+        with self._lock:
+            subscribers = list(self._subscribers.get(channel, ()))
+        for sub in subscribers:
+            sub.loop.call_soon_threadsafe(sub.queue.put_nowait, message)
+        return len(subscribers)
+
+    def _add(self, sub):
+        with self._lock:
+            self._subscribers[sub.channel].add(sub)
+
+    def _discard(self, sub):
+        with self._lock:
+            subs = self._subscribers.get(sub.channel)
+            if subs is not None:
+                subs.discard(sub)
+                if not subs:
+                    del self._subscribers[sub.channel]
+
+
+def _load_broker():
+    path = getattr(settings, 'PAYMENT_EVENTS_BROKER', 'pharmacy_app.events.InProcessBroker')
+    return import_string(path)()
+
+
+broker = _load_broker()
+
+
+def mpesa_channel(txn_id):
+    return f"mpesa:{txn_id}"
@@ -0,0 +1,183 @@
+"""
+Demand-based reorder points.
+
+For each medicine, daily units sold over the last ``window`` complete days
+give a mean demand and its standard deviation. With a supplier lead time of
+L days and a service-level z-score:
+
+    reorder_point  = ceil(mean * L + z * std * sqrt(L))
+    order_quantity = ceil(mean * cover_days)
+
+Sales are summed per (medicine, day) in SQL, then scattered into one
+medicines x days matrix per chunk, and every statistic is a NumPy reduction
+along the day axis, so all SKUs in a chunk are computed at once.
+
+Results are stored on Medicine.reorder_point / order_quantity (read by
+is_low_stock and the low-stock filters), with the statistics in
+DemandForecast. A medicine with no demand left in the window goes back to
+its reorder_level and loses its forecast. refresh() is incremental by
+default: only medicines with SaleItems newer than the previous run, or on
+sales whose status changed since then (both tracked in ForecastRun), are
+recomputed. Run it with ``manage.py forecast_demand``.
+
+NumPy is an optional dependency (``pip install numpy``).
+"""
+
+import math
+from datetime import datetime, time, timedelta
+
+from django.db import transaction
+from django.db.models import Max, Q, Sum
+from django.db.models.functions import TruncDate
+from django.utils import timezone
+
+from .models import DemandForecast, ForecastRun, Medicine, SaleItem
+from .search import barcode_cache
+
+try:
+    import numpy as np
+except ImportError:  # optional dependency
+    np = None
+
+WINDOW_DAYS = 90
+LEAD_TIME_DAYS = 7
+SERVICE_Z = 1.65          # ~95% of lead-time demand covered
+COVER_DAYS = 30
+CHUNK_SIZE = 2000
+# The single ForecastRun row holding the incremental mark
+RUN_ID = 1
+
+
+def numpy_available():
+    return np is not None
+
+
+def daily_units(medicine_ids, start, end):
+    """(medicine_id, day, units) for completed sales on days in [start, end)"""
+    return SaleItem.objects.filter(
+        medicine_id__in=medicine_ids,
+        sale__status='completed',
+        sale__created_at__gte=start,
+        sale__created_at__lt=end,
+    ).annotate(
+        day=TruncDate('sale__created_at'),
+    ).values('medicine_id', 'day').annotate(
+        units=Sum('quantity'),
+    ).values_list('medicine_id', 'day', 'units').order_by()
+
+
+def demand_matrix(medicine_ids, rows, first_day, days):
+    """medicines x days array of units sold, rows in medicine_ids order"""
+    matrix = np.zeros((len(medicine_ids), days))
+    if rows:
+        position = {med_id: i for i, med_id in enumerate(medicine_ids)}
+        meds, day_values, units = zip(*rows)
+        row_idx = np.fromiter((position[m] for m in meds), dtype=np.int64, count=len(rows))
+        day_idx = np.fromiter((d.toordinal() for d in day_values), dtype=np.int64, count=len(rows))
+        day_idx -= first_day.toordinal()
+        np.add.at(matrix, (row_idx, day_idx), np.asarray(units, dtype=np.float64))
+    return matrix
+
+
+def reorder_levels(matrix, lead_time, z, cover_days):
+    """(mean, std, reorder_point, order_quantity) arrays, one entry per matrix row"""
+    mean = matrix.mean(axis=1)
+    std = matrix.std(axis=1, ddof=1) if matrix.shape[1] > 1 else np.zeros(len(matrix))
+    reorder_point = np.ceil(mean * lead_time + z * std * math.sqrt(lead_time)).astype(np.int64)
+    order_quantity = np.ceil(mean * cover_days).astype(np.int64)
+    return mean, std, reorder_point, order_quantity
+
+
+def refresh(full=False, window=WINDOW_DAYS, lead_time=LEAD_TIME_DAYS, z=SERVICE_Z,
+            cover_days=COVER_DAYS, chunk_size=CHUNK_SIZE, today=None):
+    """
+    Recompute forecasts for medicines with new sales since the last run (or
+    every medicine with sales in the window when ``full``). Returns the
+    number of medicines updated.
+    """
+    started = timezone.now()
+    today = today or timezone.localdate()
+    first_day = today - timedelta(days=window)
+    start = timezone.make_aware(datetime.combine(first_day, time.min))
+    end = timezone.make_aware(datetime.combine(today, time.min))
+    # Today's sales are not in the window yet; leave them for the run that counts them
+    counted = SaleItem.objects.filter(sale__created_at__lt=end)
+    sales_through = counted.aggregate(top=Max('id'))['top'] or 0
+
+    if full:
+        candidates = counted.filter(sale__created_at__gte=start)
+    else:
+        last_run = ForecastRun.objects.filter(pk=RUN_ID).first()
+        # New lines, plus lines of sales whose status changed since the last
+        # run (an M-Pesa payment completing, a refund): those add no SaleItem
+        changed = Q(id__gt=last_run.sales_through if last_run else 0, id__lte=sales_through)
+        if last_run is not None:
+            changed |= Q(sale__updated_at__gte=last_run.started_at, sale__created_at__gte=start)
+        candidates = counted.filter(changed)
+    medicine_ids = set(candidates.filter(medicine__isnull=False).values_list('medicine_id', flat=True).distinct())
+    if full:
+        # Medicines whose sales have all aged out of the window lose their forecast
+        medicine_ids.update(DemandForecast.objects.values_list('medicine_id', flat=True))
+    medicine_ids = sorted(medicine_ids)
+
+    updated = 0
+    for i in range(0, len(medicine_ids), chunk_size):
+        chunk = medicine_ids[i:i + chunk_size]
+        rows = list(daily_units(chunk, start, end))
+        mean, std, reorder_point, order_quantity = reorder_levels(
+            demand_matrix(chunk, rows, first_day, window), lead_time, z, cover_days,
+        )
+        updated += _store(chunk, mean, std, reorder_point, order_quantity, window, lead_time,
+                          sales_through, started)
+    # Only a run that got through every chunk moves the mark
+    ForecastRun.objects.update_or_create(pk=RUN_ID, defaults={'sales_through': sales_through, 'started_at': started})
+    return updated
+
+
+def _store(medicine_ids, mean, std, reorder_point, order_quantity, window, lead_time, sales_through, computed_at):
+    # Per chunk, not the run's start: tills and the search index sync on
+    # updated_at and would skip a row stamped older than a version they have
+    now = timezone.now()
+    current = {
+        pk: (rop, qty) for pk, rop, qty in
+        Medicine.objects.filter(pk__in=medicine_ids).values_list('id', 'reorder_point', 'order_quantity')
+    }
+    changed = []
+    forecasts = []
+    idle = []
+    for i, med_id in enumerate(medicine_ids):
+        if med_id not in current:
+            continue
+        if mean[i] > 0:
+            values = (int(reorder_point[i]), int(order_quantity[i]))
+        else:
+            # No demand left in the window: back to the hand-set reorder_level
+            # rather than a reorder point of 0 that never flags low stock
+            values = (None, None)
+        if current[med_id] != values:
+            # updated_at moves so cached medicine lists pick up the new low-stock flag
+            changed.append(Medicine(pk=med_id, reorder_point=values[0], order_quantity=values[1], updated_at=now))
+        if values[0] is None:
+            idle.append(med_id)
+            continue
+        forecasts.append(DemandForecast(
+            medicine_id=med_id,
+            daily_demand=float(mean[i]),
+            demand_std=float(std[i]),
+            window_days=window,
+            lead_time_days=lead_time,
+            sales_through=sales_through,
+            computed_at=computed_at,
+        ))
+    with transaction.atomic():
+        Medicine.objects.bulk_update(changed, ['reorder_point', 'order_quantity', 'updated_at'], batch_size=500)
+        DemandForecast.objects.filter(medicine_id__in=idle).delete()
+        DemandForecast.objects.bulk_create(
+            forecasts, batch_size=500, update_conflicts=True, unique_fields=['medicine'],
+            update_fields=['daily_demand', 'demand_std', 'window_days', 'lead_time_days', 'sales_through', 'computed_at'],
+        )
+        # Cached scan results carry is_low_stock
+        ids = [medicine.pk for medicine in changed]
+        if ids:
+            transaction.on_commit(lambda: barcode_cache.invalidate(ids))
+    return len(forecasts) + len(idle)
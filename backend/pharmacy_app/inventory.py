@@ -0,0 +1,323 @@
+"""
+Batch (lot) level stock.
+
+Each delivery is a StockBatch with its own lot number, expiry and cost.
+Medicine.stock_quantity stays the on-hand total and Medicine.expiry_date the
+earliest expiry among batches with stock, so POS search and listings never
+aggregate batches. Every function here changes batches and those two columns
+in the same transaction.
+
+Stock recorded before batches existed (or typed straight into the medicine
+form) is "untracked": the part of stock_quantity not covered by any batch.
+Allocation drains batches first-expiry-first-out and takes whatever is left
+from untracked stock, so the medicine total remains the authority on how
+much can be sold.
+
+Every change is also appended to the StockMovement ledger, in bulk, one row
+per batch touched. snapshot() periodically folds the ledger into a
+StockSnapshot per medicine, so stock_at() needs the latest snapshot plus the
+movements after it rather than a replay of the whole history.
+"""
+
+from datetime import timedelta
+
+from django.db import transaction
+from django.db.models import Case, F, IntegerField, Max, Min, OuterRef, Q, Subquery, Sum, When
+from django.db.models.functions import Coalesce
+from django.utils import timezone
+
+from .models import Medicine, SaleItem, StockBatch, StockMovement, StockSnapshot
+from .search import barcode_cache
+
+# Ledger rows younger than this are left out of snapshots: a row can get its
+# id before the transaction that wrote it commits, and a snapshot must never
+# skip past an id that is not visible yet
+SNAPSHOT_SETTLE = timedelta(minutes=5)
+
+
+class StockConflict(Exception):
+    """A batch changed between being read and being updated; roll back and retry"""
+
+
+def fefo_batches(medicine_ids):
+    """Batches with stock for these medicines, in allocation order, locked"""
+    return StockBatch.objects.select_for_update().filter(
+        medicine_id__in=medicine_ids, quantity__gt=0,
+    ).order_by(
+        'medicine_id', F('expiry_date').asc(nulls_last=True), 'id',
+    ).values_list('id', 'medicine_id', 'quantity')
+
+
+def plan_allocation(rows, quantities):
+    """
+    Split {medicine_id: quantity} over FEFO-ordered (batch_id, medicine_id,
+    available) rows. Returns {medicine_id: [(batch_id, quantity), ...]};
+    demand the batches cannot cover is left to untracked stock.
+    """
+    remaining = dict(quantities)
+    plan = {}
+    for batch_id, med_id, available in rows:
+        need = remaining.get(med_id, 0)
+        if need <= 0:
+            continue
+        take = min(need, available)
+        plan.setdefault(med_id, []).append((batch_id, take))
+        remaining[med_id] = need - take
+    return plan
+
+
+def allocate(quantities):
+    """
+    Take {medicine_id: quantity} from batches, first expiry first out: one
+    SELECT for every batch of every medicine, one UPDATE for all of them.
+    Medicine totals are not touched (checkout's reserve_stock does that).
+    Returns the allocation plan, or None if a batch changed underneath us and
+    the caller must roll back.
+    """
+    rows = list(fefo_batches(list(quantities)))
+    plan = plan_allocation(rows, quantities)
+    takes = {batch_id: qty for lines in plan.values() for batch_id, qty in lines}
+    if not takes:
+        return plan
+
+    guard = Q()
+    whens = []
+    for batch_id, qty in takes.items():
+        guard |= Q(pk=batch_id, quantity__gte=qty)
+        whens.append(When(pk=batch_id, then=F('quantity') - qty))
+    updated = StockBatch.objects.filter(guard).update(
+        quantity=Case(*whens, output_field=IntegerField()),
+    )
+    if updated != len(takes):
+        return None
+
+    # The earliest expiry only moves when a batch runs out
+    refresh_expiry({med_id for batch_id, med_id, available in rows if takes.get(batch_id) == available})
+    return plan
+
+
+def movements_for(plan, quantities, kind, sign=-1, **fields):
+    """
+    Ledger rows for an allocation plan: one per batch, plus one for the part
+    of each quantity that came from (or went to) untracked stock
+    """
+    rows = []
+    for med_id, qty in quantities.items():
+        tracked = 0
+        for batch_id, take in plan.get(med_id, ()):
+            rows.append(StockMovement(medicine_id=med_id, batch_id=batch_id, kind=kind, quantity=sign * take, **fields))
+            tracked += take
+        if qty > tracked:
+            rows.append(StockMovement(medicine_id=med_id, kind=kind, quantity=sign * (qty - tracked), **fields))
+    return rows
+
+
+def record(movements):
+    StockMovement.objects.bulk_create(movements, batch_size=500)
+
+
+def open_stock(medicine, user=None):
+    """Opening batch and ledger row for a medicine created with stock already on hand"""
+    open_stock_many([medicine], user=user)
+
+
+def open_stock_many(medicines, user=None, batch_size=500):
+    """open_stock for many saved medicines: one bulk INSERT for batches, one for the ledger"""
+    batches = [
+        StockBatch(medicine=medicine, lot_number='OPENING', quantity=medicine.stock_quantity,
+                   expiry_date=medicine.expiry_date, cost_price=medicine.cost_price)
+        for medicine in medicines if medicine.stock_quantity
+    ]
+    StockBatch.objects.bulk_create(batches, batch_size=batch_size)
+    StockMovement.objects.bulk_create([
+        StockMovement(medicine=batch.medicine, batch=batch, kind='opening', quantity=batch.quantity, user=user)
+        for batch in batches
+    ], batch_size=batch_size)
+
+
+def receive(medicine_id, quantity, lot_number='', expiry_date=None, cost_price=None, user=None, note=''):
+    """Book a delivery in as a new batch and add it to the medicine total"""
+    line = {'medicine_id': medicine_id, 'delta': quantity, 'lot_number': lot_number,
+            'expiry_date': expiry_date, 'cost_price': cost_price}
+    return adjust_many([line], user=user, note=note)[0]['batch']
+
+
+def adjust(medicine_id, delta, user=None, note=''):
+    """Add or remove stock for one medicine; returns the delta actually applied"""
+    return adjust_many([{'medicine_id': medicine_id, 'delta': delta}], user=user, note=note)[0]['applied']
+
+
+def set_count(medicine_id, counted, user=None, note=''):
+    """Set stock to a counted quantity; the difference is taken against the locked row"""
+    return adjust_many([{'medicine_id': medicine_id, 'count': counted}], user=user, note=note)[0]['applied']
+
+
+def adjust_many(lines, user=None, note=''):
+    """
+    Apply stock changes to many medicines in one transaction.
+
+    ``lines`` are dicts with ``medicine_id`` and a signed ``delta``; a positive
+    line with a ``lot_number`` (and optionally ``expiry_date``/``cost_price``)
+    is a delivery and becomes its own batch. A line with ``count`` instead
+    of ``delta`` sets the medicine to that quantity (a stock take). Removals
+    come out of batches first-expiry-first-out and never take a medicine
+    below zero.
+
+    The medicine rows are locked with one SELECT; totals change with a single
+    F() UPDATE, batches with one bulk INSERT and one UPDATE, and the ledger
+    with one bulk INSERT, however many lines there are. Returns one result
+    per line: None for an unknown medicine, else {'applied', 'batch'}.
+    """
+    with transaction.atomic():
+        stock = dict(Medicine.objects.select_for_update().filter(
+            pk__in={line['medicine_id'] for line in lines},
+        ).values_list('id', 'stock_quantity'))
+
+        results, net, removed, added, receipts = [], {}, {}, {}, []
+        for line in lines:
+            med_id = line['medicine_id']
+            if med_id not in stock:
+                results.append(None)
+                continue
+            if 'count' in line:
+                delta = line['count'] - stock[med_id]
+            else:
+                delta = max(line['delta'], -stock[med_id])
+            stock[med_id] += delta
+            net[med_id] = net.get(med_id, 0) + delta
+            result = {'applied': delta, 'batch': None}
+            if delta < 0:
+                removed[med_id] = removed.get(med_id, 0) - delta
+            elif delta > 0 and line.get('lot_number'):
+                result['batch'] = StockBatch(
+                    medicine_id=med_id,
+                    lot_number=line['lot_number'],
+                    expiry_date=line.get('expiry_date'),
+                    quantity=delta,
+                    cost_price=line['cost_price'] if line.get('cost_price') is not None else 0,
+                )
+                receipts.append(result['batch'])
+            elif delta > 0:
+                added[med_id] = added.get(med_id, 0) + delta
+            results.append(result)
+
+        # Lots received in this call go in first, so removals in the same
+        # call can draw on them like on any other batch
+        received = [batch.quantity for batch in receipts]
+        StockBatch.objects.bulk_create(receipts)
+        plan = allocate(removed) if removed else {}
+        if plan is None:
+            raise StockConflict('Stock batches changed during the adjustment')
+        changed = {med_id: delta for med_id, delta in net.items() if delta}
+        if changed:
+            Medicine.objects.filter(pk__in=list(changed)).update(
+                stock_quantity=Case(
+                    *[When(pk=med_id, then=F('stock_quantity') + delta) for med_id, delta in changed.items()],
+                    output_field=IntegerField(),
+                ),
+                updated_at=timezone.now(),
+            )
+        refresh_expiry({batch.medicine_id for batch in receipts})
+
+        fields = {'user': user, 'note': note}
+        record(
+            [StockMovement(medicine_id=batch.medicine_id, batch=batch, kind='receipt',
+                           quantity=qty, **fields) for batch, qty in zip(receipts, received)]
+            + movements_for({}, added, 'adjustment', sign=1, **fields)
+            + movements_for(plan, removed, 'adjustment', sign=-1, **fields)
+        )
+    ids = list(changed)
+    if ids:
+        transaction.on_commit(lambda: barcode_cache.invalidate(ids))
+    return results
+
+
+def refund(sale, user=None):
+    """
+    Put a sale's items back into stock, into the batches they were sold
+    from where the ledger knows them. Call inside transaction.atomic().
+    """
+    quantities = {}
+    for med_id, qty in SaleItem.objects.filter(sale=sale, medicine__isnull=False).values_list('medicine_id', 'quantity'):
+        quantities[med_id] = quantities.get(med_id, 0) + qty
+    if not quantities:
+        return
+    plan = {}
+    sold = StockMovement.objects.filter(
+        sale=sale, kind='sale', batch__isnull=False,
+    ).values_list('medicine_id', 'batch_id').annotate(total=Sum('quantity')).order_by()
+    for med_id, batch_id, total in sold:
+        plan.setdefault(med_id, []).append((batch_id, -total))
+
+    restock = {batch_id: qty for lines in plan.values() for batch_id, qty in lines}
+    if restock:
+        StockBatch.objects.filter(pk__in=list(restock)).update(quantity=Case(
+            *[When(pk=batch_id, then=F('quantity') + qty) for batch_id, qty in restock.items()],
+            output_field=IntegerField(),
+        ))
+    Medicine.objects.filter(pk__in=list(quantities)).update(
+        stock_quantity=Case(
+            *[When(pk=med_id, then=F('stock_quantity') + qty) for med_id, qty in quantities.items()],
+            output_field=IntegerField(),
+        ),
+        updated_at=timezone.now(),
+    )
+    refresh_expiry(plan)
+    record(movements_for(plan, quantities, 'refund', sign=1, sale=sale, user=user))
+    ids = list(quantities)
+    transaction.on_commit(lambda: barcode_cache.invalidate(ids))
+
+
+def refresh_expiry(medicine_ids):
+    """Set expiry_date to the earliest expiry among batches with stock"""
+    if not medicine_ids:
+        return
+    earliest = StockBatch.objects.filter(
+        medicine=OuterRef('pk'), quantity__gt=0,
+    ).order_by().values('medicine').annotate(first=Min('expiry_date')).values('first')
+    # Medicines without dated batches keep the expiry typed into the form
+    Medicine.objects.filter(pk__in=list(medicine_ids)).update(
+        expiry_date=Coalesce(Subquery(earliest), F('expiry_date')),
+    )
+
+
+# ─── Snapshots ─────────────────────────────────────────────────────────────────
+
+def snapshot(now=None):
+    """
+    Fold settled ledger rows into a new snapshot for every medicine that has
+    movements since its last one. Returns the number of snapshots written.
+    """
+    cutoff = (now or timezone.now()) - SNAPSHOT_SETTLE
+    high_water = StockMovement.objects.filter(created_at__lte=cutoff).aggregate(top=Max('id'))['top']
+    if high_water is None:
+        return 0
+    # Every movement up to the previous run's high-water mark is already in
+    # some snapshot: a medicine without one at that mark had no movements in
+    # between. So only the ledger tail is read, on top of each latest snapshot.
+    previous = StockSnapshot.objects.aggregate(mark=Max('movement_id'))['mark'] or 0
+    if high_water <= previous:
+        return 0
+    latest = StockSnapshot.objects.filter(medicine=OuterRef('medicine')).order_by('-movement_id')
+    rows = StockMovement.objects.filter(id__gt=previous, id__lte=high_water).values('medicine').annotate(
+        delta=Sum('quantity'),
+        base=Coalesce(Subquery(latest.values('quantity')[:1]), 0),
+    ).values_list('medicine', 'base', 'delta').order_by()
+
+    created = StockSnapshot.objects.bulk_create([
+        StockSnapshot(medicine_id=med_id, movement_id=high_water, quantity=base + delta, taken_at=cutoff)
+        for med_id, base, delta in rows
+    ], batch_size=1000, ignore_conflicts=True)
+    return len(created)
+
+
+def stock_at(medicine_id, at):
+    """Stock on hand at ``at``: the last snapshot before it plus the movements since"""
+    snap = StockSnapshot.objects.filter(
+        medicine_id=medicine_id, taken_at__lte=at,
+    ).order_by('-movement_id').values_list('movement_id', 'quantity').first()
+    mark, base = snap or (0, 0)
+    tail = StockMovement.objects.filter(
+        medicine_id=medicine_id, id__gt=mark, created_at__lte=at,
+    ).aggregate(total=Sum('quantity'))['total']
+    return base + (tail or 0)
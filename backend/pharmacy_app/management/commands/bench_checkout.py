@@ -0,0 +1,278 @@
+"""
+Checkout throughput benchmark: drives SaleViewSet.create from concurrent
+threads with synthetic baskets and reports sales/s, latency percentiles,
+queries per checkout and time spent waiting on stock locks.
+
+    python manage.py bench_checkout --requests 500 --concurrency 1 4 8 \
+        --basket 1 8 --skus 200 --zipf 1.2 --output bench/$(git rev-parse --short HEAD).json
+    python manage.py bench_checkout --compare bench/main.json
+
+Popular SKUs are picked with a Zipf distribution (--zipf 0 is uniform), so a
+higher exponent means more checkouts contend for the same stock rows. The
+benchmark creates its own cashier and medicines, commits real sales (the
+concurrent requests need to see each other's writes) and deletes all of it
+afterwards. Run it against a disposable or development database.
+"""
+
+import json
+import queue
+import random
+import subprocess
+import threading
+import time
+import uuid
+from decimal import Decimal
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.utils import timezone
+from rest_framework.test import APIRequestFactory, force_authenticate
+
+from pharmacy_app.models import Medicine, Sale
+from pharmacy_app.views import SaleViewSet
+
+
+def percentile(values, pct):
+    """Nearest-rank percentile of an unsorted list"""
+    if not values:
+        return None
+    ordered = sorted(values)
+    rank = max(0, min(len(ordered) - 1, round(pct / 100 * len(ordered) + 0.5) - 1))
+    return ordered[rank]
+
+
+def zipf_weights(n, exponent):
+    return [1 / (rank ** exponent) for rank in range(1, n + 1)]
+
+
+class QueryTimer:
+    """execute_wrapper that counts queries and times the stock-locking ones"""
+
+    def __init__(self):
+        self.queries = 0
+        self.lock_wait = 0.0
+
+    def __call__(self, execute, sql, params, many, context):
+        self.queries += 1
+        # The SELECT ... FOR UPDATE on medicines and the conditional stock
+        # UPDATE are where concurrent checkouts queue behind each other
+        locking = 'FOR UPDATE' in sql or sql.startswith('UPDATE "pharmacy_app_medicine"')
+        start = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            if locking:
+                self.lock_wait += time.perf_counter() - start
+
+
+def git_revision():
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True, timeout=5,
+        ).stdout.strip()
+    except (OSError, subprocess.SubprocessError):
+        return ''
+
+
+class Command(BaseCommand):
+    help = "Benchmark concurrent checkouts through the real sale view and report latency percentiles."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--requests", type=int, default=300, help="Checkouts per concurrency level.")
+        parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 4, 8])
+        parser.add_argument("--basket", type=int, nargs=2, default=[1, 6], metavar=("MIN", "MAX"),
+                            help="Distinct items per basket, picked uniformly in this range.")
+        parser.add_argument("--quantity", type=int, nargs=2, default=[1, 3], metavar=("MIN", "MAX"))
+        parser.add_argument("--skus", type=int, default=200, help="Number of benchmark medicines.")
+        parser.add_argument("--zipf", type=float, default=1.1, help="SKU popularity skew; 0 = uniform.")
+        parser.add_argument("--seed", type=int, default=42)
+        parser.add_argument("--warmup", type=int, default=3, help="Untimed checkouts per thread before timing starts.")
+        parser.add_argument("--label", default="", help="Free-form name stored with the results.")
+        parser.add_argument("--output", help="Write results as JSON to this file.")
+        parser.add_argument("--compare", help="Print the difference against an earlier JSON result.")
+
+    def handle(self, *args, **options):
+        if options["basket"][0] < 1 or options["basket"][1] > options["skus"]:
+            raise CommandError("--basket must be between 1 and --skus")
+
+        cashier, medicines = self._setup(options["skus"])
+        try:
+            scenarios = [self._scenario(cashier, medicines, level, options) for level in options["concurrency"]]
+        finally:
+            self._teardown(cashier, medicines)
+
+        result = {
+            "label": options["label"],
+            "git_revision": git_revision(),
+            "created_at": timezone.now().isoformat(),
+            "database": connection.vendor,
+            "config": {key: options[key] for key in ("requests", "basket", "quantity", "skus", "zipf", "seed")},
+            "scenarios": scenarios,
+        }
+        self._print(scenarios)
+        if options["compare"]:
+            self._compare(scenarios, options["compare"])
+        if options["output"]:
+            with open(options["output"], "w") as fh:
+                json.dump(result, fh, indent=2)
+            self.stdout.write(self.style.SUCCESS(f"Results written to {options['output']}"))
+
+    # ─── Fixture ─────────────────────────────────────────────────────────────
+
+    def _setup(self, skus):
+        tag = uuid.uuid4().hex[:8]
+        cashier = User.objects.create_user(username=f"bench-{tag}")
+        Medicine.objects.bulk_create([
+            Medicine(name=f"Bench {tag} {i:05d}", price=Decimal("10.00"), stock_quantity=10_000_000)
+            for i in range(skus)
+        ])
+        # Ordered by rank: medicines[0] is the most popular SKU
+        medicines = list(Medicine.objects.filter(name__startswith=f"Bench {tag} ").order_by("name"))
+        return cashier, medicines
+
+    def _teardown(self, cashier, medicines):
+        # Deleting through the ORM keeps the daily sales rollup consistent
+        Sale.objects.filter(cashier=cashier).delete()
+        Medicine.objects.filter(pk__in=[m.pk for m in medicines]).delete()
+        cashier.delete()
+
+    # ─── Load generation ─────────────────────────────────────────────────────
+
+    def _baskets(self, medicines, count, options, rng):
+        weights = zipf_weights(len(medicines), options["zipf"])
+        baskets = []
+        for _ in range(count):
+            size = rng.randint(*options["basket"])
+            picked = {}
+            while len(picked) < size:
+                medicine = rng.choices(medicines, weights)[0]
+                picked[medicine.pk] = rng.randint(*options["quantity"])
+            baskets.append({
+                "payment_method": "cash",
+                "items": [
+                    {"medicine_id": pk, "quantity": qty, "unit_price": "10.00"}
+                    for pk, qty in picked.items()
+                ],
+            })
+        return baskets
+
+    def _scenario(self, cashier, medicines, concurrency, options):
+        rng = random.Random(options["seed"] + concurrency)
+        warmup_count = options["warmup"] * concurrency
+        baskets = self._baskets(medicines, warmup_count + options["requests"], options, rng)
+        warmup, timed = queue.SimpleQueue(), queue.SimpleQueue()
+        for i, payload in enumerate(baskets):
+            (warmup if i < warmup_count else timed).put(payload)
+
+        view = SaleViewSet.as_view({"post": "create"})
+        factory = APIRequestFactory()
+        samples = []
+        barrier = threading.Barrier(concurrency + 1)
+
+        def checkout(payload):
+            request = factory.post("/api/sales/", payload, format="json")
+            force_authenticate(request, user=cashier)
+            timer = QueryTimer()
+            try:
+                with connection.execute_wrapper(timer):
+                    start = time.perf_counter()
+                    response = view(request)
+                    elapsed = time.perf_counter() - start
+            except Exception as e:
+                return type(e).__name__, 0.0, 0, 0.0
+            return response.status_code, elapsed, timer.queries, timer.lock_wait
+
+        def drain(jobs, results=None):
+            while True:
+                try:
+                    payload = jobs.get_nowait()
+                except queue.Empty:
+                    return
+                sample = checkout(payload)
+                if results is not None:
+                    results.append(sample)
+
+        def worker():
+            # Each thread has its own connection; warm it up before the clock starts
+            try:
+                drain(warmup)
+                barrier.wait()
+                drain(timed, samples)
+            finally:
+                connection.close()
+
+        threads = [threading.Thread(target=worker) for _ in range(concurrency)]
+        for thread in threads:
+            thread.start()
+        barrier.wait()
+        wall_start = time.perf_counter()
+        for thread in threads:
+            thread.join()
+        wall = time.perf_counter() - wall_start
+
+        ok = [s for s in samples if s[0] == 201]
+        errors = {}
+        for status, *_ in samples:
+            if status != 201:
+                errors[str(status)] = errors.get(str(status), 0) + 1
+        latencies = [s[1] * 1000 for s in ok]
+        lock_waits = [s[3] * 1000 for s in ok]
+        return {
+            "concurrency": concurrency,
+            "requests": len(samples),
+            "succeeded": len(ok),
+            "errors": errors,
+            "wall_seconds": round(wall, 3),
+            "sales_per_second": round(len(ok) / wall, 2) if wall else None,
+            "latency_ms": {f"p{p}": _round(percentile(latencies, p)) for p in (50, 95, 99)},
+            "lock_wait_ms": {f"p{p}": _round(percentile(lock_waits, p)) for p in (50, 95, 99)},
+            "queries_per_request": round(sum(s[2] for s in ok) / len(ok), 2) if ok else None,
+        }
+
+    # ─── Reporting ───────────────────────────────────────────────────────────
+
+    def _print(self, scenarios):
+        self.stdout.write(
+            f"{'conc':>5} {'ok':>6} {'err':>5} {'sales/s':>9} {'p50 ms':>8} {'p95 ms':>8} "
+            f"{'p99 ms':>8} {'lock p95':>9} {'queries':>8}"
+        )
+        for s in scenarios:
+            lat, lock = s["latency_ms"], s["lock_wait_ms"]
+            self.stdout.write(
+                f"{s['concurrency']:>5} {s['succeeded']:>6} {sum(s['errors'].values()):>5} "
+                f"{_fmt(s['sales_per_second']):>9} {_fmt(lat['p50']):>8} {_fmt(lat['p95']):>8} "
+                f"{_fmt(lat['p99']):>8} {_fmt(lock['p95']):>9} {_fmt(s['queries_per_request']):>8}"
+            )
+            if s["errors"]:
+                self.stdout.write(f"      errors: {s['errors']}")
+
+    def _compare(self, scenarios, path):
+        with open(path) as fh:
+            baseline = json.load(fh)
+        previous = {s["concurrency"]: s for s in baseline.get("scenarios", [])}
+        self.stdout.write(f"\nvs {path} ({baseline.get('label') or baseline.get('git_revision') or 'baseline'}):")
+        for s in scenarios:
+            old = previous.get(s["concurrency"])
+            if old is None:
+                continue
+            self.stdout.write(
+                f"{s['concurrency']:>5}  sales/s {_delta(old['sales_per_second'], s['sales_per_second'])}"
+                f"  p95 {_delta(old['latency_ms']['p95'], s['latency_ms']['p95'])}"
+                f"  p99 {_delta(old['latency_ms']['p99'], s['latency_ms']['p99'])}"
+                f"  queries {_delta(old['queries_per_request'], s['queries_per_request'])}"
+            )
+
+
+def _round(value):
+    return round(value, 2) if value is not None else None
+
+
+def _fmt(value):
+    return "-" if value is None else f"{value:.2f}"
+
+
+def _delta(old, new):
+    if old in (None, 0) or new is None:
+        return f"{_fmt(old)} -> {_fmt(new)}"
+    return f"{_fmt(old)} -> {_fmt(new)} ({(new - old) / old * 100:+.1f}%)"
@@ -0,0 +1,73 @@
+"""
+Report how many SQL queries one checkout costs as the basket grows.
+
+Drives SaleViewSet.create through DRF's request factory inside a transaction
+that is rolled back at the end, so it is safe to run against any database:
+
+    python manage.py bench_checkout_queries --sizes 1 5 15 50
+"""
+
+import time
+from decimal import Decimal
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+from django.test.utils import CaptureQueriesContext
+from rest_framework.test import APIRequestFactory, force_authenticate
+
+from pharmacy_app.models import Medicine
+from pharmacy_app.views import SaleViewSet
+
+
+class _Rollback(Exception):
+    pass
+
+
+class Command(BaseCommand):
+    help = "Print queries-per-checkout for a range of basket sizes (no data is kept)."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--sizes", type=int, nargs="+", default=[1, 5, 10, 15, 25, 50])
+        parser.add_argument("--repeat", type=int, default=3, help="Checkouts per basket size.")
+
+    def handle(self, *args, **options):
+        sizes = options["sizes"]
+        try:
+            with transaction.atomic():
+                self._run(sizes, options["repeat"])
+                raise _Rollback
+        except _Rollback:
+            pass
+
+    def _run(self, sizes, repeat):
+        cashier = User.objects.create_user(username=f"bench-{time.time_ns()}")
+        medicines = Medicine.objects.bulk_create([
+            Medicine(name=f"Bench Medicine {i}", price=Decimal("10.00"), stock_quantity=1_000_000)
+            for i in range(max(sizes))
+        ])
+        view = SaleViewSet.as_view({"post": "create"})
+        factory = APIRequestFactory()
+
+        self.stdout.write(f"{'basket':>8} {'queries':>8} {'ms':>10}")
+        for size in sizes:
+            payload = {
+                "payment_method": "cash",
+                "items": [
+                    {"medicine_id": m.pk, "quantity": 1, "unit_price": "10.00"}
+                    for m in medicines[:size]
+                ],
+            }
+            counts, elapsed = [], 0.0
+            for _ in range(repeat):
+                request = factory.post("/api/sales/", payload, format="json")
+                force_authenticate(request, user=cashier)
+                with CaptureQueriesContext(connection) as ctx:
+                    start = time.perf_counter()
+                    response = view(request)
+                    elapsed += time.perf_counter() - start
+                if response.status_code != 201:
+                    self.stderr.write(f"checkout failed: {response.status_code} {response.data}")
+                    return
+                counts.append(len(ctx.captured_queries))
+            self.stdout.write(f"{size:>8} {max(counts):>8} {elapsed / repeat * 1000:>10.2f}")
@@ -0,0 +1,65 @@
+"""
+Print the database query plan for each hot query issued by views.py.
+
+Uses QuerySet.explain(), i.e. EXPLAIN QUERY PLAN on SQLite and EXPLAIN on
+PostgreSQL, so index use can be checked on whichever backend is configured:
+
+    python manage.py explain_hot_queries
+    python manage.py explain_hot_queries --only sales_list
+"""
+
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db.models import Sum
+from django.utils import timezone
+
+from pharmacy_app.models import DailySalesSummary, Medicine, Sale, SaleItem
+from pharmacy_app.views import start_of_day
+
+
+def hot_queries():
+    """name -> queryset, mirroring the filters used by the API views"""
+    today = timezone.localdate()
+    week_start = today - timedelta(days=6)
+    active = Medicine.objects.active()
+    return {
+        "medicine_list": active.select_related("category").order_by("name"),
+        "medicine_list_by_category": active.filter(category_id=1).order_by("name"),
+        "medicine_low_stock": active.low_stock().order_by("name"),
+        "medicine_expired": active.expired(),
+        "pos_search_hydrate": active.filter(stock_quantity__gt=0, pk__in=[1, 2, 3]),
+        "barcode_lookup": active.filter(barcode__in=["6001001000001"]),
+        "sales_list": Sale.objects.filter(
+            created_at__gte=start_of_day(week_start),
+            created_at__lt=start_of_day(today) + timedelta(days=1),
+        ).order_by("-created_at"),
+        "sales_list_filtered": Sale.objects.filter(
+            created_at__gte=start_of_day(week_start), status="completed", payment_method="mpesa",
+        ).order_by("-created_at"),
+        "dashboard_rollup": DailySalesSummary.objects.filter(
+            date__range=(week_start, today), status="completed",
+        ),
+        "dashboard_top_medicines": SaleItem.objects.filter(
+            sale__created_at__gte=start_of_day(week_start), sale__status="completed",
+        ).values("medicine_name").annotate(total_qty=Sum("quantity")).order_by("-total_qty")[:5],
+    }
+
+
+class Command(BaseCommand):
+    help = "Print EXPLAIN output for the hot queries in views.py to verify index use."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--only", nargs="+", help="Restrict to these query names.")
+
+    def handle(self, *args, **options):
+        queries = hot_queries()
+        names = options["only"] or list(queries)
+        unknown = set(names) - set(queries)
+        if unknown:
+            raise CommandError(f"Unknown query name(s): {', '.join(sorted(unknown))}")
+
+        for name in names:
+            self.stdout.write(self.style.MIGRATE_HEADING(f"── {name}"))
+            self.stdout.write(queries[name].explain())
+            self.stdout.write("")
@@ -0,0 +1,175 @@
+"""
+Run a local stand-in for the Safaricom Daraja API so STK push can be exercised
+and load-tested offline.
+
+    python manage.py fake_daraja --port 8900 --latency 1.5 \
+        --callback-url http://127.0.0.1:8000/api/mpesa/callback/
+
+Then start Django with MPESA_BASE_URL=http://127.0.0.1:8900. Implements the
+three endpoints MpesaService uses: OAuth token, STK push and STK query. When a
+callback URL is given, a result callback is POSTed for every push after
+--callback-delay seconds, like Daraja does.
+"""
+
+import json
+import random
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import requests
+from django.core.management.base import BaseCommand
+
+
+class FakeDaraja:
+    """Shared state and behaviour for the request handler"""
+
+    def __init__(self, latency=0.0, jitter=0.0, result_code='0', callback_url='', callback_delay=3.0):
+        self.latency = latency
+        self.jitter = jitter
+        self.result_code = result_code
+        self.callback_url = callback_url
+        self.callback_delay = callback_delay
+        self.pushes = {}   # CheckoutRequestID -> amount
+        self.lock = threading.Lock()
+        self.stats = {'oauth': 0, 'stkpush': 0, 'query': 0, 'callbacks': 0}
+
+    def wait(self):
+        delay = self.latency + random.uniform(0, self.jitter)
+        if delay > 0:
+            time.sleep(delay)
+
+    def count(self, key):
+        with self.lock:
+            self.stats[key] += 1
+
+    def oauth(self):
+        self.count('oauth')
+        return {'access_token': uuid.uuid4().hex, 'expires_in': '3599'}
+
+    def stk_push(self, body):
+        self.count('stkpush')
+        checkout_id = f"ws_CO_{uuid.uuid4().hex[:20].upper()}"
+        with self.lock:
+            self.pushes[checkout_id] = body.get('Amount', 0)
+        if self.callback_url:
+            timer = threading.Timer(self.callback_delay, self.send_callback, args=(checkout_id,))
+            timer.daemon = True
+            timer.start()
+        return {
+            'MerchantRequestID': f"{random.randint(10000, 99999)}-{random.randint(1000000, 9999999)}-1",
+            'CheckoutRequestID': checkout_id,
+            'ResponseCode': '0',
+            'ResponseDescription': 'Success. Request accepted for processing',
+            'CustomerMessage': 'Success. Request accepted for processing',
+        }
+
+    def query(self, body):
+        self.count('query')
+        checkout_id = body.get('CheckoutRequestID')
+        if checkout_id not in self.pushes:
+            return {'errorCode': '400.002.02', 'errorMessage': 'Bad Request - Invalid CheckoutRequestID'}
+        return {
+            'ResponseCode': '0',
+            'ResponseDescription': 'The service request has been accepted successsfully',
+            'CheckoutRequestID': checkout_id,
+            'ResultCode': self.result_code,
+            'ResultDesc': self.result_description(),
+        }
+
+    def result_description(self):
+        if self.result_code == '0':
+            return 'The service request is processed successfully.'
+        if self.result_code == '1032':
+            return 'Request cancelled by user'
+        return 'The transaction failed.'
+
+    def send_callback(self, checkout_id):
+        body = {'ResultCode': int(self.result_code), 'ResultDesc': self.result_description(),
+                'CheckoutRequestID': checkout_id, 'MerchantRequestID': ''}
+        if self.result_code == '0':
+            body['CallbackMetadata'] = {'Item': [
+                {'Name': 'Amount', 'Value': self.pushes.get(checkout_id, 0)},
+                {'Name': 'MpesaReceiptNumber', 'Value': f"QKL{random.randint(1000000, 9999999)}"},
+                {'Name': 'PhoneNumber', 'Value': 254700000000},
+            ]}
+        try:
+            requests.post(self.callback_url, json={'Body': {'stkCallback': body}}, timeout=10)
+            self.count('callbacks')
+        except requests.RequestException:
+            pass
+
+
+def make_handler(daraja):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'   # keep-alive, so client connection pooling is exercised
+
+        def do_GET(self):
+            if self.path.startswith('/oauth/v1/generate'):
+                daraja.wait()
+                return self.reply(200, daraja.oauth())
+            self.reply(404, {'errorMessage': 'Not found'})
+
+        def do_POST(self):
+            length = int(self.headers.get('Content-Length') or 0)
+            try:
+                body = json.loads(self.rfile.read(length) or b'{}')
+            except ValueError:
+                return self.reply(400, {'errorMessage': 'Invalid JSON'})
+            if self.path.startswith('/mpesa/stkpush/v1/processrequest'):
+                daraja.wait()
+                return self.reply(200, daraja.stk_push(body))
+            if self.path.startswith('/mpesa/stkpushquery/v1/query'):
+                daraja.wait()
+                resp = daraja.query(body)
+                return self.reply(400 if 'errorCode' in resp else 200, resp)
+            self.reply(404, {'errorMessage': 'Not found'})
+
+        def reply(self, status, payload):
+            data = json.dumps(payload).encode()
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def log_message(self, format, *args):
+            pass
+
+    return Handler
+
+
+class Command(BaseCommand):
+    help = "Run a local fake Daraja (M-Pesa) API server for offline testing."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--host", default="127.0.0.1")
+        parser.add_argument("--port", type=int, default=8900)
+        parser.add_argument("--latency", type=float, default=0.0, help="Seconds added to every response.")
+        parser.add_argument("--jitter", type=float, default=0.0, help="Extra random 0..N seconds per response.")
+        parser.add_argument("--result-code", default="0", help="0 = success, 1032 = cancelled, anything else fails.")
+        parser.add_argument("--callback-url", default="", help="POST a result callback here after each push.")
+        parser.add_argument("--callback-delay", type=float, default=3.0)
+
+    def handle(self, *args, **options):
+        daraja = FakeDaraja(
+            latency=options["latency"],
+            jitter=options["jitter"],
+            result_code=options["result_code"],
+            callback_url=options["callback_url"],
+            callback_delay=options["callback_delay"],
+        )
+        server = ThreadingHTTPServer((options["host"], options["port"]), make_handler(daraja))
+        server.daemon_threads = True
+        self.stdout.write(self.style.SUCCESS(
+            f"Fake Daraja listening on http://{options['host']}:{options['port']} "
+            f"(latency {options['latency']}s). Ctrl+C to stop."
+        ))
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.server_close()
+            self.stdout.write(f"Requests served: {daraja.stats}")
@@ -0,0 +1,47 @@
+"""
+Recompute demand-based reorder points and order quantities.
+
+By default only medicines with sales recorded since the previous run are
+recomputed, so this is cheap to run nightly; --full recomputes every
+medicine sold within the window (e.g. after changing --lead-time).
+
+    python manage.py forecast_demand
+    python manage.py forecast_demand --full --window 120 --lead-time 10 --z 2.05
+
+Needs NumPy (pip install numpy).
+"""
+
+from django.core.management.base import BaseCommand, CommandError
+
+from pharmacy_app import forecasting
+
+
+class Command(BaseCommand):
+    help = "Refresh Medicine.reorder_point / order_quantity from recent sales."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--full", action="store_true", help="Recompute every medicine sold in the window.")
+        parser.add_argument("--window", type=int, default=forecasting.WINDOW_DAYS,
+                            help="Days of sales history to use.")
+        parser.add_argument("--lead-time", type=int, default=forecasting.LEAD_TIME_DAYS,
+                            help="Supplier lead time in days.")
+        parser.add_argument("--z", type=float, default=forecasting.SERVICE_Z,
+                            help="Service-level z-score for safety stock (1.65 = 95%%).")
+        parser.add_argument("--cover-days", type=int, default=forecasting.COVER_DAYS,
+                            help="Days of demand each suggested order should cover.")
+        parser.add_argument("--chunk-size", type=int, default=forecasting.CHUNK_SIZE)
+
+    def handle(self, *args, **options):
+        if not forecasting.numpy_available():
+            raise CommandError("forecast_demand needs NumPy: pip install numpy")
+        if options["window"] < 1 or options["lead_time"] < 1:
+            raise CommandError("--window and --lead-time must be at least 1 day")
+        count = forecasting.refresh(
+            full=options["full"],
+            window=options["window"],
+            lead_time=options["lead_time"],
+            z=options["z"],
+            cover_days=options["cover_days"],
+            chunk_size=options["chunk_size"],
+        )
+        self.stdout.write(self.style.SUCCESS(f"✓ {count} medicine forecasts refreshed."))
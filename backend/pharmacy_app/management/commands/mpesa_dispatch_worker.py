@@ -0,0 +1,59 @@
+"""
+Background worker that sends queued (async mode) STK pushes.
+
+The web process normally dispatches pushes itself from a thread pool right
+after the transaction commits; this worker picks up anything left behind,
+e.g. because the process restarted before the push went out.
+
+    python manage.py mpesa_dispatch_worker            # run forever
+    python manage.py mpesa_dispatch_worker --once     # single sweep
+"""
+
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections
+from django.utils import timezone
+
+from pharmacy_app.models import MpesaTransaction
+from pharmacy_app.mpesa import dispatch_stk_push
+
+
+def _dispatch(txn_id):
+    try:
+        return dispatch_stk_push(txn_id)
+    finally:
+        close_old_connections()
+
+
+class Command(BaseCommand):
+    help = "Send queued M-Pesa STK pushes that have not been dispatched yet."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--once", action="store_true", help="Run a single sweep and exit.")
+        parser.add_argument("--interval", type=float, default=2.0, help="Seconds between sweeps.")
+        parser.add_argument("--grace", type=float, default=5.0,
+                            help="Leave rows younger than this to the web process' own dispatcher.")
+        parser.add_argument("--concurrency", type=int, default=8)
+        parser.add_argument("--batch-size", type=int, default=100)
+
+    def handle(self, *args, **options):
+        with ThreadPoolExecutor(max_workers=options["concurrency"]) as pool:
+            while True:
+                sent = self._sweep(pool, options["grace"], options["batch_size"])
+                if sent:
+                    self.stdout.write(f"Dispatched {sent} STK push(es).")
+                if options["once"]:
+                    break
+                time.sleep(options["interval"])
+
+    def _sweep(self, pool, grace, batch_size):
+        cutoff = timezone.now() - timedelta(seconds=grace)
+        ids = list(MpesaTransaction.objects.filter(
+            reference__isnull=False, dispatched_at__isnull=True,
+            status='pending', updated_at__lt=cutoff,
+        ).order_by('created_at').values_list('id', flat=True)[:batch_size])
+        close_old_connections()
+        return sum(1 for claimed in pool.map(_dispatch, ids) if claimed)
@@ -0,0 +1,24 @@
+"""
+Recompute the DailySalesSummary rollup from the sales table.
+
+    python manage.py rebuild_sales_summary
+    python manage.py rebuild_sales_summary --date-from 2026-01-01
+"""
+
+from django.core.management.base import BaseCommand
+
+from pharmacy_app.rollups import rebuild
+
+
+class Command(BaseCommand):
+    help = "Rebuild the pre-aggregated daily sales summary used by the dashboard."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--date-from",
+            help="Only rebuild buckets on or after this date (YYYY-MM-DD).",
+        )
+
+    def handle(self, *args, **options):
+        count = rebuild(date_from=options["date_from"])
+        self.stdout.write(self.style.SUCCESS(f"✓ {count} daily sales buckets written."))
@@ -0,0 +1,49 @@
+"""
+Reconcile pending M-Pesa transactions whose callback never arrived.
+
+Queries Daraja's STK status endpoint for pending transactions, oldest first,
+under a global rate limit and with per-transaction exponential backoff, and
+marks transactions older than --stale-after as ``timeout``.
+
+    python manage.py reconcile_mpesa                      # run forever
+    python manage.py reconcile_mpesa --once               # single batch
+    python manage.py reconcile_mpesa --rate 5 --stale-after 600
+"""
+
+import time
+
+from django.core.management.base import BaseCommand
+
+from pharmacy_app.reconcile import Reconciler
+
+
+class Command(BaseCommand):
+    help = "Query Daraja for pending M-Pesa transactions and apply the results."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--once", action="store_true", help="Reconcile a single batch and exit.")
+        parser.add_argument("--interval", type=float, default=5.0, help="Seconds between batches.")
+        parser.add_argument("--rate", type=float, default=2.0, help="Maximum status queries per second.")
+        parser.add_argument("--concurrency", type=int, default=4)
+        parser.add_argument("--batch-size", type=int, default=50)
+        parser.add_argument("--min-age", type=float, default=30,
+                            help="Leave transactions younger than this to the callback.")
+        parser.add_argument("--stale-after", type=float, default=900,
+                            help="Mark transactions older than this as timeout.")
+
+    def handle(self, *args, **options):
+        reconciler = Reconciler(
+            rate=options["rate"],
+            concurrency=options["concurrency"],
+            batch_size=options["batch_size"],
+            min_age=options["min_age"],
+            stale_after=options["stale_after"],
+        )
+        while True:
+            outcomes = reconciler.run_once()
+            if outcomes:
+                summary = ", ".join(f"{status}: {n}" for status, n in sorted(outcomes.items()))
+                self.stdout.write(self.style.SUCCESS(f"Reconciled {sum(outcomes.values())} transaction(s) ({summary})"))
+            if options["once"]:
+                break
+            time.sleep(options["interval"])
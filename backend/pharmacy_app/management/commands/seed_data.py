@@ -1,36 +1,66 @@
 """
 Management command to seed the database with sample pharmacy data.
 Place this file at: your_app/management/commands/seed_data.py
+
+    python manage.py seed_data                      # small demo dataset
+    python manage.py seed_data --scale 10 --days 730 --workers 4
+
+--scale generates a load-testing dataset instead of the 30 demo sales:
+2,000 x SCALE medicines, 10 x SCALE cashiers and about 300 x SCALE sales per
+day for --days days, written with bulk_create in batches. The same --seed
+always produces the same catalogue and sales. --workers splits the days over
+several processes; use it on PostgreSQL/MySQL, SQLite allows only one writer.
+
+Scaled sales are booked in the stock ledger too, with an opening balance dated
+before the first sale that covers what was sold, so stock_at() and snapshots
+agree with stock_quantity.
 """
 
+import glob
+import multiprocessing
 import os
 import random
-import glob
+from contextlib import contextmanager
+from datetime import date, datetime, time, timedelta
 from decimal import Decimal
-from datetime import date, timedelta
+from functools import lru_cache
 
+from decouple import config
+from django.conf import settings
+from django.contrib.auth.hashers import make_password
+from django.core.files import File
+from django.core.management import call_command
 from django.core.management.base import BaseCommand
 from django.contrib.auth.models import User
+from django.db import connection, connections, transaction
+from django.db.models import Max, Sum
 from django.utils import timezone
-from django.core.files import File
 
 # Update this import to match your actual app name
-from pharmacy_app.models import Category, Medicine, Sale, SaleItem, MpesaTransaction
+from pharmacy_app import inventory
+from pharmacy_app.models import Category, Medicine, Sale, SaleItem, MpesaTransaction, StockMovement
 
 
 # ── Path to your local images folder ──────────────────────────────────────────
-IMAGES_DIR = r"D:\BACKUP\Complete Projects\Pharmacy_MIS\backend\static\mydawa.com-1771587885054"
+IMAGES_DIR = config(
+    "SEED_IMAGES_DIR",
+    default=os.path.join(settings.BASE_DIR, "static", "mydawa.com-1771587885054"),
+)
+
+
+@lru_cache(maxsize=None)
+def _image_paths():
+    if not os.path.isdir(IMAGES_DIR):
+        return ()
+    images = set()
+    for pattern in ["*.jpg", "*.jpeg", "*.png", "*.webp", "*.gif"]:
+        images.update(glob.glob(os.path.join(IMAGES_DIR, "**", pattern), recursive=True))
+    return tuple(sorted(images))
 
 
 def get_random_image_path():
     """Return a random image file path from the images directory, or None."""
-    if not os.path.isdir(IMAGES_DIR):
-        return None
-    patterns = ["*.jpg", "*.jpeg", "*.png", "*.webp", "*.gif"]
-    images = []
-    for pattern in patterns:
-        images.extend(glob.glob(os.path.join(IMAGES_DIR, pattern)))
-        images.extend(glob.glob(os.path.join(IMAGES_DIR, "**", pattern), recursive=True))
+    images = _image_paths()
     return random.choice(images) if images else None
 
 
@@ -216,6 +246,127 @@ MEDICINES = [
      "description": "Topical gel for acne treatment.", "barcode": "6001010000002"},
 ]
 
+# ── Scale mode ─────────────────────────────────────────────────────────────────
+
+SCALE_MEDICINES = 2000
+SCALE_CASHIERS = 10
+SCALE_SALES_PER_DAY = 300
+# Busier weekends, quieter Mondays (index 0 = Monday)
+WEEKDAY_FACTORS = [0.8, 0.9, 0.95, 1.0, 1.15, 1.3, 1.1]
+OPENING_SECONDS, CLOSING_SECONDS = 8 * 3600, 21 * 3600
+STRENGTHS = ["5mg", "10mg", "20mg", "50mg", "100mg", "250mg", "500mg", "1g"]
+MANUFACTURERS = ["Dawa Limited", "Cosmos Limited", "Elys Chemical Industries", "Universal Pharma", "Regal Pharma"]
+SCALE_BARCODE_PREFIX = "69"
+# Values per IN (...) lookup; SQLite before 3.32 allows 999 bound variables
+LOOKUP_CHUNK_SIZE = 900
+
+# Set once per worker process by _init_day_worker()
+_catalogue = None
+
+
+@contextmanager
+def _keep_created_at():
+    """bulk_create would stamp Sale.created_at with now(); keep the generated dates"""
+    field = Sale._meta.get_field("created_at")
+    field.auto_now_add = False
+    try:
+        yield
+    finally:
+        field.auto_now_add = True
+
+
+def _chunks(values, size=LOOKUP_CHUNK_SIZE):
+    for start in range(0, len(values), size):
+        yield values[start:start + size]
+
+
+def _init_day_worker(catalogue):
+    global _catalogue
+    from django.apps import apps
+    if not apps.ready:  # spawned (not forked) worker
+        import django
+        django.setup()
+    _catalogue = catalogue
+
+
+def _seed_day(task):
+    """Generate and insert one day of sales and their ledger rows; returns (sales, items, mpesa) counts"""
+    day, day_index, first_seq, count = task
+    medicines, cum_weights, cashier_ids, seed, batch_size = _catalogue
+    rng = random.Random(f"{seed}:{day_index}")
+    opening = timezone.make_aware(datetime.combine(day, time.min))
+
+    sales, baskets = [], []
+    for n in range(count):
+        created_at = opening + timedelta(seconds=rng.randrange(OPENING_SECONDS, CLOSING_SECONDS))
+        basket = {}
+        for med in rng.choices(medicines, cum_weights=cum_weights, k=rng.choice((1, 1, 2, 2, 3, 4, 5))):
+            basket[med[0]] = (med, rng.randint(1, 4))
+        subtotal = sum(med[2] * qty for med, qty in basket.values())
+        discount = subtotal * rng.choice((0, 0, 0, 0, 5)) // 100
+        total = subtotal - discount
+        status = rng.choices(("completed", "refunded", "cancelled"), (94, 3, 3))[0]
+        payment_method = rng.choices(("cash", "mpesa", "card"), (45, 45, 10))[0]
+        paid = total if status == "completed" else 0
+        sales.append(Sale(
+            receipt_number=f"RX-{day:%y%m%d}-{first_seq + n:010d}",
+            cashier_id=rng.choice(cashier_ids),
+            customer_name="Walk-in Customer",
+            payment_method=payment_method,
+            subtotal=_money(subtotal),
+            discount=_money(discount),
+            total_amount=_money(total),
+            amount_paid=_money(paid),
+            status=status,
+            created_at=created_at,
+        ))
+        baskets.append(basket)
+
+    with _keep_created_at(), transaction.atomic():
+        Sale.objects.bulk_create(sales, batch_size=batch_size)
+        if any(sale.pk is None for sale in sales):
+            # Backends that cannot return ids from a bulk insert
+            ids = dict(Sale.objects.filter(
+                receipt_number__in=[sale.receipt_number for sale in sales],
+            ).values_list("receipt_number", "id"))
+            for sale in sales:
+                sale.pk = ids[sale.receipt_number]
+
+        items, mpesa, movements = [], [], []
+        for sale, basket in zip(sales, baskets):
+            for (med_id, name, price), qty in basket.values():
+                items.append(SaleItem(
+                    sale_id=sale.pk, medicine_id=med_id, medicine_name=name, quantity=qty,
+                    unit_price=_money(price), total_price=_money(price * qty),
+                ))
+                # Cancelled sales never left the shelf; refunded ones went back
+                if sale.status != "cancelled":
+                    movements.append(StockMovement(medicine_id=med_id, kind="sale", quantity=-qty,
+                                                   sale_id=sale.pk, created_at=sale.created_at))
+                if sale.status == "refunded":
+                    movements.append(StockMovement(medicine_id=med_id, kind="refund", quantity=qty,
+                                                   sale_id=sale.pk, created_at=sale.created_at))
+            if sale.payment_method == "mpesa" and sale.status == "completed":
+                mpesa.append(MpesaTransaction(
+                    sale_id=sale.pk,
+                    checkout_request_id=f"ws_CO_SEED{sale.receipt_number[10:]}",
+                    phone_number="254700000000",
+                    amount=sale.total_amount,
+                    mpesa_receipt_number=f"SEED{sale.receipt_number[10:]}",
+                    status="success",
+                    result_code="0",
+                    result_description="The service request is processed successfully.",
+                    transaction_date=sale.created_at,
+                ))
+        SaleItem.objects.bulk_create(items, batch_size=batch_size)
+        MpesaTransaction.objects.bulk_create(mpesa, batch_size=batch_size)
+        StockMovement.objects.bulk_create(movements, batch_size=batch_size)
+    return len(sales), len(items), len(mpesa)
+
+
+def _money(cents):
+    return Decimal(cents).scaleb(-2)
+
 
 class Command(BaseCommand):
     help = "Seed the database with sample pharmacy data (categories, medicines, sales, M-Pesa transactions)."
@@ -226,6 +377,12 @@ class Command(BaseCommand):
             action="store_true",
             help="Delete all existing data before seeding.",
         )
+        parser.add_argument("--scale", type=float, default=0,
+                            help="Generate a load-testing dataset of this size (1 = ~110k sales/year).")
+        parser.add_argument("--days", type=int, default=365, help="Days of sales history in --scale mode.")
+        parser.add_argument("--seed", type=int, default=42, help="Random seed for --scale mode.")
+        parser.add_argument("--workers", type=int, default=1, help="Processes used to insert sales.")
+        parser.add_argument("--batch-size", type=int, default=5000)
 
     def handle(self, *args, **options):
         if options["flush"]:
@@ -240,7 +397,12 @@ class Command(BaseCommand):
         self._seed_categories()
         self._seed_medicines()
         self._seed_users()
-        self._seed_sales()
+        if options["scale"]:
+            self._seed_scale(options)
+        else:
+            self._seed_sales()
+        # Sales are backdated with queryset updates or bulk inserts, which bypass the rollup signals
+        call_command("rebuild_sales_summary", stdout=self.stdout)
         self.stdout.write(self.style.SUCCESS("\n✅  Database seeded successfully!"))
 
     # ── Categories ─────────────────────────────────────────────────────────────
@@ -286,6 +448,7 @@ class Command(BaseCommand):
 
             if was_created:
                 created += 1
+                inventory.open_stock(medicine)
 
         self.stdout.write(self.style.SUCCESS(f"  ✓ {created} new medicines created ({len(MEDICINES)} total defined)."))
 
@@ -407,4 +570,133 @@ class Command(BaseCommand):
 
         self.stdout.write(self.style.SUCCESS(
             f"  ✓ {sales_created} sales created, {mpesa_created} M-Pesa transactions created."
-        ))
\ No newline at end of file
+        ))
+    # ── Scale mode ─────────────────────────────────────────────────────────────
+
+    def _seed_scale(self, options):
+        scale, seed, batch_size = options["scale"], options["seed"], options["batch_size"]
+        rng = random.Random(seed)
+        medicines = self._seed_scale_medicines(round(SCALE_MEDICINES * scale), rng, batch_size)
+        cashier_ids = self._seed_scale_cashiers(max(1, round(SCALE_CASHIERS * scale)))
+
+        # Popularity follows a Zipf-like curve over the catalogue
+        medicines = [(pk, name, int(price * 100)) for pk, name, price in medicines]
+        weights, total = [], 0.0
+        for rank in range(1, len(medicines) + 1):
+            total += 1 / rank
+            weights.append(total)
+
+        today = timezone.localdate()
+        first_seq = (Sale.objects.aggregate(top=Max("id"))["top"] or 0) + 1
+        tasks = []
+        for day_index in range(options["days"]):
+            day = today - timedelta(days=options["days"] - day_index)
+            count = round(SCALE_SALES_PER_DAY * scale * WEEKDAY_FACTORS[day.weekday()] * rng.uniform(0.8, 1.2))
+            tasks.append((day, day_index, first_seq, count))
+            first_seq += count
+
+        workers = options["workers"]
+        if workers > 1 and connection.vendor == "sqlite":
+            self.stdout.write(self.style.WARNING("  SQLite allows a single writer; using one worker."))
+            workers = 1
+
+        self.stdout.write(f"Seeding {sum(t[3] for t in tasks):,} sales over {len(tasks)} days "
+                          f"with {workers} worker(s)...")
+        catalogue = (medicines, weights, cashier_ids, seed, batch_size)
+        ledger_mark = StockMovement.objects.aggregate(top=Max("id"))["top"] or 0
+        started = timezone.now()
+        if workers > 1:
+            connections.close_all()  # never share a connection with forked workers
+            with multiprocessing.Pool(workers, initializer=_init_day_worker, initargs=(catalogue,)) as pool:
+                results = self._progress(pool.imap_unordered(_seed_day, tasks), len(tasks))
+        else:
+            _init_day_worker(catalogue)
+            results = self._progress(map(_seed_day, tasks), len(tasks))
+
+        sales, items, mpesa = (sum(column) for column in zip(*results)) if results else (0, 0, 0)
+        elapsed = (timezone.now() - started).total_seconds()
+        self.stdout.write(self.style.SUCCESS(
+            f"  ✓ {sales:,} sales, {items:,} sale items and {mpesa:,} M-Pesa transactions "
+            f"in {elapsed:.0f}s ({sales / max(elapsed, 0.001):,.0f} sales/s)."
+        ))
+        if tasks:
+            opening_at = timezone.make_aware(datetime.combine(tasks[0][0], time.min))
+            self._seed_scale_openings(ledger_mark, opening_at, batch_size)
+
+    def _seed_scale_openings(self, mark, opening_at, batch_size):
+        """
+        Opening balances for the stock the seeded sales took. The generated
+        stock_quantity is what is left today; these rows, dated before the
+        first sale, put back what was sold so the ledger adds up to it.
+        """
+        sold = StockMovement.objects.filter(id__gt=mark, kind__in=("sale", "refund")).values(
+            "medicine"
+        ).annotate(net=Sum("quantity")).values_list("medicine", "net").order_by()
+        StockMovement.objects.bulk_create((
+            StockMovement(medicine_id=med_id, kind="opening", quantity=-net, created_at=opening_at,
+                          note="Stock sold by seeded sales")
+            for med_id, net in sold.iterator() if net
+        ), batch_size=batch_size)
+
+    def _progress(self, results, total):
+        done = []
+        for result in results:
+            done.append(result)
+            if len(done) % 30 == 0 or len(done) == total:
+                self.stdout.write(f"  {len(done)}/{total} days")
+        return done
+
+    def _seed_scale_medicines(self, count, rng, batch_size):
+        """
+        Synthetic catalogue with stable barcodes, so re-running adds only what
+        is missing. Returns (id, name, price) for all of it, in barcode order.
+        """
+        self.stdout.write(f"Seeding {count:,} catalogue medicines...")
+        categories = list(Category.objects.order_by("id").values_list("id", flat=True))
+        barcodes = [f"{SCALE_BARCODE_PREFIX}{i:011d}" for i in range(count)]
+        existing = set()
+        for chunk in _chunks(barcodes):
+            existing.update(Medicine.objects.filter(barcode__in=chunk).values_list("barcode", flat=True))
+        today = date.today()
+        new = []
+        for i, barcode in enumerate(barcodes):
+            # Draw for every row so the catalogue does not depend on what already exists
+            base = rng.choice(MEDICINES)
+            price = rng.randint(10, 600)
+            medicine = Medicine(
+                name=f"{base['generic_name']} {rng.choice(STRENGTHS)} ({i + 1})",
+                generic_name=base["generic_name"],
+                category_id=rng.choice(categories) if categories else None,
+                manufacturer=rng.choice(MANUFACTURERS),
+                barcode=barcode,
+                unit=base["unit"],
+                price=Decimal(price),
+                cost_price=Decimal(price * rng.randint(45, 75) // 100),
+                stock_quantity=rng.randint(0, 2000),
+                reorder_level=rng.choice((10, 20, 30, 50)),
+                expiry_date=today + timedelta(days=rng.randint(-60, 1000)),
+                requires_prescription=base["requires_prescription"],
+            )
+            if barcode not in existing:
+                new.append(medicine)
+        with transaction.atomic():
+            Medicine.objects.bulk_create(new, batch_size=batch_size)
+            # Opening lots and ledger rows, as the medicine form would book them
+            inventory.open_stock_many(new, batch_size=batch_size)
+        self.stdout.write(self.style.SUCCESS(f"  ✓ {len(new):,} new medicines created ({count:,} in scale catalogue)."))
+        return [
+            row
+            for chunk in _chunks(barcodes)
+            for row in Medicine.objects.filter(barcode__in=chunk).order_by("barcode").values_list("id", "name", "price")
+        ]
+
+    def _seed_scale_cashiers(self, count):
+        usernames = [f"loadcashier{i:04d}" for i in range(count)]
+        existing = set(User.objects.filter(username__in=usernames).values_list("username", flat=True))
+        password = make_password("cashier1234")  # hash once, not per user
+        User.objects.bulk_create([
+            User(username=name, password=password, first_name="Load", last_name=f"Cashier {i}")
+            for i, name in enumerate(usernames) if name not in existing
+        ])
+        self.stdout.write(self.style.SUCCESS(f"  ✓ {count} load-test cashiers ready."))
+        return list(User.objects.filter(username__in=usernames).order_by("username").values_list("id", flat=True))
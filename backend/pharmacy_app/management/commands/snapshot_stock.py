@@ -0,0 +1,30 @@
+"""
+Fold the stock movement ledger into per-medicine snapshots.
+
+Only medicines with movements since their last snapshot get a new one, so
+this is cheap to run often (e.g. hourly from cron):
+
+    python manage.py snapshot_stock
+    python manage.py snapshot_stock --interval 3600      # keep running
+"""
+
+import time
+
+from django.core.management.base import BaseCommand
+
+from pharmacy_app.inventory import snapshot
+
+
+class Command(BaseCommand):
+    help = "Write stock snapshots so point-in-time stock needs only a short ledger tail."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--interval", type=float, help="Repeat every N seconds instead of running once.")
+
+    def handle(self, *args, **options):
+        while True:
+            count = snapshot()
+            self.stdout.write(self.style.SUCCESS(f"✓ {count} stock snapshots written."))
+            if not options["interval"]:
+                break
+            time.sleep(options["interval"])
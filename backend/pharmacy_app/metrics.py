@@ -0,0 +1,281 @@
+"""
+Per-endpoint request metrics, exposed in Prometheus text format at /api/metrics/.
+
+``MetricsMiddleware`` counts every request. For a sampled fraction
+(METRICS_SAMPLE_RATE) it also records latency, SQL query count, SQL time and
+response size into fixed-bucket histograms, so memory stays bounded no matter
+how much traffic there is. Unsampled requests only pay for a counter
+increment.
+
+SQL is counted by a hook installed on every database connection, which reports
+to the recorder bound to the current request's context. asgiref copies that
+context into ``sync_to_async`` threads, so views served under ASGI are counted
+the same way as under WSGI.
+
+Requests are labelled ``<basename>.<action>`` by ``InstrumentedViewMixin`` on
+DRF viewsets (e.g. ``medicine.pos_search``, ``sale.create``) and by URL route
+for everything else.
+"""
+
+import random
+import threading
+import time
+from bisect import bisect_left
+from contextvars import ContextVar
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.conf import settings
+from django.http import HttpResponse, JsonResponse
+from rest_framework.exceptions import AuthenticationFailed
+from rest_framework_simplejwt.authentication import JWTAuthentication
+
+# Distinct label sets kept; anything beyond is folded into endpoint="other"
+MAX_SERIES = 300
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+QUERY_BUCKETS = (0, 1, 2, 3, 5, 8, 13, 21, 34, 55, 89)
+SQL_TIME_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5)
+SIZE_BUCKETS = (256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304)
+
+HISTOGRAMS = {
+    'duration': ('pharmacy_request_duration_seconds', 'Request latency', LATENCY_BUCKETS),
+    'queries': ('pharmacy_request_sql_queries', 'SQL queries per request', QUERY_BUCKETS),
+    'sql_time': ('pharmacy_request_sql_seconds', 'Time spent in SQL per request', SQL_TIME_BUCKETS),
+    'size': ('pharmacy_response_size_bytes', 'Response body size', SIZE_BUCKETS),
+}
+
+
+class Histogram:
+    """Cumulative-bucket histogram; not thread-safe on its own (Registry locks)"""
+
+    __slots__ = ('bounds', 'counts', 'sum', 'count')
+
+    def __init__(self, bounds):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)   # last slot is +Inf
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.bounds, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+class Registry:
+    def __init__(self, max_series=MAX_SERIES):
+        self.max_series = max_series
+        self.lock = threading.Lock()
+        self.requests = {}     # (endpoint, method, status) -> count
+        self.samples = {}      # (endpoint, method) -> {metric: Histogram}
+
+    def _key(self, table, key):
+        if key not in table and len(table) >= self.max_series:
+            return ('other',) + key[1:]
+        return key
+
+    def count(self, endpoint, method, status):
+        with self.lock:
+            key = self._key(self.requests, (endpoint, method, str(status)))
+            self.requests[key] = self.requests.get(key, 0) + 1
+
+    def observe(self, endpoint, method, **values):
+        with self.lock:
+            key = self._key(self.samples, (endpoint, method))
+            series = self.samples.get(key)
+            if series is None:
+                series = self.samples[key] = {
+                    name: Histogram(buckets) for name, (_, _, buckets) in HISTOGRAMS.items()
+                }
+            for name, value in values.items():
+                if value is not None:
+                    series[name].observe(value)
+
+    def clear(self):
+        with self.lock:
+            self.requests.clear()
+            self.samples.clear()
+
+    def render(self, sample_rate):
+        with self.lock:
+            requests = sorted(self.requests.items())
+            samples = {
+                key: {name: (list(h.counts), h.sum, h.count) for name, h in series.items()}
+                for key, series in sorted(self.samples.items())
+            }
+
+        lines = [
+            '# HELP pharmacy_requests_total Requests handled, by endpoint and status',
+            '# TYPE pharmacy_requests_total counter',
+        ]
+        for (endpoint, method, status), value in requests:
+            lines.append(f'pharmacy_requests_total{{{_labels(endpoint, method)},status="{status}"}} {value}')
+
+        lines += [
+            '# HELP pharmacy_metrics_sample_rate Fraction of requests recorded in the histograms',
+            '# TYPE pharmacy_metrics_sample_rate gauge',
+            f'pharmacy_metrics_sample_rate {sample_rate}',
+        ]
+        for name, (metric, help_text, bounds) in HISTOGRAMS.items():
+            lines += [f'# HELP {metric} {help_text} (sampled)', f'# TYPE {metric} histogram']
+            for (endpoint, method), series in samples.items():
+                counts, total, count = series[name]
+                labels = _labels(endpoint, method)
+                cumulative = 0
+                for bound, bucket in zip(list(bounds) + ['+Inf'], counts):
+                    cumulative += bucket
+                    lines.append(f'{metric}_bucket{{{labels},le="{bound}"}} {cumulative}')
+                lines.append(f'{metric}_sum{{{labels}}} {total}')
+                lines.append(f'{metric}_count{{{labels}}} {count}')
+        return '\n'.join(lines) + '\n'
+
+
+def _labels(endpoint, method):
+    endpoint = endpoint.replace('\\', '\\\\').replace('"', '\\"')
+    return f'endpoint="{endpoint}",method="{method}"'
+
+
+registry = Registry()
+
+
+# ─── Collection ────────────────────────────────────────────────────────────────
+
+# Recorder for the sampled request in progress; None outside one
+_recorder = ContextVar('metrics_query_recorder', default=None)
+
+
+class QueryRecorder:
+    """connection.execute_wrapper counting queries and their total time"""
+
+    def __init__(self):
+        self.queries = 0
+        self.seconds = 0.0
+
+    def __call__(self, execute, sql, params, many, context):
+        start = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.queries += 1
+            self.seconds += time.perf_counter() - start
+
+
+def record_query(execute, sql, params, many, context):
+    recorder = _recorder.get()
+    if recorder is None:
+        return execute(sql, params, many, context)
+    return recorder(execute, sql, params, many, context)
+
+
+def install_query_hook(sender, connection, **kwargs):
+    """connection_created receiver: every connection, in any thread, reports to the request's recorder"""
+    if record_query not in connection.execute_wrappers:
+        connection.execute_wrappers.append(record_query)
+
+
+def endpoint_name(request):
+    name = getattr(request, 'metrics_endpoint', None)
+    if name:
+        return name
+    match = getattr(request, 'resolver_match', None)
+    if match is None:
+        return 'unmatched'
+    return match.url_name or match.route or 'unmatched'
+
+
+def response_size(response):
+    if getattr(response, 'streaming', False):
+        return None
+    return len(response.content)
+
+
+class MetricsMiddleware:
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.sample_rate = getattr(settings, 'METRICS_SAMPLE_RATE', 0.1)
+        if iscoroutinefunction(get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        if random.random() >= self.sample_rate:
+            response = self.get_response(request)
+            registry.count(endpoint_name(request), request.method, response.status_code)
+            return response
+
+        recorder = QueryRecorder()
+        token = _recorder.set(recorder)
+        start = time.perf_counter()
+        try:
+            response = self.get_response(request)
+        finally:
+            _recorder.reset(token)
+        self._record(request, response, time.perf_counter() - start, recorder)
+        return response
+
+    async def __acall__(self, request):
+        if random.random() >= self.sample_rate:
+            response = await self.get_response(request)
+            registry.count(endpoint_name(request), request.method, response.status_code)
+            return response
+
+        # The view's sync_to_async thread runs in a copy of this context and
+        # sees the same recorder
+        recorder = QueryRecorder()
+        token = _recorder.set(recorder)
+        start = time.perf_counter()
+        try:
+            response = await self.get_response(request)
+        finally:
+            _recorder.reset(token)
+        self._record(request, response, time.perf_counter() - start, recorder)
+        return response
+
+    def _record(self, request, response, elapsed, recorder):
+        endpoint = endpoint_name(request)
+        registry.count(endpoint, request.method, response.status_code)
+        registry.observe(
+            endpoint, request.method,
+            duration=elapsed,
+            queries=recorder.queries,
+            sql_time=recorder.seconds,
+            size=response_size(response),
+        )
+
+
+class InstrumentedViewMixin:
+    """Labels a viewset's requests ``<basename>.<action>`` for MetricsMiddleware"""
+
+    def initial(self, request, *args, **kwargs):
+        request._request.metrics_endpoint = f"{self.basename}.{self.action or request.method.lower()}"
+        super().initial(request, *args, **kwargs)
+
+
+# ─── Exposition ────────────────────────────────────────────────────────────────
+
+def _authorized(request):
+    token = getattr(settings, 'METRICS_TOKEN', '')
+    if token and request.headers.get('Authorization', '') == f'Bearer {token}':
+        return True
+    try:
+        result = JWTAuthentication().authenticate(request)
+    except AuthenticationFailed:
+        return False
+    return result is not None and result[0].is_staff
+
+
+def metrics_view(request):
+    """
+    Prometheus scrape endpoint. With METRICS_TOKEN set, scrapers send
+    ``Authorization: Bearer <token>``; otherwise a staff user's JWT is required.
+    """
+    if request.method != 'GET':
+        return JsonResponse({'detail': 'Method not allowed'}, status=405)
+    if not _authorized(request):
+        return JsonResponse({'detail': 'Authentication credentials were not provided.'}, status=401)
+    body = registry.render(getattr(settings, 'METRICS_SAMPLE_RATE', 0.1))
+    return HttpResponse(body, content_type='text/plain; version=0.0.4; charset=utf-8')
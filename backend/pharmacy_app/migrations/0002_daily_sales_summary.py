@@ -0,0 +1,49 @@
+# Generated by Django 5.2.18 on 2026-10-17 06:57
+
+from django.db import migrations, models
+from django.db.models import Count, Sum
+from django.db.models.functions import TruncDate
+
+
+def backfill_summary(apps, schema_editor):
+    Sale = apps.get_model('pharmacy_app', 'Sale')
+    DailySalesSummary = apps.get_model('pharmacy_app', 'DailySalesSummary')
+    rows = Sale.objects.annotate(day=TruncDate('created_at')).values(
+        'day', 'payment_method', 'status'
+    ).annotate(count=Count('id'), total=Sum('total_amount')).order_by()
+    DailySalesSummary.objects.bulk_create([
+        DailySalesSummary(
+            date=row['day'],
+            payment_method=row['payment_method'],
+            status=row['status'],
+            sale_count=row['count'],
+            total_amount=row['total'] or 0,
+        )
+        for row in rows
+    ], batch_size=1000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('pharmacy_app', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DailySalesSummary',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('date', models.DateField()),
+                ('payment_method', models.CharField(choices=[('cash', 'Cash'), ('mpesa', 'M-Pesa'), ('card', 'Card')], max_length=10)),
+                ('status', models.CharField(choices=[('pending', 'Pending'), ('completed', 'Completed'), ('cancelled', 'Cancelled'), ('refunded', 'Refunded')], max_length=15)),
+                ('sale_count', models.IntegerField(default=0)),
+                ('total_amount', models.DecimalField(decimal_places=2, default=0, max_digits=14)),
+            ],
+            options={
+                'verbose_name_plural': 'Daily sales summaries',
+                'constraints': [models.UniqueConstraint(fields=('date', 'payment_method', 'status'), name='unique_daily_sales_bucket')],
+            },
+        ),
+        migrations.RunPython(backfill_summary, migrations.RunPython.noop),
+    ]
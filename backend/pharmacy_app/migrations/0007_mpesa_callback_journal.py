@@ -0,0 +1,29 @@
+# Generated by Django 5.2.18 on 2026-10-17 07:07
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('pharmacy_app', '0006_mpesa_reconciliation'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='MpesaCallback',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('dedupe_key', models.CharField(max_length=64, unique=True)),
+                ('checkout_request_id', models.CharField(db_index=True, max_length=100)),
+                ('result_code', models.CharField(blank=True, max_length=10)),
+                ('payload', models.JSONField()),
+                ('received_at', models.DateTimeField(auto_now_add=True)),
+                ('applied_at', models.DateTimeField(blank=True, null=True)),
+                ('outcome', models.CharField(blank=True, choices=[('applied', 'Applied'), ('ignored', 'Ignored'), ('unmatched', 'Unmatched')], max_length=10)),
+            ],
+            options={
+                'indexes': [models.Index(fields=['applied_at', 'id'], name='mpesa_callback_pending_idx')],
+            },
+        ),
+    ]
@@ -0,0 +1,22 @@
+# Generated by Django 5.2.18 on 2026-10-17 07:14
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('pharmacy_app', '0007_mpesa_callback_journal'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='sale',
+            name='client_ref',
+            field=models.CharField(blank=True, max_length=64, null=True, unique=True),
+        ),
+        migrations.AddIndex(
+            model_name='medicine',
+            index=models.Index(fields=['updated_at'], name='medicine_updated_idx'),
+        ),
+    ]
@@ -0,0 +1,44 @@
+# Generated by Django 5.2.18 on 2026-10-17 07:18
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+def open_batches(apps, schema_editor):
+    """Existing stock becomes one opening batch per medicine, keeping its expiry and cost"""
+    Medicine = apps.get_model('pharmacy_app', 'Medicine')
+    StockBatch = apps.get_model('pharmacy_app', 'StockBatch')
+    rows = Medicine.objects.filter(stock_quantity__gt=0).values_list(
+        'id', 'stock_quantity', 'expiry_date', 'cost_price'
+    ).iterator(chunk_size=2000)
+    StockBatch.objects.bulk_create((
+        StockBatch(medicine_id=pk, lot_number='OPENING', quantity=qty, expiry_date=expiry, cost_price=cost)
+        for pk, qty, expiry, cost in rows
+    ), batch_size=1000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('pharmacy_app', '0009_category_updated_at'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='StockBatch',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('lot_number', models.CharField(blank=True, max_length=50)),
+                ('expiry_date', models.DateField(blank=True, null=True)),
+                ('quantity', models.PositiveIntegerField(default=0)),
+                ('cost_price', models.DecimalField(decimal_places=2, default=0, max_digits=10)),
+                ('received_at', models.DateTimeField(auto_now_add=True)),
+                ('medicine', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='batches', to='pharmacy_app.medicine')),
+            ],
+            options={
+                'verbose_name_plural': 'Stock batches',
+                'indexes': [models.Index(condition=models.Q(('quantity__gt', 0)), fields=['medicine', 'expiry_date', 'id'], name='stockbatch_fefo_idx')],
+            },
+        ),
+        migrations.RunPython(open_batches, migrations.RunPython.noop),
+    ]
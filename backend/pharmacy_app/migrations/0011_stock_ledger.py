@@ -0,0 +1,59 @@
+# Generated by Django 5.2.18 on 2026-10-17 07:20
+
+import django.db.models.deletion
+import django.utils.timezone
+from django.conf import settings
+from django.db import migrations, models
+
+
+def opening_snapshots(apps, schema_editor):
+    """Current stock is the baseline the ledger builds on (movement_id 0)"""
+    Medicine = apps.get_model('pharmacy_app', 'Medicine')
+    StockSnapshot = apps.get_model('pharmacy_app', 'StockSnapshot')
+    rows = Medicine.objects.values_list('id', 'stock_quantity').iterator(chunk_size=2000)
+    StockSnapshot.objects.bulk_create((
+        StockSnapshot(medicine_id=pk, movement_id=0, quantity=qty) for pk, qty in rows
+    ), batch_size=1000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('pharmacy_app', '0010_stock_batches'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='StockMovement',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('kind', models.CharField(choices=[('opening', 'Opening balance'), ('receipt', 'Receipt'), ('sale', 'Sale'), ('refund', 'Refund'), ('adjustment', 'Adjustment')], max_length=10)),
+                ('quantity', models.IntegerField()),
+                ('note', models.CharField(blank=True, max_length=200)),
+                ('created_at', models.DateTimeField(default=django.utils.timezone.now)),
+                ('batch', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='movements', to='pharmacy_app.stockbatch')),
+                ('medicine', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='movements', to='pharmacy_app.medicine')),
+                ('sale', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='stock_movements', to='pharmacy_app.sale')),
+                ('user', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'indexes': [models.Index(fields=['medicine', 'id'], name='stockmovement_medicine_idx'), models.Index(fields=['created_at'], name='stockmovement_created_idx')],
+            },
+        ),
+        migrations.CreateModel(
+            name='StockSnapshot',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('movement_id', models.BigIntegerField()),
+                ('quantity', models.IntegerField()),
+                ('taken_at', models.DateTimeField(default=django.utils.timezone.now)),
+                ('medicine', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='snapshots', to='pharmacy_app.medicine')),
+            ],
+            options={
+                'indexes': [models.Index(fields=['medicine', 'taken_at'], name='stocksnapshot_taken_idx')],
+                'constraints': [models.UniqueConstraint(fields=('medicine', 'movement_id'), name='unique_stock_snapshot')],
+            },
+        ),
+        migrations.RunPython(opening_snapshots, migrations.RunPython.noop),
+    ]
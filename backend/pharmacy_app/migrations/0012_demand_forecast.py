@@ -0,0 +1,37 @@
+# Generated by Django 5.2.18 on 2026-10-17 07:24
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('pharmacy_app', '0011_stock_ledger'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='medicine',
+            name='order_quantity',
+            field=models.PositiveIntegerField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='medicine',
+            name='reorder_point',
+            field=models.PositiveIntegerField(blank=True, null=True),
+        ),
+        migrations.CreateModel(
+            name='DemandForecast',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('daily_demand', models.FloatField()),
+                ('demand_std', models.FloatField()),
+                ('window_days', models.PositiveIntegerField()),
+                ('lead_time_days', models.PositiveIntegerField()),
+                ('sales_through', models.BigIntegerField(default=0)),
+                ('computed_at', models.DateTimeField()),
+                ('medicine', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, related_name='forecast', to='pharmacy_app.medicine')),
+            ],
+        ),
+    ]
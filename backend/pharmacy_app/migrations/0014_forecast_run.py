@@ -0,0 +1,32 @@
+# Generated by Django 5.2.18 on 2026-10-17 08:03
+
+from django.db import migrations, models
+from django.db.models import Max
+
+
+def seed_mark(apps, schema_editor):
+    """Carry the mark over from existing forecasts, so the next run stays incremental"""
+    DemandForecast = apps.get_model('pharmacy_app', 'DemandForecast')
+    ForecastRun = apps.get_model('pharmacy_app', 'ForecastRun')
+    last = DemandForecast.objects.aggregate(mark=Max('sales_through'), at=Max('computed_at'))
+    if last['at'] is not None:
+        ForecastRun.objects.create(pk=1, sales_through=last['mark'] or 0, started_at=last['at'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('pharmacy_app', '0013_sale_updated_at'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ForecastRun',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('sales_through', models.BigIntegerField(default=0)),
+                ('started_at', models.DateTimeField()),
+            ],
+        ),
+        migrations.RunPython(seed_mark, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,17 @@
+# Generated by Django 5.2.18 on 2026-10-17 08:04
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('pharmacy_app', '0014_forecast_run'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='stocksnapshot',
+            index=models.Index(fields=['movement_id'], name='stocksnapshot_movement_idx'),
+        ),
+    ]
@@ -1,13 +1,16 @@
 from django.db import models
+from django.db.models.functions import Coalesce
 from django.contrib.auth.models import User
 from django.utils import timezone
-import uuid
+
+from .receipts import receipt_numbers
 
 
 class Category(models.Model):
     name = models.CharField(max_length=100)
     description = models.TextField(blank=True)
     created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
 
     class Meta:
         verbose_name_plural = "Categories"
@@ -16,6 +19,36 @@ class Category(models.Model):
         return self.name
 
 
+class MedicineQuerySet(models.QuerySet):
+    """Database-side equivalents of Medicine.is_low_stock / is_expired"""
+
+    def active(self):
+        return self.filter(is_active=True)
+
+    def low_stock(self):
+        return self.filter(self._low_stock_q())
+
+    def expired(self, today=None):
+        return self.filter(self._expired_q(today))
+
+    def stock_counts(self, today=None):
+        """Total, low-stock and expired counts in one aggregate query"""
+        return self.aggregate(
+            total=models.Count('id'),
+            low_stock=models.Count('id', filter=self._low_stock_q()),
+            expired=models.Count('id', filter=self._expired_q(today)),
+        )
+
+    @staticmethod
+    def _low_stock_q():
+        threshold = Coalesce(models.F('reorder_point'), models.F('reorder_level'))
+        return models.Q(stock_quantity__lte=threshold)
+
+    @staticmethod
+    def _expired_q(today=None):
+        return models.Q(expiry_date__lt=today or timezone.localdate())
+
+
 class Medicine(models.Model):
     UNIT_CHOICES = [
         ('tablet', 'Tablet'),
@@ -40,18 +73,33 @@ class Medicine(models.Model):
     cost_price = models.DecimalField(max_digits=10, decimal_places=2, default=0)
     stock_quantity = models.PositiveIntegerField(default=0)
     reorder_level = models.PositiveIntegerField(default=10)
+    # Demand-based values from forecasting.py; reorder_level is the manual fallback
+    reorder_point = models.PositiveIntegerField(null=True, blank=True)
+    order_quantity = models.PositiveIntegerField(null=True, blank=True)
     expiry_date = models.DateField(null=True, blank=True)
     requires_prescription = models.BooleanField(default=False)
     is_active = models.BooleanField(default=True)
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
 
+    objects = MedicineQuerySet.as_manager()
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['is_active', 'name'], name='medicine_active_name_idx'),
+            models.Index(fields=['is_active', 'stock_quantity'], name='medicine_active_stock_idx'),
+            models.Index(fields=['is_active', 'category'], name='medicine_active_category_idx'),
+            models.Index(fields=['is_active', 'expiry_date'], name='medicine_active_expiry_idx'),
+            models.Index(fields=['updated_at'], name='medicine_updated_idx'),
+        ]
+
     def __str__(self):
         return self.name
 
     @property
     def is_low_stock(self):
-        return self.stock_quantity <= self.reorder_level
+        threshold = self.reorder_point if self.reorder_point is not None else self.reorder_level
+        return self.stock_quantity <= threshold
 
     @property
     def is_expired(self):
@@ -60,6 +108,109 @@ class Medicine(models.Model):
         return False
 
 
+class StockBatch(models.Model):
+    """One delivered lot of a medicine; checkout drains lots first-expiry-first-out (see inventory.py)"""
+    medicine = models.ForeignKey(Medicine, on_delete=models.CASCADE, related_name='batches')
+    lot_number = models.CharField(max_length=50, blank=True)
+    expiry_date = models.DateField(null=True, blank=True)
+    quantity = models.PositiveIntegerField(default=0)      # remaining in this lot
+    cost_price = models.DecimalField(max_digits=10, decimal_places=2, default=0)
+    received_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        verbose_name_plural = "Stock batches"
+        indexes = [
+            models.Index(
+                fields=['medicine', 'expiry_date', 'id'], name='stockbatch_fefo_idx',
+                condition=models.Q(quantity__gt=0),
+            ),
+        ]
+
+    def __str__(self):
+        return f"{self.medicine_id} lot {self.lot_number or '-'} ({self.quantity})"
+
+
+class StockMovement(models.Model):
+    """
+    Append-only stock ledger: one signed row per change to a medicine's stock
+    (and batch, when known). Rows are only ever inserted, in bulk (see inventory.py).
+    """
+    KIND_CHOICES = [
+        ('opening', 'Opening balance'),
+        ('receipt', 'Receipt'),
+        ('sale', 'Sale'),
+        ('refund', 'Refund'),
+        ('adjustment', 'Adjustment'),
+    ]
+
+    medicine = models.ForeignKey(Medicine, on_delete=models.CASCADE, related_name='movements')
+    batch = models.ForeignKey(StockBatch, on_delete=models.SET_NULL, null=True, blank=True, related_name='movements')
+    kind = models.CharField(max_length=10, choices=KIND_CHOICES)
+    quantity = models.IntegerField()                       # signed: + into stock, - out
+    sale = models.ForeignKey('Sale', on_delete=models.SET_NULL, null=True, blank=True, related_name='stock_movements')
+    user = models.ForeignKey(User, on_delete=models.SET_NULL, null=True, blank=True)
+    note = models.CharField(max_length=200, blank=True)
+    created_at = models.DateTimeField(default=timezone.now)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['medicine', 'id'], name='stockmovement_medicine_idx'),
+            models.Index(fields=['created_at'], name='stockmovement_created_idx'),
+        ]
+
+    def __str__(self):
+        return f"{self.kind} {self.quantity:+d} medicine {self.medicine_id}"
+
+
+class StockSnapshot(models.Model):
+    """Stock of a medicine after every movement up to and including ``movement_id``"""
+    medicine = models.ForeignKey(Medicine, on_delete=models.CASCADE, related_name='snapshots')
+    movement_id = models.BigIntegerField()     # ledger high-water mark; 0 = before any movement
+    quantity = models.IntegerField()
+    taken_at = models.DateTimeField(default=timezone.now)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['medicine', 'movement_id'], name='unique_stock_snapshot'),
+        ]
+        indexes = [
+            models.Index(fields=['medicine', 'taken_at'], name='stocksnapshot_taken_idx'),
+            # Latest high-water mark overall, where snapshot() resumes
+            models.Index(fields=['movement_id'], name='stocksnapshot_movement_idx'),
+        ]
+
+    def __str__(self):
+        return f"{self.medicine_id}@{self.movement_id}: {self.quantity}"
+
+
+class DemandForecast(models.Model):
+    """Demand statistics behind a medicine's reorder_point / order_quantity (see forecasting.py)"""
+    medicine = models.OneToOneField(Medicine, on_delete=models.CASCADE, related_name='forecast')
+    daily_demand = models.FloatField()
+    demand_std = models.FloatField()
+    window_days = models.PositiveIntegerField()
+    lead_time_days = models.PositiveIntegerField()
+    # Highest SaleItem id seen by the run that computed this row
+    sales_through = models.BigIntegerField(default=0)
+    computed_at = models.DateTimeField()
+
+    def __str__(self):
+        return f"{self.medicine_id}: {self.daily_demand:.2f}/day"
+
+
+class ForecastRun(models.Model):
+    """
+    Where the last completed forecast refresh got to: a single row, kept apart
+    from DemandForecast so deleting idle forecasts never moves the mark back
+    """
+    # Highest SaleItem id the run counted
+    sales_through = models.BigIntegerField(default=0)
+    started_at = models.DateTimeField()
+
+    def __str__(self):
+        return f"Forecast through sale item {self.sales_through} ({self.started_at:%Y-%m-%d %H:%M})"
+
+
 class Sale(models.Model):
     PAYMENT_METHODS = [
         ('cash', 'Cash'),
@@ -86,14 +237,23 @@ class Sale(models.Model):
     change_amount = models.DecimalField(max_digits=12, decimal_places=2, default=0)
     status = models.CharField(max_length=15, choices=STATUS_CHOICES, default='pending')
     notes = models.TextField(blank=True)
+    # Idempotency key set by tills that queue sales offline (see SaleViewSet.batch)
+    client_ref = models.CharField(max_length=64, unique=True, null=True, blank=True)
     created_at = models.DateTimeField(auto_now_add=True)
+    # Moves on every save, e.g. when an M-Pesa payment completes the sale or it is refunded
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['created_at', 'id'], name='sale_created_id_idx'),
+            models.Index(fields=['status', 'created_at'], name='sale_status_created_idx'),
+            models.Index(fields=['payment_method', 'status', 'created_at'], name='sale_payment_status_idx'),
+            models.Index(fields=['updated_at'], name='sale_updated_idx'),
+        ]
 
     def save(self, *args, **kwargs):
         if not self.receipt_number:
-            prefix = "RX"
-            timestamp = timezone.now().strftime('%y%m%d%H%M')
-            uid = str(uuid.uuid4())[:4].upper()
-            self.receipt_number = f"{prefix}-{timestamp}-{uid}"
+            self.receipt_number = receipt_numbers.next()
         super().save(*args, **kwargs)
 
     def __str__(self):
@@ -108,6 +268,11 @@ class SaleItem(models.Model):
     unit_price = models.DecimalField(max_digits=10, decimal_places=2)
     total_price = models.DecimalField(max_digits=12, decimal_places=2)
 
+    class Meta:
+        indexes = [
+            models.Index(fields=['medicine', 'sale'], name='saleitem_medicine_sale_idx'),
+        ]
+
     def save(self, *args, **kwargs):
         self.medicine_name = self.medicine.name if self.medicine else self.medicine_name
         self.total_price = self.unit_price * self.quantity
@@ -117,6 +282,24 @@ class SaleItem(models.Model):
         return f"{self.medicine_name} x{self.quantity}"
 
 
+class DailySalesSummary(models.Model):
+    """Pre-aggregated sales per day, payment method and status (see rollups.py)"""
+    date = models.DateField()
+    payment_method = models.CharField(max_length=10, choices=Sale.PAYMENT_METHODS)
+    status = models.CharField(max_length=15, choices=Sale.STATUS_CHOICES)
+    sale_count = models.IntegerField(default=0)
+    total_amount = models.DecimalField(max_digits=14, decimal_places=2, default=0)
+
+    class Meta:
+        verbose_name_plural = "Daily sales summaries"
+        constraints = [
+            models.UniqueConstraint(fields=['date', 'payment_method', 'status'], name='unique_daily_sales_bucket'),
+        ]
+
+    def __str__(self):
+        return f"{self.date} {self.payment_method}/{self.status}: {self.total_amount}"
+
+
 class MpesaTransaction(models.Model):
     STATUS_CHOICES = [
         ('pending', 'Pending'),
@@ -128,6 +311,13 @@ class MpesaTransaction(models.Model):
 
     sale = models.OneToOneField(Sale, on_delete=models.SET_NULL, null=True, related_name='mpesa_transaction')
     checkout_request_id = models.CharField(max_length=100, unique=True)
+    # Stable id handed to the client when the push is dispatched asynchronously;
+    # checkout_request_id holds the same placeholder until Daraja answers
+    reference = models.CharField(max_length=40, unique=True, null=True, blank=True)
+    dispatched_at = models.DateTimeField(null=True, blank=True)
+    # Reconciliation bookkeeping (see reconcile.py)
+    status_checks = models.PositiveIntegerField(default=0)
+    next_status_check_at = models.DateTimeField(null=True, blank=True)
     merchant_request_id = models.CharField(max_length=100, blank=True)
     phone_number = models.CharField(max_length=15)
     amount = models.DecimalField(max_digits=12, decimal_places=2)
@@ -139,5 +329,43 @@ class MpesaTransaction(models.Model):
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
 
+    class Meta:
+        indexes = [
+            models.Index(fields=['status', 'created_at'], name='mpesa_status_created_idx'),
+        ]
+
+    def __str__(self):
+        return f"M-Pesa {self.checkout_request_id} - {self.status}"
+
+
+class MpesaCallback(models.Model):
+    """
+    Append-only journal of Daraja result callbacks. The callback endpoint only
+    inserts here; mpesa.apply_callbacks() applies the rows to MpesaTransaction.
+    A callback whose transaction is not there yet stays unapplied and is
+    retried by the next applier run (scheduled for CALLBACK_RETRY_DELAY later)
+    or by the reconciler, until UNMATCHED_GRACE marks it unmatched.
+    """
+
+    OUTCOME_CHOICES = [
+        ('applied', 'Applied'),
+        ('ignored', 'Ignored'),        # transaction was already resolved
+        ('unmatched', 'Unmatched'),    # no transaction with this checkout id
+    ]
+
+    # Identical redeliveries of the same result share a key and are stored once
+    dedupe_key = models.CharField(max_length=64, unique=True)
+    checkout_request_id = models.CharField(max_length=100, db_index=True)
+    result_code = models.CharField(max_length=10, blank=True)
+    payload = models.JSONField()
+    received_at = models.DateTimeField(auto_now_add=True)
+    applied_at = models.DateTimeField(null=True, blank=True)
+    outcome = models.CharField(max_length=10, choices=OUTCOME_CHOICES, blank=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['applied_at', 'id'], name='mpesa_callback_pending_idx'),
+        ]
+
     def __str__(self):
-        return f"M-Pesa {self.checkout_request_id} - {self.status}"
\ No newline at end of file
+        return f"Callback {self.checkout_request_id} - {self.result_code}"
@@ -0,0 +1,508 @@
+"""
+M-Pesa Daraja integration: the API client and the asynchronous STK push dispatcher.
+"""
+
+import base64
+import hashlib
+import json
+import logging
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+
+import requests
+from decouple import config
+from django.conf import settings
+from django.core.cache import caches
+from django.db import close_old_connections, transaction
+from django.utils import timezone
+from requests.adapters import HTTPAdapter
+
+from .events import broker, mpesa_channel
+from .models import MpesaCallback, MpesaTransaction, Sale
+
+logger = logging.getLogger(__name__)
+
+
+class TokenCache:
+    """
+    OAuth token shared through a Django cache, so every worker process reuses
+    one token (configure a shared backend such as Redis, Memcached or the
+    database cache via MPESA_TOKEN_CACHE).
+
+    Only one caller refreshes at a time: a thread lock inside the process and a
+    cache.add() lock across processes; everyone else waits for the new token.
+    Once a token is within REFRESH_AHEAD seconds of expiry it is refreshed in a
+    background thread while callers keep using the still-valid one.
+    """
+
+    KEY = 'mpesa:oauth-token'
+    LOCK_KEY = 'mpesa:oauth-token:lock'
+    # Never hand out a token this close to expiry
+    EXPIRY_MARGIN = 60
+    REFRESH_AHEAD = 300
+    LOCK_TIMEOUT = 30
+    WAIT_TIMEOUT = 15
+    POLL_INTERVAL = 0.1
+
+    def __init__(self, fetch, alias=None):
+        self.fetch = fetch   # () -> (token, expires_in seconds)
+        self.alias = alias or getattr(settings, 'MPESA_TOKEN_CACHE', 'default')
+        self._lock = threading.Lock()
+        self._background = threading.Lock()
+
+    @property
+    def cache(self):
+        return caches[self.alias]
+
+    def get(self):
+        entry = self.cache.get(self.KEY)
+        now = time.time()
+        if entry and now < entry['expires_at'] - self.EXPIRY_MARGIN:
+            if now >= entry['expires_at'] - self.REFRESH_AHEAD:
+                self._refresh_in_background()
+            return entry['token']
+        return self._refresh()['token']
+
+    def warm(self):
+        """Refresh now if the token is missing or due; for long-running workers"""
+        entry = self.cache.get(self.KEY)
+        if not entry or time.time() >= entry['expires_at'] - self.REFRESH_AHEAD:
+            self._refresh(force=bool(entry))
+
+    def clear(self):
+        self.cache.delete(self.KEY)
+
+    def _refresh_in_background(self):
+        if not self._background.acquire(blocking=False):
+            return
+
+        def run():
+            try:
+                self._refresh(force=True)
+            except Exception as e:
+                logger.warning(f"[MPESA] Background token refresh failed: {e}")
+            finally:
+                self._background.release()
+
+        threading.Thread(target=run, daemon=True).start()
+
+    def _refresh(self, force=False):
+        with self._lock:
+            # Another thread in this process may have refreshed while we waited
+            entry = self.cache.get(self.KEY)
+            if entry and not force and time.time() < entry['expires_at'] - self.EXPIRY_MARGIN:
+                return entry
+            previous = entry['token'] if entry else None
+            if self.cache.add(self.LOCK_KEY, 1, self.LOCK_TIMEOUT):
+                try:
+                    return self._fetch_and_store()
+                finally:
+                    self.cache.delete(self.LOCK_KEY)
+            # Another process is refreshing: wait for its token
+            deadline = time.monotonic() + self.WAIT_TIMEOUT
+            while time.monotonic() < deadline:
+                time.sleep(self.POLL_INTERVAL)
+                entry = self.cache.get(self.KEY)
+                if entry and entry['token'] != previous and time.time() < entry['expires_at'] - self.EXPIRY_MARGIN:
+                    return entry
+                if self.cache.get(self.LOCK_KEY) is None:
+                    break
+            entry = self.cache.get(self.KEY)
+            if entry and time.time() < entry['expires_at'] - self.EXPIRY_MARGIN:
+                return entry
+            return self._fetch_and_store()
+
+    def _fetch_and_store(self):
+        token, expires_in = self.fetch()
+        entry = {'token': token, 'expires_at': time.time() + expires_in}
+        self.cache.set(self.KEY, entry, max(1, expires_in - self.EXPIRY_MARGIN))
+        logger.debug(f"[MPESA] Fresh token cached, expires in {expires_in}s")
+        return entry
+
+
+def build_session(pool_size):
+    """Keep-alive HTTP session shared by all Daraja calls in this process"""
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=2, pool_maxsize=pool_size)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    session.headers.update({
+        'User-Agent': 'MyPharmacyApp/1.0',
+        'Accept': 'application/json',
+    })
+    return session
+
+
+class MpesaService:
+    """Daraja API integration"""
+
+    CONSUMER_KEY = config('MPESA_CONSUMER_KEY', default='')
+    CONSUMER_SECRET = config('MPESA_CONSUMER_SECRET', default='')
+    SHORTCODE = config('MPESA_SHORTCODE', default='174379')
+    PASSKEY = config('MPESA_PASSKEY', default='')
+    CALLBACK_URL = config('MPESA_CALLBACK_URL', default='https://yourdomain.com/api/mpesa/callback/')
+    ENVIRONMENT = config('MPESA_ENVIRONMENT', default='sandbox')
+    # Overrides the environment's URL, e.g. to point at `manage.py fake_daraja`
+    BASE_URL = config('MPESA_BASE_URL', default='')
+    POOL_SIZE = config('MPESA_POOL_SIZE', default=16, cast=int)
+
+    def __init__(self):
+        self.session = build_session(self.POOL_SIZE)
+        self.tokens = TokenCache(self.fetch_access_token)
+
+    @property
+    def base_url(self):
+        if self.BASE_URL:
+            return self.BASE_URL.rstrip('/')
+        if self.ENVIRONMENT == 'production':
+            return 'https://api.safaricom.co.ke'
+        return 'https://sandbox.safaricom.co.ke'
+
+    def get_access_token(self):
+        return self.tokens.get()
+
+    def fetch_access_token(self):
+        """Request a new OAuth token; returns (token, expires_in seconds)"""
+        url = f"{self.base_url}/oauth/v1/generate?grant_type=client_credentials"
+        credentials = base64.b64encode(
+            f"{self.CONSUMER_KEY}:{self.CONSUMER_SECRET}".encode()
+        ).decode()
+
+        resp = self.session.get(
+            url,
+            headers={
+                'Authorization': f'Basic {credentials}',
+                'Cache-Control': 'no-cache',
+            },
+            timeout=10
+        )
+        resp.raise_for_status()
+        data = resp.json()
+        # Token expires in 3599s
+        return data['access_token'], int(data.get('expires_in', 3599))
+
+    def get_password(self, timestamp):
+        raw = f"{self.SHORTCODE}{self.PASSKEY}{timestamp}"
+        logger.debug(f"[MPESA] Password raw string: {self.SHORTCODE} + {self.PASSKEY} + {timestamp}")
+        logger.debug(f"[MPESA] Full raw (first 30 chars): {raw[:30]}")
+        return base64.b64encode(raw.encode()).decode()
+
+    def stk_push(self, phone: str, amount: int, account_ref: str, description: str):
+        token = self.get_access_token()
+        timestamp = timezone.now().strftime('%Y%m%d%H%M%S')
+        password = self.get_password(timestamp)
+        
+        url = f"{self.base_url}/mpesa/stkpush/v1/processrequest"
+        payload = {
+            "BusinessShortCode": self.SHORTCODE,
+            "Password": password,
+            "Timestamp": timestamp,
+            "TransactionType": "CustomerPayBillOnline",
+            "Amount": int(amount),
+            "PartyA": phone,
+            "PartyB": self.SHORTCODE,
+            "PhoneNumber": phone,
+            "CallBackURL": self.CALLBACK_URL,
+            "AccountReference": account_ref,
+            "TransactionDesc": description
+        }
+        
+        logger.debug(f"[MPESA] STK Push URL: {url}")
+        logger.debug(f"[MPESA] STK Push payload: {json.dumps({**payload, 'Password': '***HIDDEN***'})}")
+        logger.debug(f"[MPESA] Shortcode: {self.SHORTCODE}")
+        logger.debug(f"[MPESA] Passkey (first 10): {self.PASSKEY[:10] if self.PASSKEY else 'EMPTY!'}")
+        logger.debug(f"[MPESA] Timestamp: {timestamp}")
+        logger.debug(f"[MPESA] Phone: {phone}")
+        logger.debug(f"[MPESA] Amount: {amount}")
+        logger.debug(f"[MPESA] Callback URL: {self.CALLBACK_URL}")
+        logger.debug(f"[MPESA] Environment: {self.ENVIRONMENT}")
+        
+        try:
+            resp = self.session.post(
+                url,
+                json=payload,
+                headers={'Authorization': f'Bearer {token}'},
+                timeout=30
+            )
+            logger.debug(f"[MPESA] STK response status: {resp.status_code}")
+            logger.debug(f"[MPESA] STK response body: {resp.text}")
+            resp.raise_for_status()
+            return resp.json()
+        except requests.exceptions.HTTPError as e:
+            logger.error(f"[MPESA] STK Push HTTP error: {e}")
+            if e.response is not None:
+                logger.error(f"[MPESA] STK error status code: {e.response.status_code}")
+                logger.error(f"[MPESA] STK error response body: {e.response.text}")
+                try:
+                    error_json = e.response.json()
+                    logger.error(f"[MPESA] STK error parsed: {error_json}")
+                except Exception:
+                    pass
+            raise
+
+    def query_stk_status(self, checkout_request_id: str):
+        token = self.get_access_token()
+        timestamp = timezone.now().strftime('%Y%m%d%H%M%S')
+        url = f"{self.base_url}/mpesa/stkpushquery/v1/query"
+        payload = {
+            "BusinessShortCode": self.SHORTCODE,
+            "Password": self.get_password(timestamp),
+            "Timestamp": timestamp,
+            "CheckoutRequestID": checkout_request_id
+        }
+        resp = self.session.post(
+            url,
+            json=payload,
+            headers={'Authorization': f'Bearer {token}'},
+            timeout=30
+        )
+        resp.raise_for_status()
+        return resp.json()
+
+
+mpesa_service = MpesaService()
+
+
+# ─── Asynchronous STK push ────────────────────────────────────────────────────
+#
+# In async mode the view stores a pending MpesaTransaction whose
+# checkout_request_id is a local placeholder (equal to its ``reference``) and
+# returns straight away. The push itself is sent from a small thread pool once
+# the transaction commits; ``manage.py mpesa_dispatch_worker`` sweeps up any
+# rows a crashed process never sent.
+
+DISPATCH_MODE = config('MPESA_DISPATCH_MODE', default='sync')   # sync | async
+DISPATCH_WORKERS = config('MPESA_DISPATCH_WORKERS', default=8, cast=int)
+
+_executor = None
+
+
+def new_reference():
+    return f"LOCAL-{uuid.uuid4().hex[:20].upper()}"
+
+
+def queue_stk_push(txn_id):
+    """Send the push for ``txn_id`` in the background after the current transaction commits"""
+    global _executor
+    if _executor is None:
+        _executor = ThreadPoolExecutor(max_workers=DISPATCH_WORKERS, thread_name_prefix='stk-dispatch')
+    transaction.on_commit(lambda: _executor.submit(_dispatch_in_thread, txn_id))
+
+
+def _dispatch_in_thread(txn_id):
+    close_old_connections()
+    try:
+        dispatch_stk_push(txn_id)
+    except Exception:
+        logger.exception(f"[MPESA] Dispatch of transaction {txn_id} crashed")
+    finally:
+        close_old_connections()
+
+
+def dispatch_stk_push(txn_id):
+    """
+    Claim an undispatched transaction and send its STK push.
+    Returns False if another worker already claimed it.
+    """
+    claimed = MpesaTransaction.objects.filter(
+        pk=txn_id, reference__isnull=False, dispatched_at__isnull=True, status='pending'
+    ).update(dispatched_at=timezone.now())
+    if not claimed:
+        return False
+
+    txn = MpesaTransaction.objects.select_related('sale').get(pk=txn_id)
+    receipt = txn.sale.receipt_number if txn.sale else txn.reference
+    try:
+        resp = mpesa_service.stk_push(
+            phone=txn.phone_number,
+            amount=int(txn.amount),
+            account_ref=receipt,
+            description=f"Pharmacy payment {receipt}"
+        )
+    except Exception as e:
+        logger.error(f"[MPESA] Async STK Push exception: {e}")
+        MpesaTransaction.objects.filter(pk=txn_id).update(
+            status='failed', result_description=str(e)[:500], updated_at=timezone.now()
+        )
+        broker.publish(mpesa_channel(txn_id), {'status': 'failed'})
+        return True
+
+    if resp.get('ResponseCode') == '0':
+        MpesaTransaction.objects.filter(pk=txn_id).update(
+            checkout_request_id=resp['CheckoutRequestID'],
+            merchant_request_id=resp.get('MerchantRequestID', ''),
+            updated_at=timezone.now(),
+        )
+    else:
+        logger.error(f"[MPESA] Async STK Push failed: {resp}")
+        MpesaTransaction.objects.filter(pk=txn_id).update(
+            status='failed',
+            result_description=resp.get('errorMessage', 'STK push failed'),
+            updated_at=timezone.now(),
+        )
+        broker.publish(mpesa_channel(txn_id), {'status': 'failed'})
+    return True
+
+
+# ─── Applying results ─────────────────────────────────────────────────────────
+
+def status_for_result(result_code):
+    """Map a Daraja ResultCode to an MpesaTransaction status"""
+    if result_code == '0':
+        return 'success'
+    if result_code in ('1032', '1037'):
+        return 'cancelled'
+    return 'failed'
+
+
+def resolve_transaction(txn_id, status, result_code='', result_description='', receipt_number=''):
+    """
+    Move a pending transaction to a final status with a conditional UPDATE.
+    Returns False if it was no longer pending (already resolved elsewhere).
+    A successful payment also completes its sale.
+    """
+    now = timezone.now()
+    changes = {
+        'status': status,
+        'result_code': result_code,
+        'result_description': result_description,
+        'updated_at': now,
+        'next_status_check_at': None,
+    }
+    if status == 'success':
+        changes['mpesa_receipt_number'] = receipt_number
+        changes['transaction_date'] = now
+    with transaction.atomic():
+        if not MpesaTransaction.objects.filter(pk=txn_id, status='pending').update(**changes):
+            return False
+        if status == 'success':
+            txn = MpesaTransaction.objects.only('sale_id', 'amount').get(pk=txn_id)
+            sale = Sale.objects.filter(pk=txn.sale_id).first() if txn.sale_id else None
+            if sale is not None:
+                # save() rather than update() so the sales rollup follows the status change
+                sale.status = 'completed'
+                sale.amount_paid = txn.amount
+                sale.save()
+        transaction.on_commit(lambda: broker.publish(mpesa_channel(txn_id), {'status': status}))
+    return True
+
+
+
+# ─── Callback journal ─────────────────────────────────────────────────────────
+
+CALLBACK_BATCH_SIZE = 200
+# Callbacks can beat the transaction row (or its real checkout id) into the
+# database; keep retrying them this long before giving up
+UNMATCHED_GRACE = timedelta(minutes=5)
+# Seconds before callbacks still waiting for their transaction are looked at
+# again, in case no other callback arrives to trigger a run
+CALLBACK_RETRY_DELAY = 30
+
+_applier = None
+_apply_scheduled = threading.Event()
+_retry = None
+
+
+def parse_callback(data):
+    """(checkout_request_id, result_code, result_description, receipt_number) from a Daraja callback"""
+    body = (data.get('Body') or {}).get('stkCallback') or {}
+    items = (body.get('CallbackMetadata') or {}).get('Item') or []
+    meta = {item.get('Name'): item.get('Value') for item in items if isinstance(item, dict)}
+    return (
+        str(body.get('CheckoutRequestID') or ''),
+        str(body.get('ResultCode', '')),
+        str(body.get('ResultDesc', '')),
+        str(meta.get('MpesaReceiptNumber') or ''),
+    )
+
+
+def journal_callback(data):
+    """
+    Store a raw callback with a single INSERT; duplicates are dropped by the
+    unique dedupe key. Returns False if the payload has no checkout id.
+    """
+    checkout_id, result_code, _, receipt = parse_callback(data)
+    if not checkout_id:
+        return False
+    key = hashlib.sha256(f"{checkout_id}|{result_code}|{receipt}".encode()).hexdigest()
+    MpesaCallback.objects.bulk_create([MpesaCallback(
+        dedupe_key=key, checkout_request_id=checkout_id, result_code=result_code, payload=data,
+    )], ignore_conflicts=True)
+    return True
+
+
+def schedule_callback_apply():
+    """
+    Apply journalled callbacks in the background once the current transaction
+    commits. A burst of callbacks is folded into one applier run; callbacks
+    still waiting for their transaction are retried CALLBACK_RETRY_DELAY later.
+    """
+    global _applier
+    if _applier is None:
+        _applier = ThreadPoolExecutor(max_workers=1, thread_name_prefix='mpesa-callbacks')
+    if _apply_scheduled.is_set():
+        return
+    _apply_scheduled.set()
+    transaction.on_commit(lambda: _applier.submit(_apply_in_thread))
+
+
+def _apply_in_thread():
+    # Callbacks journalled from here on schedule another run
+    _apply_scheduled.clear()
+    close_old_connections()
+    try:
+        while apply_callbacks() == CALLBACK_BATCH_SIZE:
+            pass
+        if MpesaCallback.objects.filter(applied_at__isnull=True).exists():
+            _retry_later()
+    except Exception:
+        logger.exception("[MPESA] Applying callbacks crashed")
+    finally:
+        close_old_connections()
+
+
+def _retry_later():
+    # Only ever called from the single applier thread
+    global _retry
+    if _retry is not None and _retry.is_alive():
+        return
+    _retry = threading.Timer(CALLBACK_RETRY_DELAY, schedule_callback_apply)
+    _retry.daemon = True
+    _retry.start()
+
+
+def apply_callbacks(batch_size=CALLBACK_BATCH_SIZE):
+    """
+    Apply one batch of unapplied callbacks, oldest first, through
+    resolve_transaction's conditional UPDATE, so replays, duplicates and races
+    with the reconciler cannot overwrite a resolved transaction.
+    Returns the number of callbacks examined.
+    """
+    callbacks = list(MpesaCallback.objects.filter(applied_at__isnull=True).order_by('id')[:batch_size])
+    if not callbacks:
+        return 0
+    txn_ids = dict(MpesaTransaction.objects.filter(
+        checkout_request_id__in={cb.checkout_request_id for cb in callbacks},
+    ).values_list('checkout_request_id', 'id'))
+
+    now = timezone.now()
+    outcomes = {'applied': [], 'ignored': [], 'unmatched': []}
+    for cb in callbacks:
+        txn_id = txn_ids.get(cb.checkout_request_id)
+        if txn_id is None:
+            if now - cb.received_at >= UNMATCHED_GRACE:
+                logger.error(f"[MPESA] Transaction NOT FOUND for checkout_id: {cb.checkout_request_id}")
+                outcomes['unmatched'].append(cb.pk)
+            continue
+        _, result_code, result_desc, receipt = parse_callback(cb.payload)
+        resolved = resolve_transaction(txn_id, status_for_result(result_code), result_code, result_desc, receipt)
+        outcomes['applied' if resolved else 'ignored'].append(cb.pk)
+
+    for outcome, pks in outcomes.items():
+        if pks:
+            MpesaCallback.objects.filter(pk__in=pks, applied_at__isnull=True).update(applied_at=now, outcome=outcome)
+    logger.debug(f"[MPESA] Applied callbacks: { {k: len(v) for k, v in outcomes.items()} }")
+    return len(callbacks)
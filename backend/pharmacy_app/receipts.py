@@ -0,0 +1,118 @@
+"""
+Time-ordered receipt numbers.
+
+A receipt number is ``RX`` followed by 18 Crockford base32 characters that
+encode, most significant first:
+
+    44 bits  milliseconds since RECEIPT_EPOCH
+     8 bits  RECEIPT_INSTANCE_ID (unique per app server sharing the database)
+    22 bits  process id
+    16 bits  per-process sequence within the millisecond
+
+With RECEIPT_INSTANCE_ID set, every running process has a distinct
+(instance, pid) pair, and each process never issues the same (millisecond,
+sequence) twice, so numbers are unique without touching the database or
+retrying. Without it, the 30 instance and pid bits are a hash of hostname and
+pid instead: container replicas all run as pid 1 but have their own hostname,
+and two processes collide with odds of about one in a billion.
+
+Fixed width and an alphabet in ASCII order mean that sorting the strings sorts
+by creation time. Older ``RX-...`` receipts sort before all of these.
+"""
+
+import hashlib
+import os
+import socket
+import threading
+import time
+from datetime import datetime, timezone as dt_timezone
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+
+PREFIX = 'RX'
+ALPHABET = '0123456789ABCDEFGHJKMNPQRSTVWXYZ'   # Crockford base32
+LENGTH = 18
+RECEIPT_EPOCH = datetime(2024, 1, 1, tzinfo=dt_timezone.utc)
+
+TIMESTAMP_BITS, INSTANCE_BITS, PID_BITS, SEQUENCE_BITS = 44, 8, 22, 16
+
+
+class ReceiptNumberAllocator:
+    def __init__(self, instance_id=None):
+        self._instance_id = instance_id
+        self._node = None              # (pid, instance field, pid field) for this process
+        self._lock = threading.Lock()
+        self._last_ms = -1
+        self._sequence = 0
+
+    @property
+    def instance_id(self):
+        """RECEIPT_INSTANCE_ID, or None when it is not set"""
+        if self._instance_id is None:
+            value = getattr(settings, 'RECEIPT_INSTANCE_ID', None)
+            if value is None:
+                return None
+            if not 0 <= value < 1 << INSTANCE_BITS:
+                raise ImproperlyConfigured(f"RECEIPT_INSTANCE_ID must be between 0 and {(1 << INSTANCE_BITS) - 1}")
+            self._instance_id = value
+        return self._instance_id
+
+    def node(self):
+        """(instance, pid) fields identifying this process; recomputed after a fork"""
+        pid = os.getpid()
+        if self._node is None or self._node[0] != pid:
+            instance_id = self.instance_id
+            if instance_id is not None:
+                self._node = (pid, instance_id, pid)
+            else:
+                digest = hashlib.blake2b(f'{socket.gethostname()}:{pid}'.encode(), digest_size=4).digest()
+                value = int.from_bytes(digest, 'big') >> (32 - INSTANCE_BITS - PID_BITS)
+                self._node = (pid, value >> PID_BITS, value & ((1 << PID_BITS) - 1))
+        return self._node[1:]
+
+    def next(self):
+        with self._lock:
+            now_ms = self._now_ms()
+            # Never go backwards, even if the wall clock does
+            if now_ms <= self._last_ms:
+                now_ms = self._last_ms
+                self._sequence += 1
+                if self._sequence >> SEQUENCE_BITS:
+                    # Sequence exhausted for this millisecond: move to the next one
+                    while now_ms <= self._last_ms:
+                        time.sleep(0.0001)
+                        now_ms = self._now_ms()
+                    self._sequence = 0
+            else:
+                self._sequence = 0
+            self._last_ms = now_ms
+            return encode(now_ms, *self.node(), self._sequence)
+
+    @staticmethod
+    def _now_ms():
+        return time.time_ns() // 1_000_000 - int(RECEIPT_EPOCH.timestamp() * 1000)
+
+
+def encode(ms, instance_id, pid, sequence):
+    value = ms
+    value = (value << INSTANCE_BITS) | instance_id
+    value = (value << PID_BITS) | (pid & ((1 << PID_BITS) - 1))
+    value = (value << SEQUENCE_BITS) | sequence
+    chars = []
+    for _ in range(LENGTH):
+        value, digit = divmod(value, 32)
+        chars.append(ALPHABET[digit])
+    return PREFIX + ''.join(reversed(chars))
+
+
+def issued_at(receipt_number):
+    """Creation time embedded in a receipt number from this allocator"""
+    value = 0
+    for char in receipt_number[len(PREFIX):]:
+        value = value * 32 + ALPHABET.index(char)
+    ms = value >> (INSTANCE_BITS + PID_BITS + SEQUENCE_BITS)
+    return datetime.fromtimestamp(RECEIPT_EPOCH.timestamp() + ms / 1000, tz=dt_timezone.utc)
+
+
+receipt_numbers = ReceiptNumberAllocator()
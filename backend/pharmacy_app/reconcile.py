@@ -0,0 +1,230 @@
+"""
+Background reconciliation of pending M-Pesa transactions.
+
+Pending transactions are normally resolved by Daraja's callback. When a
+callback is lost, the Reconciler asks Daraja for the status instead:
+
+* pending rows older than ``min_age`` are picked oldest-first, in batches;
+* each row is re-checked with exponential backoff (``status_checks`` /
+  ``next_status_check_at`` on the row), so young rows are checked often and
+  old ones rarely;
+* all outbound queries share one token-bucket rate limit, and a 429/5xx from
+  Daraja pauses the whole bucket;
+* concurrent queries for the same checkout_request_id are coalesced;
+* rows older than ``stale_after`` get one last query and are then marked
+  ``timeout``;
+* async pushes that were claimed for sending but never got a
+  CheckoutRequestID (the sender crashed or its call timed out) have nothing
+  to query: they are marked ``timeout`` once older than ``stale_after``.
+  They are not re-sent, since Daraja may have prompted the customer already.
+
+API requests never query Daraja for status themselves; run this with
+``manage.py reconcile_mpesa``. Before querying, the worker applies any
+journalled callbacks the web process has not applied yet; it also refreshes
+the shared OAuth token ahead of expiry.
+"""
+
+import logging
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from datetime import timedelta
+
+import requests
+from django.db import close_old_connections
+from django.db.models import F, Q
+from django.utils import timezone
+
+from .models import MpesaTransaction
+from .mpesa import CALLBACK_BATCH_SIZE, apply_callbacks, mpesa_service, resolve_transaction, status_for_result
+
+logger = logging.getLogger(__name__)
+
+# Daraja's "The transaction is being processed" error code
+STILL_PROCESSING = '500.001.1001'
+
+
+class RateLimiter:
+    """Thread-safe token bucket: ``rate`` requests per second, bursts up to ``burst``"""
+
+    def __init__(self, rate, burst=None):
+        self.rate = rate
+        self.capacity = burst or max(1, int(rate))
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                if now < self.paused_until:
+                    wait = self.paused_until - now
+                else:
+                    self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                    self.updated = now
+                    if self.tokens >= 1:
+                        self.tokens -= 1
+                        return
+                    wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+    def pause(self, seconds):
+        """Stop handing out tokens for ``seconds`` (e.g. after a 429)"""
+        with self.lock:
+            self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+
+
+class SingleFlight:
+    """Run at most one call per key at a time; concurrent callers share its result"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.calls = {}
+
+    def do(self, key, fn):
+        with self.lock:
+            future = self.calls.get(key)
+            leader = future is None
+            if leader:
+                future = self.calls[key] = Future()
+        if not leader:
+            return future.result()
+        try:
+            future.set_result(fn())
+        except BaseException as e:
+            future.set_exception(e)
+        finally:
+            with self.lock:
+                del self.calls[key]
+        return future.result()
+
+
+class Reconciler:
+    def __init__(self, service=None, rate=2.0, concurrency=4, batch_size=50,
+                 min_age=30, stale_after=900, base_backoff=15, max_backoff=600):
+        self.service = service or mpesa_service
+        self.limiter = RateLimiter(rate)
+        self.flight = SingleFlight()
+        self.concurrency = concurrency
+        self.batch_size = batch_size
+        self.min_age = timedelta(seconds=min_age)
+        self.stale_after = timedelta(seconds=stale_after)
+        self.base_backoff = base_backoff
+        self.max_backoff = max_backoff
+
+    def due(self, now=None):
+        """Pending, dispatched transactions whose next check is due, oldest first"""
+        now = now or timezone.now()
+        return MpesaTransaction.objects.filter(
+            Q(next_status_check_at__isnull=True) | Q(next_status_check_at__lte=now),
+            status='pending',
+            created_at__lte=now - self.min_age,
+        ).exclude(
+            # Async pushes that have not been sent yet have nothing to query
+            reference__isnull=False, checkout_request_id=F('reference'),
+        ).order_by('created_at').values_list('id', 'checkout_request_id', 'created_at', 'status_checks')
+
+    def unsent(self, now=None):
+        """Async pushes claimed by a sender that never recorded a CheckoutRequestID"""
+        now = now or timezone.now()
+        return MpesaTransaction.objects.filter(
+            status='pending',
+            reference__isnull=False,
+            checkout_request_id=F('reference'),
+            created_at__lte=now - self.stale_after,
+            # Leave a send that may still be in flight alone
+            dispatched_at__lte=now - self.min_age,
+        ).order_by('created_at').values_list('id', flat=True)
+
+    def run_once(self):
+        """Reconcile one batch; returns {outcome: count}"""
+        try:
+            # Keeps the shared OAuth token fresh, so web requests never wait for it
+            self.service.tokens.warm()
+        except Exception as e:
+            logger.warning(f"[MPESA] Token refresh failed: {e}")
+        # Journalled callbacks first: no need to ask Daraja about those
+        while apply_callbacks() == CALLBACK_BATCH_SIZE:
+            pass
+        outcomes = {}
+        for txn_id in self.unsent()[:self.batch_size]:
+            if resolve_transaction(txn_id, 'timeout', '', 'STK push was claimed but never confirmed as sent'):
+                outcomes['timeout'] = outcomes.get('timeout', 0) + 1
+        rows = list(self.due()[:self.batch_size])
+        close_old_connections()
+        if not rows:
+            return outcomes
+        with ThreadPoolExecutor(max_workers=self.concurrency) as pool:
+            for outcome in pool.map(self._reconcile, rows):
+                outcomes[outcome] = outcomes.get(outcome, 0) + 1
+        return outcomes
+
+    def _reconcile(self, row):
+        txn_id, checkout_id, created_at, checks = row
+        try:
+            return self.reconcile(txn_id, checkout_id, created_at, checks)
+        except Exception:
+            logger.exception(f"[MPESA] Reconciling transaction {txn_id} crashed")
+            self._reschedule(txn_id, checks)
+            return 'error'
+        finally:
+            close_old_connections()
+
+    def reconcile(self, txn_id, checkout_id, created_at, checks):
+        stale = timezone.now() - created_at >= self.stale_after
+        result_code, result_desc, retry_after = self.query(checkout_id)
+
+        if result_code is not None:
+            status = status_for_result(result_code)
+            resolve_transaction(txn_id, status, result_code, result_desc)
+            return status
+        if stale:
+            resolve_transaction(txn_id, 'timeout', '', 'No result from M-Pesa before the reconciliation deadline')
+            return 'timeout'
+        if retry_after:
+            self.limiter.pause(retry_after)
+        self._reschedule(txn_id, checks)
+        return 'pending'
+
+    def query(self, checkout_id):
+        """
+        (result_code, result_description, retry_after). result_code is None while
+        the outcome is unknown; retry_after is set when Daraja asks us to slow down.
+        """
+        def call():
+            self.limiter.acquire()
+            return self.service.query_stk_status(checkout_id)
+
+        try:
+            resp = self.flight.do(checkout_id, call)
+        except requests.HTTPError as e:
+            response = e.response
+            code = response.status_code if response is not None else None
+            body = {}
+            if response is not None:
+                try:
+                    body = response.json()
+                except ValueError:
+                    pass
+            if body.get('errorCode') == STILL_PROCESSING:
+                return None, '', 0
+            if code == 429 or (code and code >= 500):
+                return None, '', self.base_backoff
+            logger.warning(f"[MPESA] Status query for {checkout_id} failed: {e}")
+            return None, '', 0
+        except requests.RequestException as e:
+            logger.warning(f"[MPESA] Status query for {checkout_id} failed: {e}")
+            return None, '', self.base_backoff
+
+        if 'ResultCode' in resp and resp['ResultCode'] not in ('', None):
+            return str(resp['ResultCode']), resp.get('ResultDesc', ''), 0
+        return None, '', 0
+
+    def _reschedule(self, txn_id, checks):
+        delay = min(self.max_backoff, self.base_backoff * (2 ** checks))
+        MpesaTransaction.objects.filter(pk=txn_id, status='pending').update(
+            status_checks=checks + 1,
+            next_status_check_at=timezone.now() + timedelta(seconds=delay),
+        )
@@ -0,0 +1,91 @@
+"""
+Incremental maintenance of the DailySalesSummary rollup.
+
+Every Sale lives in exactly one (date, payment_method, status) bucket. When a
+sale is created, changes bucket (e.g. pending -> completed, completed ->
+refunded) or changes total, the old bucket is decremented and the new one
+incremented. Updates are applied after the surrounding transaction commits so
+checkouts never hold a lock on the shared per-day rows.
+
+``manage.py rebuild_sales_summary`` recomputes the table from scratch.
+"""
+
+from django.db import IntegrityError, transaction
+from django.db.models import Count, F, Sum
+from django.db.models.functions import TruncDate
+from django.utils import timezone
+
+from .models import DailySalesSummary, Sale
+
+
+def bucket_for(sale):
+    """(date, payment_method, status, total_amount) for a Sale instance"""
+    return (
+        timezone.localdate(sale.created_at),
+        sale.payment_method,
+        sale.status,
+        sale.total_amount,
+    )
+
+
+def record_sale_change(old, new):
+    """
+    Move a sale between buckets. ``old``/``new`` are values from bucket_for(),
+    or None when the sale is being created/deleted.
+    """
+    if old == new:
+        return
+    deltas = []
+    if old is not None:
+        deltas.append((old[:3], -1, -old[3]))
+    if new is not None:
+        deltas.append((new[:3], 1, new[3]))
+    transaction.on_commit(lambda: _apply(deltas))
+
+
+def _apply(deltas):
+    for (day, method, status), count, amount in deltas:
+        _bump(day, method, status, count, amount)
+
+
+def _bump(day, method, status, count, amount):
+    key = {'date': day, 'payment_method': method, 'status': status}
+    changes = {
+        'sale_count': F('sale_count') + count,
+        'total_amount': F('total_amount') + amount,
+    }
+    if DailySalesSummary.objects.filter(**key).update(**changes):
+        return
+    try:
+        with transaction.atomic():
+            DailySalesSummary.objects.create(**key, sale_count=count, total_amount=amount)
+    except IntegrityError:
+        # Another process created the bucket first
+        DailySalesSummary.objects.filter(**key).update(**changes)
+
+
+def rebuild(date_from=None):
+    """Recompute the rollup from the sales table; returns the number of buckets written"""
+    sales = Sale.objects.all()
+    summaries = DailySalesSummary.objects.all()
+    if date_from:
+        sales = sales.filter(created_at__date__gte=date_from)
+        summaries = summaries.filter(date__gte=date_from)
+
+    rows = sales.annotate(day=TruncDate('created_at')).values(
+        'day', 'payment_method', 'status'
+    ).annotate(count=Count('id'), total=Sum('total_amount')).order_by()
+
+    with transaction.atomic():
+        summaries.delete()
+        created = DailySalesSummary.objects.bulk_create([
+            DailySalesSummary(
+                date=row['day'],
+                payment_method=row['payment_method'],
+                status=row['status'],
+                sale_count=row['count'],
+                total_amount=row['total'] or 0,
+            )
+            for row in rows
+        ], batch_size=1000)
+    return len(created)
@@ -0,0 +1,244 @@
+"""
+In-memory lookups for the POS terminal.
+
+Each process keeps its own index over Medicine name, generic_name and barcode.
+It is built lazily on first use, kept current by the Medicine save/delete
+signals (see signals.py) and periodically re-synced against ``updated_at`` so
+edits made by other worker processes show up within a few seconds.
+
+Barcode scans skip the index entirely and go through a small LRU cache of
+barcode -> Medicine, invalidated by the same signals.
+"""
+
+import heapq
+import threading
+import time
+from collections import OrderedDict
+
+from .models import Medicine
+
+
+# Tiers used to rank hits — lower is better
+EXACT_BARCODE = 0
+NAME_PREFIX = 1
+WORD_PREFIX = 2
+SUBSTRING = 3
+
+
+class MedicineSearchIndex:
+    """Prefix/trigram index returning ranked Medicine ids"""
+
+    # n-grams up to this length are indexed; longer queries intersect trigrams
+    GRAM_SIZE = 3
+    # Seconds between incremental re-syncs against the database
+    SYNC_INTERVAL = 5
+
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._built = False
+        self._synced_at = None
+        self._checked_at = 0
+        self._reset()
+
+    def _reset(self):
+        self._entries = {}    # id -> (name, generic_name, words, barcode)
+        self._barcodes = {}   # lower-cased barcode -> id
+        self._grams = {}      # n-gram -> set of ids
+
+    # ── Maintenance ────────────────────────────────────────────────────────────
+
+    def build(self):
+        """(Re)build the whole index from the database"""
+        rows = Medicine.objects.filter(is_active=True).values_list(
+            'id', 'name', 'generic_name', 'barcode', 'updated_at'
+        )
+        with self._lock:
+            self._reset()
+            latest = None
+            for pk, name, generic_name, barcode, updated_at in rows.iterator(chunk_size=2000):
+                self._add(pk, name, generic_name, barcode)
+                if latest is None or updated_at > latest:
+                    latest = updated_at
+            self._synced_at = latest
+            self._checked_at = time.monotonic()
+            self._built = True
+
+    def sync(self):
+        """Pull rows changed since the last build/sync (e.g. by other processes)"""
+        with self._lock:
+            if not self._built:
+                return self.build()
+            self._checked_at = time.monotonic()
+            qs = Medicine.objects.all()
+            if self._synced_at is not None:
+                qs = qs.filter(updated_at__gt=self._synced_at)
+            for pk, name, generic_name, barcode, is_active, updated_at in qs.values_list(
+                'id', 'name', 'generic_name', 'barcode', 'is_active', 'updated_at'
+            ):
+                self._remove(pk)
+                if is_active:
+                    self._add(pk, name, generic_name, barcode)
+                if self._synced_at is None or updated_at > self._synced_at:
+                    self._synced_at = updated_at
+
+    def ensure_ready(self):
+        if not self._built:
+            self.build()
+        elif time.monotonic() - self._checked_at >= self.SYNC_INTERVAL:
+            self.sync()
+
+    def update(self, medicine):
+        """Index (or drop, if inactive) a single Medicine instance"""
+        with self._lock:
+            if not self._built:
+                return
+            self._remove(medicine.pk)
+            if medicine.is_active:
+                self._add(medicine.pk, medicine.name, medicine.generic_name, medicine.barcode)
+
+    def remove(self, pk):
+        with self._lock:
+            if self._built:
+                self._remove(pk)
+
+    def _add(self, pk, name, generic_name, barcode):
+        name = (name or '').lower()
+        generic_name = (generic_name or '').lower()
+        barcode = (barcode or '').lower()
+        words = tuple(name.split() + generic_name.split())
+        self._entries[pk] = (name, generic_name, words, barcode)
+        if barcode:
+            self._barcodes[barcode] = pk
+        for gram in self._grams_for(name) | self._grams_for(generic_name):
+            self._grams.setdefault(gram, set()).add(pk)
+
+    def _remove(self, pk):
+        entry = self._entries.pop(pk, None)
+        if entry is None:
+            return
+        name, generic_name, _, barcode = entry
+        for gram in self._grams_for(name) | self._grams_for(generic_name):
+            ids = self._grams.get(gram)
+            if ids is not None:
+                ids.discard(pk)
+                if not ids:
+                    del self._grams[gram]
+        if barcode and self._barcodes.get(barcode) == pk:
+            del self._barcodes[barcode]
+
+    def _grams_for(self, text):
+        grams = set()
+        for n in range(1, self.GRAM_SIZE + 1):
+            for i in range(len(text) - n + 1):
+                grams.add(text[i:i + n])
+        return grams
+
+    # ── Lookup ─────────────────────────────────────────────────────────────────
+
+    def search(self, query, limit=20):
+        """
+        Return up to ``limit`` Medicine ids ranked exact barcode first,
+        then name prefix, then word prefix, then substring matches.
+        """
+        q = (query or '').strip().lower()
+        if not q:
+            return []
+        self.ensure_ready()
+
+        with self._lock:
+            barcode_hit = self._barcodes.get(q)
+
+            if len(q) <= self.GRAM_SIZE:
+                candidates = self._grams.get(q, set())
+            else:
+                sets = [
+                    self._grams.get(q[i:i + self.GRAM_SIZE], set())
+                    for i in range(len(q) - self.GRAM_SIZE + 1)
+                ]
+                sets.sort(key=len)
+                candidates = set(sets[0]).intersection(*sets[1:])
+
+            ranked = []
+            if barcode_hit is not None:
+                ranked.append((EXACT_BARCODE, '', barcode_hit))
+            for pk in candidates:
+                if pk == barcode_hit:
+                    continue
+                name, generic_name, words, _ = self._entries[pk]
+                if name.startswith(q) or generic_name.startswith(q):
+                    tier = NAME_PREFIX
+                elif any(w.startswith(q) for w in words):
+                    tier = WORD_PREFIX
+                elif q in name or q in generic_name:
+                    tier = SUBSTRING
+                else:
+                    continue
+                ranked.append((tier, name, pk))
+
+        return [pk for _, _, pk in heapq.nsmallest(limit, ranked)]
+
+
+class BarcodeCache:
+    """LRU cache of active Medicine rows keyed by exact barcode"""
+
+    MAX_SIZE = 5000
+    # Entries expire so changes made by other worker processes are picked up
+    TTL = 30
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._items = OrderedDict()   # barcode -> (medicine, expires_at)
+        self._codes = {}              # medicine id -> barcode
+
+    def get_many(self, codes):
+        """Return {barcode: Medicine} for the codes that exist, loading misses in one query"""
+        now = time.monotonic()
+        found, missing = {}, []
+        with self._lock:
+            for code in codes:
+                item = self._items.get(code)
+                if item is not None and item[1] > now:
+                    self._items.move_to_end(code)
+                    found[code] = item[0]
+                else:
+                    missing.append(code)
+
+        if missing:
+            loaded = Medicine.objects.select_related('category').filter(
+                is_active=True
+            ).in_bulk(missing, field_name='barcode')
+            with self._lock:
+                for code, medicine in loaded.items():
+                    self._put(code, medicine, now + self.TTL)
+            found.update(loaded)
+        return found
+
+    def get(self, code):
+        return self.get_many([code]).get(code)
+
+    def invalidate(self, pks):
+        with self._lock:
+            for pk in pks:
+                code = self._codes.pop(pk, None)
+                if code is not None:
+                    self._items.pop(code, None)
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+            self._codes.clear()
+
+    def _put(self, code, medicine, expires_at):
+        previous = self._codes.get(medicine.pk)
+        if previous is not None and previous != code:
+            self._items.pop(previous, None)
+        self._items[code] = (medicine, expires_at)
+        self._items.move_to_end(code)
+        self._codes[medicine.pk] = code
+        while len(self._items) > self.MAX_SIZE:
+            evicted_code, (evicted, _) = self._items.popitem(last=False)
+            if self._codes.get(evicted.pk) == evicted_code:
+                del self._codes[evicted.pk]
+
+medicine_index = MedicineSearchIndex()
+barcode_cache = BarcodeCache()
@@ -1,5 +1,7 @@
 from rest_framework import serializers
 from django.contrib.auth.models import User
+from django.db import transaction
+from . import inventory
 from .models import Category, Medicine, Sale, SaleItem, MpesaTransaction
 
 
@@ -17,7 +19,11 @@ class CategorySerializer(serializers.ModelSerializer):
         fields = ['id', 'name', 'description', 'medicine_count', 'created_at']
 
     def get_medicine_count(self, obj):
-        return obj.medicines.filter(is_active=True).count()
+        # CategoryViewSet annotates the count; fall back for unannotated instances
+        count = getattr(obj, 'medicine_count', None)
+        if count is None:
+            count = obj.medicines.filter(is_active=True).count()
+        return count
 
 
 class MedicineSerializer(serializers.ModelSerializer):
@@ -32,9 +38,35 @@ class MedicineSerializer(serializers.ModelSerializer):
             'id', 'name', 'generic_name', 'category', 'category_name',
             'image', 'description', 'manufacturer', 'barcode', 'unit',
             'price', 'cost_price', 'stock_quantity', 'reorder_level',
+            'reorder_point', 'order_quantity',
             'expiry_date', 'requires_prescription', 'is_active',
             'is_low_stock', 'is_expired', 'created_at', 'updated_at'
         ]
+        read_only_fields = ['reorder_point', 'order_quantity']
+
+    def create(self, validated_data):
+        with transaction.atomic():
+            medicine = super().create(validated_data)
+            inventory.open_stock(medicine, user=self._user())
+        return medicine
+
+    def update(self, instance, validated_data):
+        # Stock typed into the form is a count, booked against the locked row;
+        # the form save leaves stock_quantity alone so a checkout that lands in
+        # between is not written over
+        counted = validated_data.pop('stock_quantity', None)
+        with transaction.atomic():
+            for attr, value in validated_data.items():
+                setattr(instance, attr, value)
+            instance.save(update_fields=[*validated_data, 'updated_at'])
+            if counted is not None:
+                inventory.set_count(instance.pk, counted, user=self._user(), note='Edited on medicine form')
+                instance.refresh_from_db(fields=['stock_quantity', 'expiry_date', 'updated_at'])
+        return instance
+
+    def _user(self):
+        request = self.context.get('request')
+        return request.user if request and request.user.is_authenticated else None
 
 
 class MedicineListSerializer(serializers.ModelSerializer):
@@ -51,6 +83,42 @@ class MedicineListSerializer(serializers.ModelSerializer):
         ]
 
 
+class BarcodeBatchSerializer(serializers.Serializer):
+    barcodes = serializers.ListField(
+        child=serializers.CharField(max_length=100), allow_empty=False, max_length=200
+    )
+
+
+class StockAdjustmentLineSerializer(serializers.Serializer):
+    medicine_id = serializers.IntegerField(required=False)
+    barcode = serializers.CharField(max_length=100, required=False)
+    delta = serializers.IntegerField()
+    lot_number = serializers.CharField(max_length=50, required=False, allow_blank=True)
+    expiry_date = serializers.DateField(required=False, allow_null=True)
+    cost_price = serializers.DecimalField(max_digits=10, decimal_places=2, required=False, allow_null=True)
+
+    def validate(self, attrs):
+        if ('medicine_id' in attrs) == ('barcode' in attrs):
+            raise serializers.ValidationError("Give either medicine_id or barcode.")
+        if attrs.get('lot_number') and attrs['delta'] <= 0:
+            raise serializers.ValidationError("Lot details are only allowed on positive deltas.")
+        return attrs
+
+
+class StockUpdateSerializer(serializers.Serializer):
+    """Body of PATCH /medicines/<id>/update_stock/; lot details only count on a positive quantity"""
+    quantity = serializers.IntegerField()
+    lot_number = serializers.CharField(max_length=50, required=False, allow_blank=True)
+    expiry_date = serializers.DateField(required=False, allow_null=True)
+    cost_price = serializers.DecimalField(max_digits=10, decimal_places=2, required=False, allow_null=True)
+    note = serializers.CharField(max_length=200, required=False, allow_blank=True, default='')
+
+
+class StockAdjustmentSerializer(serializers.Serializer):
+    lines = StockAdjustmentLineSerializer(many=True, allow_empty=False, max_length=1000)
+    note = serializers.CharField(max_length=200, required=False, allow_blank=True, default='')
+
+
 class SaleItemSerializer(serializers.ModelSerializer):
     class Meta:
         model = SaleItem
@@ -94,15 +162,29 @@ class SaleCreateSerializer(serializers.Serializer):
         return items
 
 
+class SaleBatchItemSerializer(SaleCreateSerializer):
+    client_ref = serializers.CharField(max_length=64)
+
+
+class SaleBatchSerializer(serializers.Serializer):
+    sales = SaleBatchItemSerializer(many=True, allow_empty=False, max_length=200)
+
+    def validate_sales(self, sales):
+        refs = [sale['client_ref'] for sale in sales]
+        if len(refs) != len(set(refs)):
+            raise serializers.ValidationError("client_ref values must be unique within a batch.")
+        return sales
+
+
 class MpesaTransactionSerializer(serializers.ModelSerializer):
     class Meta:
         model = MpesaTransaction
         fields = [
-            'id', 'sale', 'checkout_request_id', 'merchant_request_id',
+            'id', 'sale', 'checkout_request_id', 'reference', 'merchant_request_id',
             'phone_number', 'amount', 'mpesa_receipt_number', 'status',
             'result_code', 'result_description', 'transaction_date', 'created_at'
         ]
-        read_only_fields = ['checkout_request_id', 'merchant_request_id', 'status']
+        read_only_fields = ['checkout_request_id', 'reference', 'merchant_request_id', 'status']
 
 
 class STKPushSerializer(serializers.Serializer):
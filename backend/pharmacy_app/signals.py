@@ -0,0 +1,68 @@
+from django.db import transaction
+from django.db.backends.signals import connection_created
+from django.db.models.signals import pre_save, post_save, post_delete
+from django.dispatch import receiver
+
+from .events import broker, mpesa_channel
+from .metrics import install_query_hook
+from .models import Medicine, MpesaTransaction, Sale
+from .rollups import bucket_for, record_sale_change
+from .search import medicine_index, barcode_cache
+
+
+# ─── POS search index / barcode cache ──────────────────────────────────────────
+
+@receiver(post_save, sender=Medicine)
+def index_medicine(sender, instance, **kwargs):
+    def apply():
+        medicine_index.update(instance)
+        barcode_cache.invalidate([instance.pk])
+    transaction.on_commit(apply)
+
+
+@receiver(post_delete, sender=Medicine)
+def unindex_medicine(sender, instance, **kwargs):
+    pk = instance.pk
+
+    def apply():
+        medicine_index.remove(pk)
+        barcode_cache.invalidate([pk])
+    transaction.on_commit(apply)
+
+
+# ─── Daily sales rollup ────────────────────────────────────────────────────────
+
+@receiver(pre_save, sender=Sale)
+def remember_sale_bucket(sender, instance, **kwargs):
+    instance._rollup_bucket = None
+    if instance.pk:
+        old = Sale.objects.filter(pk=instance.pk).only(
+            'created_at', 'payment_method', 'status', 'total_amount'
+        ).first()
+        if old is not None:
+            instance._rollup_bucket = bucket_for(old)
+
+
+@receiver(post_save, sender=Sale)
+def update_sales_rollup(sender, instance, raw=False, **kwargs):
+    if raw:
+        return
+    record_sale_change(getattr(instance, '_rollup_bucket', None), bucket_for(instance))
+
+
+@receiver(post_delete, sender=Sale)
+def remove_from_sales_rollup(sender, instance, **kwargs):
+    record_sale_change(bucket_for(instance), None)
+
+
+# ─── Payment status events ─────────────────────────────────────────────────────
+
+@receiver(post_save, sender=MpesaTransaction)
+def announce_payment_status(sender, instance, **kwargs):
+    txn_id, status = instance.pk, instance.status
+    transaction.on_commit(lambda: broker.publish(mpesa_channel(txn_id), {'status': status}))
+
+
+# ─── Request metrics ───────────────────────────────────────────────────────────
+
+connection_created.connect(install_query_hook, dispatch_uid='pharmacy_metrics_query_hook')
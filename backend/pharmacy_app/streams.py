@@ -0,0 +1,123 @@
+"""
+Async payment-status endpoint, served by the ASGI application (backend/asgi.py).
+
+    GET /api/mpesa/events/<checkout_id>/?timeout=25
+
+Long-poll by default: the request is held open until the transaction leaves
+``pending`` or the timeout passes, then the transaction is returned as JSON.
+With ``Accept: text/event-stream`` the same endpoint streams server-sent
+``status`` events until the payment is resolved.
+
+Status changes arrive through events.broker, so waiting clients never cause
+status queries to Safaricom. Under WSGI the view still works but holds a
+worker thread while it waits.
+"""
+
+import json
+import time
+from contextlib import aclosing
+
+from asgiref.sync import sync_to_async
+from django.db.models import Q
+from django.http import JsonResponse, StreamingHttpResponse
+from rest_framework.exceptions import AuthenticationFailed
+from rest_framework_simplejwt.authentication import JWTAuthentication
+
+from .events import broker, mpesa_channel
+from .models import MpesaTransaction
+from .serializers import MpesaTransactionSerializer
+
+RESOLVED = ('success', 'failed', 'cancelled', 'timeout')
+
+DEFAULT_TIMEOUT = 25
+MAX_TIMEOUT = 60
+STREAM_DURATION = 180
+# Re-read the row this often in case the change happened in another process
+RECHECK_INTERVAL = 5
+HEARTBEAT_INTERVAL = 15
+
+
+def _authenticate(request):
+    try:
+        return JWTAuthentication().authenticate(request) is not None
+    except AuthenticationFailed:
+        return False
+
+
+def _load(checkout_id=None, pk=None):
+    qs = MpesaTransaction.objects.all()
+    if pk is not None:
+        txn = qs.filter(pk=pk).first()
+    else:
+        txn = qs.filter(Q(checkout_request_id=checkout_id) | Q(reference=checkout_id)).first()
+    return txn, (MpesaTransactionSerializer(txn).data if txn else None)
+
+
+async def _changes(txn_id, deadline):
+    """
+    Yield the serialized transaction once subscribed, then again every time it
+    may have changed, until ``deadline``.
+    """
+    with broker.subscribe(mpesa_channel(txn_id)) as sub:
+        while True:
+            _, data = await sync_to_async(_load)(pk=txn_id)
+            yield data
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return
+            await sub.get(min(remaining, RECHECK_INTERVAL))
+
+
+async def payment_events(request, checkout_id):
+    if request.method != 'GET':
+        return JsonResponse({'detail': 'Method not allowed'}, status=405)
+    if not await sync_to_async(_authenticate)(request):
+        return JsonResponse({'detail': 'Authentication credentials were not provided.'}, status=401)
+
+    txn, data = await sync_to_async(_load)(checkout_id=checkout_id)
+    if txn is None:
+        return JsonResponse({'error': 'Transaction not found'}, status=404)
+
+    if 'text/event-stream' in request.headers.get('Accept', ''):
+        response = StreamingHttpResponse(_event_stream(txn.pk, data), content_type='text/event-stream')
+        response['Cache-Control'] = 'no-cache'
+        response['X-Accel-Buffering'] = 'no'
+        return response
+
+    if data['status'] in RESOLVED:
+        return JsonResponse(data)
+    try:
+        timeout = min(float(request.GET.get('timeout', DEFAULT_TIMEOUT)), MAX_TIMEOUT)
+    except ValueError:
+        timeout = DEFAULT_TIMEOUT
+    async with aclosing(_changes(txn.pk, time.monotonic() + timeout)) as changes:
+        async for data in changes:
+            if data is None or data['status'] in RESOLVED:
+                break
+    if data is None:
+        return JsonResponse({'error': 'Transaction not found'}, status=404)
+    return JsonResponse(data)
+
+
+async def _event_stream(txn_id, data):
+    def event(payload):
+        return f"event: status\ndata: {json.dumps(payload, default=str)}\n\n"
+
+    yield event(data)
+    if data['status'] in RESOLVED:
+        return
+    last_sent = time.monotonic()
+    last_status = data['status']
+    async with aclosing(_changes(txn_id, time.monotonic() + STREAM_DURATION)) as changes:
+        async for data in changes:
+            if data is None:
+                return
+            if data['status'] != last_status:
+                last_status = data['status']
+                last_sent = time.monotonic()
+                yield event(data)
+                if last_status in RESOLVED:
+                    return
+            elif time.monotonic() - last_sent >= HEARTBEAT_INTERVAL:
+                last_sent = time.monotonic()
+                yield ": keepalive\n\n"
@@ -1,3 +1,1241 @@
-from django.test import TestCase
+import asyncio
+import csv
+import io
+import json
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date, timedelta
+from decimal import Decimal
+from unittest import mock, skipUnless
 
-# Create your tests here.
+from asgiref.sync import sync_to_async
+from django.contrib.auth.models import User
+from django.core.exceptions import ImproperlyConfigured
+from django.db import IntegrityError, connection
+from django.db.models import Max, QuerySet
+from django.test import TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from django.utils.http import http_date
+import requests
+from rest_framework.test import APIClient
+from rest_framework_simplejwt.tokens import AccessToken
+
+from . import forecasting, inventory, metrics, mpesa, receipts, rollups, streams
+from .analytics import numpy_available
+from .events import broker, mpesa_channel
+from .management.commands.mpesa_dispatch_worker import Command as DispatchWorker
+from .metrics import registry
+from .models import (
+    Category, DailySalesSummary, DemandForecast, Medicine, MpesaCallback, MpesaTransaction, Sale, SaleItem,
+    StockMovement,
+)
+from .pagination import KeysetPagination
+from .receipts import ReceiptNumberAllocator
+from .reconcile import RateLimiter, Reconciler, SingleFlight
+from .search import barcode_cache, medicine_index
+from .serializers import MedicineSerializer
+
+
+class QueryCountMixin:
+    """
+    Helpers for catching N+1 regressions on list endpoints.
+
+    ``assertConstantQueries`` requests an endpoint, lets the test add more rows,
+    requests it again and fails if the number of queries grew.
+    """
+
+    def count_queries(self, url):
+        with CaptureQueriesContext(connection) as ctx:
+            response = self.client.get(url)
+        self.assertEqual(response.status_code, 200, response.content)
+        return len(ctx.captured_queries)
+
+    def assertConstantQueries(self, url, add_rows, max_queries=None):
+        before = self.count_queries(url)
+        add_rows()
+        after = self.count_queries(url)
+        self.assertEqual(before, after, f"{url} went from {before} to {after} queries (N+1?)")
+        if max_queries is not None:
+            self.assertLessEqual(after, max_queries, f"{url} made {after} queries")
+
+
+class ListEndpointQueryTests(QueryCountMixin, TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username='cashier', first_name='Jane')
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+        self.rows = 0
+
+    def add_catalogue(self, n=3):
+        for _ in range(n):
+            self.rows += 1
+            category = Category.objects.create(name=f"Category {self.rows}")
+            Medicine.objects.create(
+                name=f"Paracetamol {self.rows}", category=category, barcode=f"BC{self.rows}",
+                price=Decimal('10.00'), stock_quantity=50,
+            )
+        medicine_index.build()
+
+    def add_sales(self, n=3):
+        medicines = list(Medicine.objects.all())
+        for _ in range(n):
+            sale = Sale.objects.create(cashier=self.user, payment_method='cash', status='completed')
+            for med in medicines:
+                SaleItem.objects.create(sale=sale, medicine=med, quantity=1, unit_price=med.price)
+
+    def test_category_list(self):
+        self.add_catalogue()
+        self.assertConstantQueries('/api/categories/', self.add_catalogue, max_queries=2)
+
+    def test_category_list_medicine_count(self):
+        self.add_catalogue(1)
+        category = Category.objects.get()
+        Medicine.objects.create(name="Inactive", category=category, price=1, is_active=False)
+        response = self.client.get('/api/categories/')
+        self.assertEqual(response.json()['results'][0]['medicine_count'], 1)
+
+    def test_medicine_list(self):
+        self.add_catalogue()
+        self.assertConstantQueries('/api/medicines/', self.add_catalogue, max_queries=2)
+
+    def test_pos_search(self):
+        self.add_catalogue()
+        self.assertConstantQueries('/api/medicines/pos_search/?q=para', self.add_catalogue, max_queries=1)
+
+    def test_pos_search_fills_page_past_out_of_stock_hits(self):
+        # The best-ranked 70 hits are sold out; the page still fills from further down
+        Medicine.objects.bulk_create(
+            [Medicine(name=f"Paracetamol {i:03d}", price=Decimal('10.00')) for i in range(70)]
+            + [Medicine(name=f"Paracetamol X{i:02d}", price=Decimal('10.00'), stock_quantity=5) for i in range(25)]
+        )
+        medicine_index.build()
+        response = self.client.get('/api/medicines/pos_search/?q=para')
+        self.assertEqual([m['name'] for m in response.data], [f"Paracetamol X{i:02d}" for i in range(20)])
+
+    def test_sales_list(self):
+        self.add_catalogue()
+        self.add_sales()
+        self.assertConstantQueries('/api/sales/', self.add_sales, max_queries=3)
+
+    def test_sales_list_keyset(self):
+        self.add_catalogue()
+        self.add_sales()
+        # No COUNT(*): one page query plus the items prefetch
+        self.assertConstantQueries('/api/sales/?pagination=keyset', self.add_sales, max_queries=2)
+
+    def test_medicine_list_not_modified(self):
+        self.add_catalogue()
+        etag = self.client.get('/api/medicines/')['ETag']
+        with CaptureQueriesContext(connection) as ctx:
+            response = self.client.get('/api/medicines/', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(len(ctx.captured_queries), 1)
+        Medicine.objects.filter(pk=Medicine.objects.first().pk).update(stock_quantity=1, updated_at=timezone.now())
+        self.assertEqual(self.client.get('/api/medicines/', HTTP_IF_NONE_MATCH=etag).status_code, 200)
+
+
+class CheckoutBatchTests(TestCase):
+    def setUp(self):
+        self.client = APIClient()
+        self.client.force_authenticate(User.objects.create_user(username='cashier'))
+        self.medicine = Medicine.objects.create(name='Amoxicillin', price=Decimal('10.00'))
+
+    def test_checkout_drains_earliest_expiry_first(self):
+        late = inventory.receive(self.medicine.pk, 10, 'LATE', date(2031, 6, 1))
+        early = inventory.receive(self.medicine.pk, 5, 'EARLY', date(2031, 1, 1))
+        response = self.client.post('/api/sales/', {
+            'payment_method': 'cash',
+            'items': [{'medicine_id': self.medicine.pk, 'quantity': 7, 'unit_price': '10.00'}],
+        }, format='json')
+        self.assertEqual(response.status_code, 201, response.content)
+        early.refresh_from_db()
+        late.refresh_from_db()
+        self.medicine.refresh_from_db()
+        self.assertEqual((early.quantity, late.quantity), (0, 8))
+        self.assertEqual(self.medicine.stock_quantity, 8)
+        self.assertEqual(self.medicine.expiry_date, date(2031, 6, 1))
+
+    def test_ledger_and_snapshot_agree_with_stock(self):
+        inventory.receive(self.medicine.pk, 10, 'LOT', date(2031, 1, 1))
+        response = self.client.post('/api/sales/', {
+            'payment_method': 'cash',
+            'items': [{'medicine_id': self.medicine.pk, 'quantity': 4, 'unit_price': '10.00'}],
+        }, format='json')
+        sold_at = timezone.now()
+        inventory.snapshot(now=sold_at + inventory.SNAPSHOT_SETTLE)
+        self.client.post(f"/api/sales/{response.data['id']}/refund/")
+        self.medicine.refresh_from_db()
+        self.assertEqual(self.medicine.stock_quantity, 10)
+        self.assertEqual(inventory.stock_at(self.medicine.pk, sold_at), 6)
+        self.assertEqual(inventory.stock_at(self.medicine.pk, timezone.now()), 10)
+
+    def test_snapshot_folds_only_the_ledger_tail(self):
+        other = Medicine.objects.create(name='Ibuprofen', price=Decimal('5.00'))
+        inventory.receive(self.medicine.pk, 10, 'LOT', date(2031, 1, 1))
+        inventory.receive(other.pk, 4, 'LOT', date(2031, 1, 1))
+        later = timezone.now() + inventory.SNAPSHOT_SETTLE
+        self.assertEqual(inventory.snapshot(now=later), 2)
+        self.assertEqual(inventory.snapshot(now=later), 0)
+        mark = StockMovement.objects.aggregate(top=Max('id'))['top']
+        inventory.adjust(self.medicine.pk, -3)
+        with CaptureQueriesContext(connection) as ctx:
+            self.assertEqual(inventory.snapshot(now=timezone.now() + inventory.SNAPSHOT_SETTLE), 1)
+        # Only the ledger after the previous high-water mark is read
+        fold = next(query['sql'] for query in ctx.captured_queries if 'SUM(' in query['sql'])
+        self.assertIn(f'"pharmacy_app_stockmovement"."id" > {mark}', fold)
+        self.assertEqual(self.medicine.snapshots.order_by('-movement_id').first().quantity, 7)
+        self.assertEqual(other.snapshots.order_by('-movement_id').first().quantity, 4)
+
+    def test_form_edit_counts_against_current_stock(self):
+        inventory.receive(self.medicine.pk, 10, 'LOT', date(2031, 1, 1))
+        form = Medicine.objects.get(pk=self.medicine.pk)
+        self.client.post('/api/sales/', {
+            'payment_method': 'cash',
+            'items': [{'medicine_id': self.medicine.pk, 'quantity': 3, 'unit_price': '10.00'}],
+        }, format='json')
+        # A stale form that does not touch stock leaves the sale alone
+        serializer = MedicineSerializer(form, data={'name': 'Amoxil'}, partial=True)
+        serializer.is_valid(raise_exception=True)
+        serializer.save()
+        self.medicine.refresh_from_db()
+        self.assertEqual((self.medicine.name, self.medicine.stock_quantity), ('Amoxil', 7))
+        # A count typed into it is booked as the difference from the locked row
+        serializer = MedicineSerializer(form, data={'stock_quantity': 5}, partial=True)
+        serializer.is_valid(raise_exception=True)
+        serializer.save()
+        self.medicine.refresh_from_db()
+        self.assertEqual(self.medicine.stock_quantity, 5)
+        self.assertEqual(self.medicine.movements.filter(kind='adjustment').get().quantity, -2)
+
+    def test_batch_reports_duplicate_only_when_ref_is_stored(self):
+        user = User.objects.get(username='cashier')
+
+        def concurrent_upload(cashier, data, client_ref):
+            # 'first' lands while 'second' is in flight under the same ref
+            if client_ref == 'first':
+                return Sale.objects.create(cashier=user, payment_method='cash', client_ref='second'), None
+            raise IntegrityError('UNIQUE constraint failed')
+
+        sale = {'payment_method': 'cash', 'items': [{'medicine_id': self.medicine.pk, 'quantity': 1, 'unit_price': '10.00'}]}
+        with mock.patch('pharmacy_app.views.checkout', side_effect=concurrent_upload):
+            response = self.client.post('/api/sales/batch/', {
+                'sales': [{**sale, 'client_ref': ref} for ref in ('first', 'second', 'third')],
+            }, format='json')
+        self.assertEqual(response.status_code, 200, response.content)
+        self.assertEqual([r['status'] for r in response.data['results']], ['created', 'duplicate', 'rejected'])
+
+
+@skipUnless(numpy_available(), "analytics needs numpy")
+class SalesAnalyticsTests(TestCase):
+    def test_margin_velocity_and_abc(self):
+        user = User.objects.create_user(username='manager', is_staff=True)
+        client = APIClient()
+        client.force_authenticate(user)
+        fast = Medicine.objects.create(name='Fast', price=Decimal('10.00'), cost_price=Decimal('6.00'))
+        slow = Medicine.objects.create(name='Slow', price=Decimal('10.00'), cost_price=Decimal('2.00'))
+        sale = Sale.objects.create(cashier=user, payment_method='cash', status='completed')
+        SaleItem.objects.create(sale=sale, medicine=fast, quantity=90, unit_price=fast.price)
+        SaleItem.objects.create(sale=sale, medicine=slow, quantity=3, unit_price=slow.price)
+
+        response = client.get('/api/sales/analytics/', {'date_from': timezone.localdate() - timedelta(days=2)})
+        self.assertEqual(response.status_code, 200, response.content)
+        first, second = response.data['results']
+        self.assertEqual((first['name'], first['abc_class'], first['gross_margin']), ('Fast', 'A', 360.0))
+        self.assertEqual(first['units_per_day'], 30.0)
+        self.assertEqual((second['name'], second['margin_pct']), ('Slow', 80.0))
+        self.assertEqual(response.data['totals']['revenue'], 930.0)
+        for params in ({'date_from': 'last week'}, {'date_to': '2026-02-30'}):
+            self.assertEqual(client.get('/api/sales/analytics/', params).status_code, 400, params)
+
+
+@skipUnless(forecasting.numpy_available(), "forecasting needs numpy")
+class ForecastTests(TestCase):
+    def test_refresh_sets_reorder_point_incrementally(self):
+        user = User.objects.create_user(username='cashier')
+        fast = Medicine.objects.create(name='Fast', barcode='FAST', price=Decimal('10.00'), stock_quantity=20, reorder_level=5)
+        for days_ago in range(1, 11):
+            sale = Sale.objects.create(cashier=user, payment_method='cash', status='completed')
+            Sale.objects.filter(pk=sale.pk).update(created_at=timezone.now() - timedelta(days=days_ago))
+            SaleItem.objects.create(sale=sale, medicine=fast, quantity=9, unit_price=fast.price)
+
+        barcode_cache.get('FAST')
+        with self.captureOnCommitCallbacks(execute=True):
+            self.assertEqual(forecasting.refresh(window=10, lead_time=2, z=0, cover_days=5), 1)
+        fast.refresh_from_db()
+        # Stamped when the chunk was written, not when the run started
+        self.assertGreater(fast.updated_at, fast.forecast.computed_at)
+        self.assertEqual((fast.reorder_point, fast.order_quantity), (18, 45))
+        self.assertEqual(barcode_cache.get('FAST').reorder_point, 18)
+        self.assertFalse(fast.is_low_stock)
+        # Nothing sold since the last run: nothing to recompute
+        self.assertEqual(forecasting.refresh(window=10, lead_time=2, z=0, cover_days=5), 0)
+        # A refund adds no SaleItem but still changes demand
+        sale.refresh_from_db()
+        sale.status = 'refunded'
+        sale.save()
+        self.assertEqual(forecasting.refresh(window=10, lead_time=2, z=0, cover_days=5), 1)
+        # Sold today: outside the window, so left for tomorrow's run
+        today = Sale.objects.create(cashier=user, payment_method='cash', status='completed')
+        SaleItem.objects.create(sale=today, medicine=fast, quantity=1, unit_price=fast.price)
+        self.assertEqual(forecasting.refresh(window=10, lead_time=2, z=0, cover_days=5), 0)
+        tomorrow = timezone.localdate() + timedelta(days=1)
+        self.assertEqual(forecasting.refresh(window=10, lead_time=2, z=0, cover_days=5, today=tomorrow), 1)
+        # Every sale aged out: back to reorder_level, not a reorder point of 0
+        later = timezone.localdate() + timedelta(days=30)
+        self.assertEqual(forecasting.refresh(full=True, window=10, today=later), 1)
+        fast.refresh_from_db()
+        self.assertEqual((fast.reorder_point, fast.order_quantity), (None, None))
+        self.assertFalse(DemandForecast.objects.exists())
+        # The mark outlives the forecasts: nothing new, nothing rescanned
+        self.assertEqual(forecasting.refresh(window=10, today=later), 0)
+
+
+class StockAdjustmentTests(QueryCountMixin, TestCase):
+    url = '/api/medicines/adjust-stock/'
+
+    def setUp(self):
+        self.user = User.objects.create_user(username='storekeeper')
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+        self.medicine = Medicine.objects.create(name='Amoxicillin', barcode='AMX', price=Decimal('10.00'))
+
+    def adjust(self, *lines):
+        response = self.client.post(self.url, {'lines': list(lines)}, format='json')
+        self.assertEqual(response.status_code, 200, response.content)
+        return response.data['results']
+
+    def assertBatchesMatchStock(self, medicine):
+        medicine.refresh_from_db()
+        in_batches = sum(medicine.batches.values_list('quantity', flat=True))
+        in_ledger = sum(medicine.movements.values_list('quantity', flat=True))
+        self.assertEqual((in_batches, in_ledger), (medicine.stock_quantity, medicine.stock_quantity))
+
+    def test_lines_by_id_and_barcode(self):
+        received, removed, unknown_code, unknown_id = self.adjust(
+            {'barcode': ' AMX ', 'delta': 10, 'lot_number': 'L1', 'expiry_date': '2031-03-01', 'cost_price': '4.50'},
+            {'medicine_id': self.medicine.pk, 'delta': -15},
+            {'barcode': 'NOPE', 'delta': 5},
+            {'medicine_id': 999999, 'delta': 5},
+        )
+        batch = self.medicine.batches.get()
+        self.assertEqual((received['status'], received['batch_id']), ('applied', batch.pk))
+        self.assertEqual((batch.lot_number, batch.expiry_date, batch.cost_price), ('L1', date(2031, 3, 1), Decimal('4.50')))
+        self.assertEqual((removed['status'], removed['applied'], removed['stock_quantity']), ('clamped', -10, 0))
+        self.assertEqual((unknown_code['status'], unknown_id['status']), ('not_found', 'not_found'))
+        self.assertBatchesMatchStock(self.medicine)
+
+    def test_query_count_does_not_grow_with_lines(self):
+        def note(n):
+            medicines = [
+                Medicine.objects.create(name=f'Med {i}', barcode=f'Q{n}-{i}', price=Decimal('10.00'), stock_quantity=5)
+                for i in range(n)
+            ]
+            lines = []
+            for medicine in medicines:
+                lines += [
+                    {'barcode': medicine.barcode, 'delta': 10, 'lot_number': 'GRN', 'expiry_date': '2031-01-01'},
+                    {'medicine_id': medicine.pk, 'delta': -3},
+                    {'medicine_id': medicine.pk, 'delta': 2},
+                ]
+            with CaptureQueriesContext(connection) as ctx:
+                self.adjust(*lines)
+            return len(ctx.captured_queries)
+
+        self.assertEqual(note(2), note(20))
+
+    def test_receive_and_remove_in_one_note(self):
+        self.adjust(
+            {'medicine_id': self.medicine.pk, 'delta': 10, 'lot_number': 'A'},
+            {'medicine_id': self.medicine.pk, 'delta': -10},
+        )
+        self.assertEqual(self.medicine.batches.get().quantity, 0)
+        self.assertFalse(self.medicine.movements.filter(batch__isnull=True).exists())
+        self.assertBatchesMatchStock(self.medicine)
+
+    def test_conflict_is_409(self):
+        inventory.receive(self.medicine.pk, 10, 'LOT', date(2031, 1, 1))
+        with mock.patch('pharmacy_app.inventory.allocate', return_value=None):
+            update_stock = self.client.patch(f'/api/medicines/{self.medicine.pk}/update_stock/', {'quantity': -2}, format='json')
+            form = self.client.patch(f'/api/medicines/{self.medicine.pk}/', {'stock_quantity': 4}, format='json')
+        self.assertEqual((update_stock.status_code, form.status_code), (409, 409))
+        self.assertBatchesMatchStock(self.medicine)
+        self.assertEqual(self.medicine.stock_quantity, 10)
+
+    def test_update_stock_rejects_bad_lot_details(self):
+        url = f'/api/medicines/{self.medicine.pk}/update_stock/'
+        for body in ({}, {'quantity': 'ten'},
+                     {'quantity': 5, 'lot_number': 'L1', 'expiry_date': '2031-02-30'},
+                     {'quantity': 5, 'lot_number': 'L1', 'cost_price': 'cheap'}):
+            self.assertEqual(self.client.patch(url, body, format='json').status_code, 400, body)
+        self.assertFalse(self.medicine.batches.exists())
+        response = self.client.patch(url, {'quantity': 5, 'lot_number': 'L1', 'expiry_date': '2031-02-28'}, format='json')
+        self.assertEqual(response.data['expiry_date'], '2031-02-28')
+
+
+class InlinePool:
+    """ThreadPoolExecutor stand-in that maps on the calling thread, so work stays on the test's connection"""
+
+    def __init__(self, max_workers=None):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def map(self, fn, items):
+        return map(fn, items)
+
+
+class MpesaMixin:
+    """A cashier and pending M-Pesa sales; Daraja itself is always a mock"""
+
+    def setUp(self):
+        self.cashier = User.objects.create_user(username='cashier')
+        self.client = APIClient()
+        self.client.force_authenticate(self.cashier)
+        self.daraja = mock.Mock()
+
+    def pending(self, age=60, **fields):
+        sale = Sale.objects.create(cashier=self.cashier, payment_method='mpesa', status='pending')
+        fields.setdefault('checkout_request_id', f'ws_CO_{sale.pk}')
+        txn = MpesaTransaction.objects.create(sale=sale, phone_number='254700000000', amount=Decimal('100'), **fields)
+        MpesaTransaction.objects.filter(pk=txn.pk).update(
+            created_at=timezone.now() - timedelta(seconds=age), updated_at=timezone.now() - timedelta(seconds=age),
+        )
+        txn.refresh_from_db()
+        return txn
+
+    def queued(self, age=60):
+        """An async push the view has stored but nobody has sent yet"""
+        reference = f'LOCAL-{MpesaTransaction.objects.count()}'
+        return self.pending(age=age, checkout_request_id=reference, reference=reference)
+
+
+class TokenCacheTests(TestCase):
+    def setUp(self):
+        self.fetches = []
+        self.tokens = mpesa.TokenCache(self.fetch)
+        self.tokens.cache.clear()
+
+    def fetch(self, delay=0.1):
+        self.fetches.append(1)
+        time.sleep(delay)
+        return f'token-{len(self.fetches)}', 3599
+
+    def store(self, token, expires_in):
+        self.tokens.cache.set(self.tokens.KEY, {'token': token, 'expires_at': time.time() + expires_in})
+
+    def test_concurrent_callers_share_one_refresh(self):
+        with ThreadPoolExecutor(max_workers=8) as pool:
+            tokens = list(pool.map(lambda _: self.tokens.get(), range(8)))
+        self.assertEqual((len(self.fetches), set(tokens)), (1, {'token-1'}))
+        self.assertEqual(self.tokens.get(), 'token-1')
+
+    def test_waits_for_a_refresh_running_in_another_process(self):
+        self.store('old', 10)   # inside the expiry margin: unusable
+        self.tokens.cache.add(self.tokens.LOCK_KEY, 1)
+
+        def other_process():
+            time.sleep(0.1)
+            self.store('theirs', 3599)
+            self.tokens.cache.delete(self.tokens.LOCK_KEY)
+
+        threading.Thread(target=other_process).start()
+        self.assertEqual(self.tokens.get(), 'theirs')
+        self.assertEqual(self.fetches, [])
+
+    def test_token_near_expiry_is_refreshed_in_the_background(self):
+        self.store('old', self.tokens.REFRESH_AHEAD - 100)
+        self.assertEqual(self.tokens.get(), 'old')   # still valid: no waiting
+        # Let the background refresh finish, lock release included, before the next test
+        self.assertTrue(self.tokens._background.acquire(timeout=5))
+        self.tokens._background.release()
+        self.assertEqual((self.tokens.get(), len(self.fetches)), ('token-1', 1))
+
+
+class MpesaDispatchTests(MpesaMixin, TestCase):
+    accepted = {'ResponseCode': '0', 'CheckoutRequestID': 'ws_CO_1', 'MerchantRequestID': 'mr_1'}
+
+    def test_async_push_is_queued_and_sent_once(self):
+        sale = Sale.objects.create(cashier=self.cashier, payment_method='mpesa', status='pending')
+        with mock.patch('pharmacy_app.views.DISPATCH_MODE', 'async'), \
+                mock.patch('pharmacy_app.views.queue_stk_push') as queue:
+            response = self.client.post('/api/mpesa/stk-push/', {
+                'phone_number': '0700000000', 'amount': '100', 'sale_id': sale.pk,
+            }, format='json')
+        self.assertEqual(response.status_code, 202, response.content)
+        txn = MpesaTransaction.objects.get(reference=response.data['reference'])
+        self.assertEqual((txn.checkout_request_id, txn.phone_number, txn.dispatched_at), (txn.reference, '254700000000', None))
+        queue.assert_called_once_with(txn.pk)
+
+        self.daraja.stk_push.return_value = self.accepted
+        with mock.patch('pharmacy_app.mpesa.mpesa_service', self.daraja):
+            self.assertTrue(mpesa.dispatch_stk_push(txn.pk))
+            # Already claimed: a second sender backs off
+            self.assertFalse(mpesa.dispatch_stk_push(txn.pk))
+        self.daraja.stk_push.assert_called_once()
+        txn.refresh_from_db()
+        self.assertEqual((txn.checkout_request_id, txn.merchant_request_id, txn.status), ('ws_CO_1', 'mr_1', 'pending'))
+        self.assertIsNotNone(txn.dispatched_at)
+        # Polling by the reference handed out before Daraja answered still finds it
+        self.assertEqual(self.client.get(f'/api/mpesa/status/{txn.reference}/').data['checkout_request_id'], 'ws_CO_1')
+
+    def test_rejected_or_crashed_push_fails_the_transaction(self):
+        rejected, crashed = self.queued(), self.queued()
+        self.daraja.stk_push.side_effect = [
+            {'ResponseCode': '1', 'errorMessage': 'Invalid PhoneNumber'},
+            requests.ConnectionError('connection reset'),
+        ]
+        with mock.patch('pharmacy_app.mpesa.mpesa_service', self.daraja), self.assertLogs('pharmacy_app.mpesa', 'ERROR'):
+            mpesa.dispatch_stk_push(rejected.pk)
+            mpesa.dispatch_stk_push(crashed.pk)
+        rejected.refresh_from_db()
+        crashed.refresh_from_db()
+        self.assertEqual((rejected.status, rejected.result_description), ('failed', 'Invalid PhoneNumber'))
+        self.assertEqual((crashed.status, crashed.result_description), ('failed', 'connection reset'))
+
+    def test_sweeper_sends_pushes_left_behind(self):
+        left_behind, fresh = self.queued(age=60), self.queued(age=0)
+        sent = self.pending()   # synchronous push, nothing to send
+        self.daraja.stk_push.return_value = self.accepted
+        with mock.patch('pharmacy_app.mpesa.mpesa_service', self.daraja):
+            swept = DispatchWorker()._sweep(InlinePool(), grace=5, batch_size=100)
+        self.assertEqual(swept, 1)
+        self.daraja.stk_push.assert_called_once()
+        left_behind.refresh_from_db()
+        fresh.refresh_from_db()
+        self.assertEqual((left_behind.checkout_request_id, fresh.dispatched_at), ('ws_CO_1', None))
+        self.assertEqual(MpesaTransaction.objects.get(pk=sent.pk).checkout_request_id, sent.checkout_request_id)
+
+
+class PaymentEventsTests(MpesaMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        self.auth = {'Authorization': f'Bearer {AccessToken.for_user(self.cashier)}'}
+        self.txn = self.pending()
+        self.url = f'/api/mpesa/events/{self.txn.checkout_request_id}/'
+
+    async def resolve_soon(self, status='success'):
+        await asyncio.sleep(0.05)
+        await sync_to_async(MpesaTransaction.objects.filter(pk=self.txn.pk).update)(status=status)
+        broker.publish(mpesa_channel(self.txn.pk), {'status': status})
+
+    def test_needs_a_jwt_and_a_known_transaction(self):
+        self.assertEqual(self.client.get(self.url).status_code, 401)
+        self.assertEqual(self.client.get('/api/mpesa/events/ws_CO_unknown/', headers=self.auth).status_code, 404)
+
+    def test_long_poll_returns_resolved_or_times_out(self):
+        response = self.client.get(self.url, {'timeout': 0.05}, headers=self.auth)
+        self.assertEqual(response.json()['status'], 'pending')
+        MpesaTransaction.objects.filter(pk=self.txn.pk).update(status='cancelled')
+        started = time.monotonic()
+        response = self.client.get(self.url, {'timeout': 30}, headers=self.auth)
+        self.assertEqual(response.json()['status'], 'cancelled')
+        self.assertLess(time.monotonic() - started, 1)
+
+    async def test_long_poll_wakes_on_published_change(self):
+        waker = asyncio.ensure_future(self.resolve_soon())
+        started = time.monotonic()
+        response = await self.async_client.get(self.url, {'timeout': 30}, headers=self.auth)
+        await waker
+        self.assertEqual(response.json()['status'], 'success')
+        self.assertLess(time.monotonic() - started, streams.RECHECK_INTERVAL)
+
+    async def test_event_stream_ends_once_resolved(self):
+        response = await self.async_client.get(self.url, headers={**self.auth, 'Accept': 'text/event-stream'})
+        self.assertEqual(response['Content-Type'], 'text/event-stream')
+        waker = asyncio.ensure_future(self.resolve_soon('failed'))
+        events = [chunk async for chunk in response.streaming_content]
+        await waker
+        statuses = [json.loads(event.decode().split('data: ')[1])['status'] for event in events]
+        self.assertEqual(statuses, ['pending', 'failed'])
+
+
+class MpesaCallbackTests(MpesaMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        # Applied explicitly below instead of on a background thread
+        patcher = mock.patch('pharmacy_app.views.schedule_callback_apply')
+        self.scheduled = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def callback(self, checkout_id, result_code=0, receipt='QHX123'):
+        body = {'CheckoutRequestID': checkout_id, 'ResultCode': result_code, 'ResultDesc': 'Result'}
+        if result_code == 0:
+            body['CallbackMetadata'] = {'Item': [{'Name': 'MpesaReceiptNumber', 'Value': receipt}]}
+        response = self.client.post('/api/mpesa/callback/', {'Body': {'stkCallback': body}}, format='json')
+        self.assertEqual(response.data['ResultCode'], 0)
+        return response
+
+    def test_repeated_callback_is_journalled_and_applied_once(self):
+        txn = self.pending()
+        self.callback(txn.checkout_request_id)
+        self.callback(txn.checkout_request_id)
+        self.assertEqual(MpesaCallback.objects.count(), 1)
+        self.assertEqual(self.scheduled.call_count, 2)
+
+        self.assertEqual(mpesa.apply_callbacks(), 1)
+        self.assertEqual(mpesa.apply_callbacks(), 0)
+        txn.refresh_from_db()
+        self.assertEqual((txn.status, txn.mpesa_receipt_number, txn.sale.status), ('success', 'QHX123', 'completed'))
+        self.assertEqual(MpesaCallback.objects.get().outcome, 'applied')
+
+    def test_callback_that_beats_its_transaction_is_applied_later(self):
+        txn = self.queued()
+        self.callback('ws_CO_early', result_code=1032)
+        self.callback('ws_CO_nobody')
+        mpesa.apply_callbacks()
+        self.assertFalse(MpesaCallback.objects.filter(applied_at__isnull=False).exists())
+
+        # The dispatcher stores Daraja's id; the journalled result now matches
+        MpesaTransaction.objects.filter(pk=txn.pk).update(checkout_request_id='ws_CO_early')
+        MpesaCallback.objects.filter(checkout_request_id='ws_CO_nobody').update(
+            received_at=timezone.now() - mpesa.UNMATCHED_GRACE,
+        )
+        mpesa.apply_callbacks()
+        outcomes = dict(MpesaCallback.objects.values_list('checkout_request_id', 'outcome'))
+        self.assertEqual(outcomes, {'ws_CO_early': 'applied', 'ws_CO_nobody': 'unmatched'})
+        self.assertEqual(MpesaTransaction.objects.get(pk=txn.pk).status, 'cancelled')
+
+    def test_first_resolution_wins(self):
+        txn = self.pending()
+        # The reconciler got there first; the late callback must not overwrite it
+        self.assertTrue(mpesa.resolve_transaction(txn.pk, 'timeout', '', 'No result'))
+        self.assertFalse(mpesa.resolve_transaction(txn.pk, 'success', '0', 'Paid', 'QHX123'))
+        self.callback(txn.checkout_request_id)
+        mpesa.apply_callbacks()
+        txn.refresh_from_db()
+        self.assertEqual((txn.status, txn.mpesa_receipt_number, txn.sale.status), ('timeout', '', 'pending'))
+        self.assertEqual(MpesaCallback.objects.get().outcome, 'ignored')
+
+    def test_payload_without_checkout_id_is_acknowledged_but_dropped(self):
+        self.client.post('/api/mpesa/callback/', {'Body': {}}, format='json')
+        self.assertFalse(MpesaCallback.objects.exists())
+        self.scheduled.assert_not_called()
+
+    def test_waiting_callback_schedules_a_retry(self):
+        self.callback('ws_CO_early')
+        with mock.patch('pharmacy_app.mpesa.close_old_connections'), mock.patch.object(mpesa, '_retry', None), \
+                mock.patch('pharmacy_app.mpesa.threading.Timer') as timer:
+            mpesa._apply_in_thread()
+            timer.assert_called_once_with(mpesa.CALLBACK_RETRY_DELAY, mpesa.schedule_callback_apply)
+            timer.return_value.start.assert_called_once_with()
+            # Once nothing is waiting, no further retry
+            MpesaCallback.objects.update(received_at=timezone.now() - mpesa.UNMATCHED_GRACE)
+            timer.return_value.is_alive.return_value = False
+            mpesa._apply_in_thread()
+            self.assertEqual(timer.call_count, 1)
+        self.assertEqual(MpesaCallback.objects.get().outcome, 'unmatched')
+
+
+class ReconcilerTests(MpesaMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        patcher = mock.patch('pharmacy_app.reconcile.ThreadPoolExecutor', InlinePool)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def reconciler(self, **options):
+        return Reconciler(service=self.daraja, **{'min_age': 0, 'stale_after': 900, **options})
+
+    def http_error(self, status, body=b'{}'):
+        response = requests.Response()
+        response.status_code = status
+        response._content = body
+        return requests.HTTPError(response=response)
+
+    def test_token_bucket_bursts_then_spaces_requests(self):
+        clock = [100.0]
+        waits = []
+
+        def sleep(seconds):
+            waits.append(round(seconds, 3))
+            clock[0] += seconds
+
+        with mock.patch('pharmacy_app.reconcile.time.monotonic', lambda: clock[0]), \
+                mock.patch('pharmacy_app.reconcile.time.sleep', sleep):
+            limiter = RateLimiter(rate=2, burst=2)
+            for _ in range(3):
+                limiter.acquire()
+            self.assertEqual(waits, [0.5])
+            # A 429 stops the whole bucket, then it refills from where it was
+            limiter.pause(10)
+            limiter.acquire()
+            self.assertEqual(waits, [0.5, 10.0])
+
+    def test_concurrent_queries_for_one_checkout_are_coalesced(self):
+        flight = SingleFlight()
+        release = threading.Event()
+        calls = []
+
+        def query():
+            calls.append(1)
+            release.wait(5)
+            return {'ResultCode': '0'}
+
+        with ThreadPoolExecutor(max_workers=4) as pool:
+            futures = [pool.submit(flight.do, 'ws_CO_1', query) for _ in range(4)]
+            time.sleep(0.05)
+            release.set()
+            results = [future.result() for future in futures]
+        self.assertEqual((len(calls), results), (1, [{'ResultCode': '0'}] * 4))
+
+    def test_backs_off_until_daraja_has_a_result(self):
+        txn = self.pending()
+        reconciler = self.reconciler(base_backoff=15, max_backoff=600)
+        self.daraja.query_stk_status.side_effect = self.http_error(500, b'{"errorCode": "500.001.1001"}')
+        self.assertEqual(reconciler.run_once(), {'pending': 1})
+        txn.refresh_from_db()
+        self.assertEqual(txn.status_checks, 1)
+        self.assertAlmostEqual((txn.next_status_check_at - timezone.now()).total_seconds(), 15, delta=5)
+        # Not due yet: Daraja is not asked again
+        self.assertEqual(reconciler.run_once(), {})
+        self.assertEqual(self.daraja.query_stk_status.call_count, 1)
+
+        # The delay doubles per check and is capped
+        MpesaTransaction.objects.filter(pk=txn.pk).update(status_checks=9, next_status_check_at=timezone.now())
+        self.assertEqual(reconciler.run_once(), {'pending': 1})
+        txn.refresh_from_db()
+        self.assertAlmostEqual((txn.next_status_check_at - timezone.now()).total_seconds(), 600, delta=5)
+
+        MpesaTransaction.objects.filter(pk=txn.pk).update(next_status_check_at=timezone.now())
+        self.daraja.query_stk_status.side_effect = None
+        self.daraja.query_stk_status.return_value = {'ResultCode': '0', 'ResultDesc': 'Processed'}
+        self.assertEqual(reconciler.run_once(), {'success': 1})
+        txn.refresh_from_db()
+        self.assertEqual((txn.status, txn.sale.status, txn.next_status_check_at), ('success', 'completed', None))
+
+    def test_throttled_query_pauses_the_bucket(self):
+        self.pending()
+        reconciler = self.reconciler(base_backoff=15)
+        self.daraja.query_stk_status.side_effect = self.http_error(429)
+        with mock.patch.object(reconciler.limiter, 'pause') as pause:
+            self.assertEqual(reconciler.run_once(), {'pending': 1})
+        pause.assert_called_once_with(15)
+
+    def test_stale_row_gets_a_last_query_then_times_out(self):
+        answered, silent = self.pending(age=1000), self.pending(age=1000)
+        self.daraja.query_stk_status.side_effect = lambda checkout_id: (
+            {'ResultCode': 1032, 'ResultDesc': 'Cancelled by user'} if checkout_id == answered.checkout_request_id else {}
+        )
+        self.assertEqual(self.reconciler(stale_after=900).run_once(), {'cancelled': 1, 'timeout': 1})
+        self.assertEqual(MpesaTransaction.objects.get(pk=silent.pk).status, 'timeout')
+        self.assertEqual(MpesaTransaction.objects.get(pk=answered.pk).result_code, '1032')
+
+    def test_claimed_but_unsent_push_times_out(self):
+        # The sender claimed the row, then died before Daraja gave it a CheckoutRequestID
+        txn = self.pending(age=120, checkout_request_id='LOCAL-1', reference='LOCAL-1',
+                           dispatched_at=timezone.now() - timedelta(seconds=110))
+        self.assertEqual(self.reconciler(stale_after=900).run_once(), {})
+        self.assertEqual(self.reconciler(stale_after=60).run_once(), {'timeout': 1})
+        txn.refresh_from_db()
+        self.assertEqual(txn.status, 'timeout')
+        self.daraja.query_stk_status.assert_not_called()
+
+
+@override_settings(METRICS_SAMPLE_RATE=1.0, METRICS_TOKEN='scrape-token')
+class MetricsTests(TestCase):
+    def setUp(self):
+        registry.clear()
+        self.addCleanup(registry.clear)
+        self.cashier = User.objects.create_user(username='cashier')
+        self.manager = User.objects.create_user(username='manager', is_staff=True)
+
+    def bearer(self, user):
+        return {'Authorization': f'Bearer {AccessToken.for_user(user)}'}
+
+    def scrape(self):
+        response = self.client.get('/api/metrics/', headers={'Authorization': 'Bearer scrape-token'})
+        self.assertEqual(response.status_code, 200)
+        return response.content.decode().splitlines()
+
+    def test_requests_are_counted_by_endpoint_method_and_status(self):
+        self.client.get('/api/medicines/', headers=self.bearer(self.cashier))
+        self.client.get('/api/medicines/')
+        lines = self.scrape()
+        self.assertIn('pharmacy_requests_total{endpoint="medicine.list",method="GET",status="200"} 1', lines)
+        self.assertIn('pharmacy_requests_total{endpoint="medicine.list",method="GET",status="401"} 1', lines)
+
+    def test_sampled_request_fills_cumulative_buckets(self):
+        Medicine.objects.create(name='Panadol', price=Decimal('10.00'))
+        self.client.get('/api/medicines/', headers=self.bearer(self.cashier))
+        lines = self.scrape()
+        labels = 'endpoint="medicine.list",method="GET"'
+        buckets = [line for line in lines if line.startswith(f'pharmacy_request_sql_queries_bucket{{{labels},')]
+        self.assertEqual(len(buckets), len(metrics.QUERY_BUCKETS) + 1)
+        counts = [int(line.rsplit(' ', 1)[1]) for line in buckets]
+        self.assertEqual(counts, sorted(counts))
+        self.assertEqual(buckets[0], f'pharmacy_request_sql_queries_bucket{{{labels},le="0"}} 0')
+        self.assertEqual(buckets[-1], f'pharmacy_request_sql_queries_bucket{{{labels},le="+Inf"}} 1')
+        self.assertIn(f'pharmacy_request_duration_seconds_count{{{labels}}} 1', lines)
+
+    async def test_asgi_requests_count_their_queries(self):
+        headers = await sync_to_async(self.bearer)(self.cashier)
+        response = await self.async_client.get('/api/medicines/', headers=headers)
+        self.assertEqual(response.status_code, 200)
+        series = registry.samples[('medicine.list', 'GET')]
+        self.assertEqual(series['queries'].count, 1)
+        self.assertGreater(series['queries'].sum, 0)
+        self.assertGreater(series['sql_time'].sum, 0)
+
+    def test_unsampled_requests_are_only_counted(self):
+        with mock.patch('pharmacy_app.metrics.random.random', return_value=0.5), \
+                override_settings(METRICS_SAMPLE_RATE=0.1):
+            self.client.get('/api/medicines/', headers=self.bearer(self.cashier))
+        self.assertEqual(registry.requests, {('medicine.list', 'GET', '200'): 1})
+        self.assertEqual(registry.samples, {})
+
+    def test_scrape_needs_the_token_or_a_staff_jwt(self):
+        self.assertEqual(self.client.get('/api/metrics/').status_code, 401)
+        self.assertEqual(self.client.get('/api/metrics/', headers={'Authorization': 'Bearer wrong'}).status_code, 401)
+        self.assertEqual(self.client.get('/api/metrics/', headers=self.bearer(self.cashier)).status_code, 401)
+        self.assertEqual(self.client.get('/api/metrics/', headers=self.bearer(self.manager)).status_code, 200)
+        self.assertEqual(self.client.get('/api/metrics/', headers={'Authorization': 'Bearer scrape-token'}).status_code, 200)
+
+
+class CheckoutTests(TestCase):
+    def setUp(self):
+        self.client = APIClient()
+        self.client.force_authenticate(User.objects.create_user(username='cashier'))
+        self.medicine = Medicine.objects.create(name='Amoxicillin', price=Decimal('10.00'))
+        inventory.receive(self.medicine.pk, 5, 'LOT', date(2031, 1, 1))
+
+    def sell(self, *lines):
+        return self.client.post('/api/sales/', {
+            'payment_method': 'cash',
+            'items': [{'medicine_id': pk, 'quantity': qty, 'unit_price': '10.00'} for pk, qty in lines],
+        }, format='json')
+
+    def assertNothingSold(self):
+        self.medicine.refresh_from_db()
+        self.assertEqual(self.medicine.stock_quantity, 5)
+        self.assertFalse(Sale.objects.exists())
+        self.assertFalse(self.medicine.movements.filter(kind='sale').exists())
+
+    def test_insufficient_stock_is_a_400(self):
+        # Two lines for the same medicine are checked against stock together
+        response = self.sell((self.medicine.pk, 3), (self.medicine.pk, 3))
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.data['error'], 'Insufficient stock for Amoxicillin. Available: 5')
+        self.assertNothingSold()
+
+    def test_unknown_medicine_is_a_400(self):
+        response = self.sell((self.medicine.pk, 1), (self.medicine.pk + 100, 1))
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.data['error'], f'Medicine {self.medicine.pk + 100} not found')
+        self.assertNothingSold()
+
+    def test_stock_sold_after_the_check_is_a_409(self):
+        in_bulk = QuerySet.in_bulk
+
+        def racing_in_bulk(queryset, *args, **kwargs):
+            found = in_bulk(queryset, *args, **kwargs)
+            # Another till sells the stock between the check and the UPDATE,
+            # as it can where select_for_update() takes no row lock
+            Medicine.objects.filter(pk=self.medicine.pk).update(stock_quantity=1)
+            return found
+
+        with mock.patch.object(QuerySet, 'in_bulk', racing_in_bulk):
+            response = self.sell((self.medicine.pk, 4))
+        self.assertEqual(response.status_code, 409)
+        self.assertEqual(response.data['error'], 'Stock changed during checkout, please retry')
+        # The whole checkout rolled back, the racing write included
+        self.assertNothingSold()
+
+    def test_sale_decrements_stock_in_one_update(self):
+        other = Medicine.objects.create(name='Ibuprofen', price=Decimal('10.00'))
+        inventory.receive(other.pk, 5, 'LOT', date(2031, 1, 1))
+        with CaptureQueriesContext(connection) as ctx:
+            response = self.sell((self.medicine.pk, 2), (other.pk, 3))
+        self.assertEqual(response.status_code, 201, response.content)
+        updates = [q['sql'] for q in ctx.captured_queries if q['sql'].startswith('UPDATE "pharmacy_app_medicine"')]
+        self.assertEqual(len(updates), 1)
+        self.assertEqual(dict(Medicine.objects.values_list('name', 'stock_quantity')), {'Amoxicillin': 3, 'Ibuprofen': 2})
+
+
+class SalesRollupTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username='cashier')
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+        self.medicine = Medicine.objects.create(name='Amoxicillin', price=Decimal('10.00'))
+        inventory.receive(self.medicine.pk, 50, 'LOT', date(2031, 1, 1))
+
+    def sell(self, quantity, payment_method='cash'):
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.client.post('/api/sales/', {
+                'payment_method': payment_method,
+                'items': [{'medicine_id': self.medicine.pk, 'quantity': quantity, 'unit_price': '10.00'}],
+            }, format='json')
+        self.assertEqual(response.status_code, 201, response.content)
+        return Sale.objects.get(pk=response.data['id'])
+
+    def buckets(self):
+        return {
+            (row.payment_method, row.status): (row.sale_count, row.total_amount)
+            for row in DailySalesSummary.objects.filter(date=timezone.localdate()) if row.sale_count
+        }
+
+    def assertMatchesRebuild(self):
+        maintained = self.buckets()
+        rollups.rebuild()
+        self.assertEqual(maintained, self.buckets())
+        return maintained
+
+    def test_refund_moves_the_sale_to_the_refunded_bucket(self):
+        kept = self.sell(2)
+        refunded = self.sell(3)
+        with self.captureOnCommitCallbacks(execute=True):
+            self.assertEqual(self.client.post(f'/api/sales/{refunded.pk}/refund/').status_code, 200)
+        self.assertEqual(self.assertMatchesRebuild(), {
+            ('cash', 'completed'): (1, Decimal('20.00')),
+            ('cash', 'refunded'): (1, Decimal('30.00')),
+        })
+        stats = self.client.get('/api/sales/dashboard_stats/').data
+        self.assertEqual((stats['total_sales_today'], stats['total_transactions_today']), (float(kept.total_amount), 1))
+        self.assertEqual(stats['payment_breakdown']['cash'], 20.0)
+
+    def test_status_change_moves_the_sale_between_buckets(self):
+        self.sell(1)
+        sale = self.sell(4, payment_method='mpesa')
+        self.assertEqual(self.buckets()[('mpesa', 'pending')], (1, Decimal('40.00')))
+        with self.captureOnCommitCallbacks(execute=True):
+            sale.status = 'completed'
+            sale.save()
+        self.assertEqual(self.assertMatchesRebuild(), {
+            ('cash', 'completed'): (1, Decimal('10.00')),
+            ('mpesa', 'completed'): (1, Decimal('40.00')),
+        })
+        stats = self.client.get('/api/sales/dashboard_stats/').data
+        self.assertEqual((stats['total_sales_today'], stats['total_transactions_today']), (50.0, 2))
+        self.assertEqual(stats['sales_this_week'][-1], {'date': str(timezone.localdate()), 'total': 50.0})
+
+
+class StockFilterTests(TestCase):
+    def setUp(self):
+        self.client = APIClient()
+        self.client.force_authenticate(User.objects.create_user(username='cashier'))
+        yesterday = timezone.localdate() - timedelta(days=1)
+        for name, fields in [
+            ('Plenty', {'stock_quantity': 50}),
+            ('At level', {'stock_quantity': 10}),
+            ('Under forecast', {'stock_quantity': 20, 'reorder_point': 25}),
+            ('Over forecast', {'stock_quantity': 6, 'reorder_point': 4}),
+            ('Expired', {'stock_quantity': 50, 'expiry_date': yesterday}),
+            ('Expires today', {'stock_quantity': 50, 'expiry_date': timezone.localdate()}),
+            ('Inactive', {'stock_quantity': 0, 'expiry_date': yesterday, 'is_active': False}),
+        ]:
+            Medicine.objects.create(name=name, price=Decimal('1.00'), **fields)
+
+    def names(self, **params):
+        response = self.client.get('/api/medicines/', params)
+        self.assertEqual(response.status_code, 200, response.content)
+        return {m['name'] for m in response.data['results']}
+
+    def test_filters_match_the_model_properties(self):
+        active = Medicine.objects.filter(is_active=True)
+        self.assertEqual(self.names(low_stock='true'), {m.name for m in active if m.is_low_stock})
+        self.assertEqual(self.names(low_stock='true'), {'At level', 'Under forecast'})
+        self.assertEqual(self.names(expired='true'), {m.name for m in active if m.is_expired})
+        self.assertEqual(self.names(expired='true'), {'Expired'})
+        self.assertEqual(self.names(low_stock='false'), {m.name for m in active})
+
+    def test_dashboard_counts_in_one_query(self):
+        with CaptureQueriesContext(connection) as ctx:
+            stats = self.client.get('/api/sales/dashboard_stats/').data
+        self.assertEqual((stats['total_medicines'], stats['low_stock_count'], stats['expired_count']), (6, 2, 1))
+        self.assertEqual(sum('"pharmacy_app_medicine"' in q['sql'] for q in ctx.captured_queries), 1)
+
+
+class KeysetPaginationTests(TestCase):
+    def setUp(self):
+        user = User.objects.create_user(username='cashier')
+        self.client = APIClient()
+        self.client.force_authenticate(user)
+        Sale.objects.bulk_create([Sale(cashier=user, payment_method='cash', receipt_number=f'R{i}') for i in range(11)])
+        # Several sales share a timestamp, so id has to break the tie
+        now = timezone.now()
+        ids = list(Sale.objects.order_by('id').values_list('id', flat=True))
+        for i, pk in enumerate(ids):
+            Sale.objects.filter(pk=pk).update(created_at=now - timedelta(minutes=i // 4))
+        self.expected = list(Sale.objects.order_by('-created_at', '-id').values_list('id', flat=True))
+
+    def test_pages_cover_every_sale_once_in_order(self):
+        seen, url, pages = [], '/api/sales/?pagination=keyset&page_size=3', 0
+        while url:
+            response = self.client.get(url)
+            self.assertEqual(response.status_code, 200, response.content)
+            self.assertEqual(set(response.data), {'next', 'results'})
+            seen += [sale['id'] for sale in response.data['results']]
+            url, pages = response.data['next'], pages + 1
+        self.assertEqual(seen, self.expected)
+        self.assertEqual(pages, 4)
+
+    def test_sale_added_while_paging_does_not_shift_later_pages(self):
+        first = self.client.get('/api/sales/?pagination=keyset&page_size=5').data
+        Sale.objects.create(cashier=User.objects.get(), payment_method='cash')
+        second = self.client.get(first['next']).data
+        self.assertEqual([s['id'] for s in second['results']], self.expected[5:10])
+
+    def test_bad_cursor_is_a_404(self):
+        for cursor in ('not-base64!', KeysetPagination.encode_cursor(timezone.now(), 1)[:-4], 'bm9waXBl'):
+            response = self.client.get('/api/sales/', {'cursor': cursor})
+            self.assertEqual(response.status_code, 404, cursor)
+            self.assertEqual(response.data['detail'], 'Invalid cursor')
+
+
+class SalesExportTests(TestCase):
+    def setUp(self):
+        user = User.objects.create_user(username='cashier')
+        self.client = APIClient()
+        self.client.force_authenticate(user)
+        medicine = Medicine.objects.create(name='Amoxicillin', price=Decimal('10.00'))
+        self.basket = Sale.objects.create(cashier=user, payment_method='cash', status='completed', total_amount=Decimal('25.00'))
+        SaleItem.objects.create(sale=self.basket, medicine=medicine, quantity=2, unit_price=Decimal('10.00'))
+        other = Medicine.objects.create(name='Amoxil 250', price=Decimal('5.00'))
+        SaleItem.objects.create(sale=self.basket, medicine=other, quantity=1, unit_price=other.price)
+        self.empty = Sale.objects.create(cashier=user, payment_method='mpesa', status='pending')
+        old = Sale.objects.create(cashier=user, payment_method='cash', status='completed')
+        Sale.objects.filter(pk=old.pk).update(created_at=timezone.now() - timedelta(days=3))
+
+    def export(self, fmt, **params):
+        response = self.client.get(f'/api/sales/export/{fmt}/', {'date_from': str(timezone.localdate()), **params})
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.streaming)
+        return b''.join(response.streaming_content).decode()
+
+    def test_csv_has_one_row_per_item(self):
+        header, *rows = csv.reader(io.StringIO(self.export('csv')))
+        self.assertEqual(header[:2], ['receipt_number', 'created_at'])
+        self.assertEqual(header[-5:], ['item_medicine_id', 'item_medicine_name', 'item_quantity',
+                                       'item_unit_price', 'item_total_price'])
+        records = [dict(zip(header, row)) for row in rows]
+        self.assertEqual([r['receipt_number'] for r in records], [self.basket.receipt_number] * 2 + [self.empty.receipt_number])
+        self.assertEqual([(r['item_medicine_name'], r['item_total_price']) for r in records],
+                         [('Amoxicillin', '20.00'), ('Amoxil 250', '5.00'), ('', '')])
+        self.assertEqual((records[0]['cashier'], records[0]['total_amount']), ('cashier', '25.00'))
+
+    def test_ndjson_has_one_line_per_sale(self):
+        lines = [json.loads(line) for line in self.export('ndjson', payment_method='cash').splitlines()]
+        self.assertEqual(len(lines), 1)
+        self.assertEqual(lines[0]['receipt_number'], self.basket.receipt_number)
+        self.assertEqual([(i['medicine_name'], i['quantity'], i['unit_price']) for i in lines[0]['items']],
+                         [('Amoxicillin', 2, '10.00'), ('Amoxil 250', 1, '5.00')])
+
+    def test_bad_date_is_a_400(self):
+        for params in ({'date_from': '17/10/2026'}, {'date_to': '2026-02-30'}):
+            response = self.client.get('/api/sales/export/csv/', params)
+            self.assertEqual(response.status_code, 400, params)
+            self.assertIn(next(iter(params)), response.data)
+
+
+class ReceiptNumberTests(TestCase):
+    FORMAT = r'^RX[0-9A-HJKMNP-TV-Z]{18}$'
+
+    def test_format_and_order(self):
+        allocator = ReceiptNumberAllocator(instance_id=3)
+        numbers = [allocator.next() for _ in range(2000)]
+        for number in numbers[:5]:
+            self.assertRegex(number, self.FORMAT)
+        self.assertEqual(len(set(numbers)), len(numbers))
+        self.assertEqual(numbers, sorted(numbers))
+        self.assertLess(abs((receipts.issued_at(numbers[-1]) - timezone.now()).total_seconds()), 5)
+
+    def test_unique_across_threads_and_instances(self):
+        allocators = [ReceiptNumberAllocator(instance_id=i) for i in (1, 2)]
+        with ThreadPoolExecutor(max_workers=8) as pool:
+            numbers = list(pool.map(lambda i: allocators[i % 2].next(), range(4000)))
+        self.assertEqual(len(set(numbers)), len(numbers))
+        # Same millisecond, pid and sequence still differ by instance
+        self.assertNotEqual(receipts.encode(1, 1, 42, 0), receipts.encode(1, 2, 42, 0))
+
+    def test_clock_going_back_keeps_numbers_increasing(self):
+        allocator = ReceiptNumberAllocator(instance_id=0)
+        with mock.patch.object(ReceiptNumberAllocator, '_now_ms', side_effect=[5000, 4000, 4000]):
+            numbers = [allocator.next() for _ in range(3)]
+        self.assertEqual(numbers, sorted(numbers))
+        self.assertEqual(len(set(numbers)), 3)
+
+    def test_sales_get_a_receipt_number(self):
+        user = User.objects.create_user(username='cashier')
+        first, second = (Sale.objects.create(cashier=user, payment_method='cash') for _ in range(2))
+        self.assertRegex(first.receipt_number, self.FORMAT)
+        self.assertLess(first.receipt_number, second.receipt_number)
+        # Older receipts keep sorting first
+        self.assertLess('RX-20250101-0001', first.receipt_number)
+
+    @override_settings(RECEIPT_INSTANCE_ID=None)
+    def test_replicas_without_an_instance_id_differ(self):
+        nodes = set()
+        for host in ('pos-7d9f-abcde', 'pos-7d9f-fghij'):
+            with mock.patch('socket.gethostname', return_value=host), mock.patch('os.getpid', return_value=1):
+                nodes.add(ReceiptNumberAllocator().node())
+        self.assertEqual(len(nodes), 2)
+        with mock.patch('os.getpid', return_value=1):
+            self.assertEqual(ReceiptNumberAllocator(instance_id=7).node(), (7, 1))
+
+    def test_instance_id_out_of_range(self):
+        with override_settings(RECEIPT_INSTANCE_ID=256):
+            with self.assertRaises(ImproperlyConfigured):
+                ReceiptNumberAllocator().next()
+
+
+class CatalogueTests(TestCase):
+    url = '/api/medicines/catalogue/'
+
+    def setUp(self):
+        self.client = APIClient()
+        self.client.force_authenticate(User.objects.create_user(username='cashier'))
+        self.a, self.b, self.c = (
+            Medicine.objects.create(name=name, barcode=name, price=Decimal('10.00'), stock_quantity=5)
+            for name in ('A', 'B', 'C')
+        )
+        Medicine.objects.update(updated_at=timezone.now() - timedelta(hours=2))
+        Medicine.objects.filter(pk=self.c.pk).update(updated_at=timezone.now() - timedelta(hours=1))
+
+    def test_full_snapshot_then_delta(self):
+        full = self.client.get(self.url)
+        self.assertEqual(full.status_code, 200)
+        self.assertEqual((full.data['full'], full.data['count'], full.data['removed']), (True, 3, []))
+        fields = full.data['fields']
+        self.assertEqual([dict(zip(fields, row))['name'] for row in full.data['rows']], ['A', 'B', 'C'])
+
+        self.a.price = Decimal('12.50')
+        self.a.save()
+        self.b.is_active = False
+        self.b.save()
+        delta = self.client.get(self.url, {'since': full.data['version']})
+        self.assertEqual((delta.data['full'], delta.data['count']), (False, 2))
+        # C is as new as the version itself, so the overlap sends it again
+        self.assertEqual([dict(zip(fields, row)) for row in delta.data['rows']], [
+            {**dict(zip(fields, full.data['rows'][0])), 'price': '12.50'},
+            dict(zip(fields, full.data['rows'][2])),
+        ])
+        self.assertEqual(delta.data['removed'], [self.b.pk])
+        self.assertGreater(delta.data['version'], full.data['version'])
+
+    def test_etag_answers_304_until_the_catalogue_changes(self):
+        etag = self.client.get(self.url)['ETag']
+        with CaptureQueriesContext(connection) as ctx:
+            response = self.client.get(self.url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response['ETag'], etag)
+        self.assertEqual(len(ctx.captured_queries), 1)
+        # A hard delete leaves no newer updated_at, but the count changes
+        self.c.delete()
+        response = self.client.get(self.url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], etag)
+        self.assertEqual(response.data['count'], 2)
+
+    def test_bad_since_is_a_400(self):
+        for since in ('yesterday', '9' * 30):
+            response = self.client.get(self.url, {'since': since})
+            self.assertEqual(response.status_code, 400, since)
+            self.assertIn('since', response.data)
+
+    def test_batch_sync_replay_is_a_duplicate(self):
+        inventory.receive(self.a.pk, 5, 'LOT', date(2031, 1, 1))
+        sales = [
+            {'client_ref': 'till-1', 'payment_method': 'cash', 'items': [{'medicine_id': self.a.pk, 'quantity': 2, 'unit_price': '10.00'}]},
+            {'client_ref': 'till-2', 'payment_method': 'cash', 'items': [{'medicine_id': self.a.pk, 'quantity': 50, 'unit_price': '10.00'}]},
+        ]
+        first = self.client.post('/api/sales/batch/', {'sales': sales}, format='json').data['results']
+        self.assertEqual([r['status'] for r in first], ['created', 'rejected'])
+        again = self.client.post('/api/sales/batch/', {'sales': sales[:1]}, format='json').data['results']
+        self.assertEqual(again, [{'client_ref': 'till-1', 'status': 'duplicate', 'receipt_number': first[0]['receipt_number']}])
+        self.a.refresh_from_db()
+        self.assertEqual((self.a.stock_quantity, Sale.objects.count()), (8, 1))
+
+
+class BarcodeLookupTests(TestCase):
+    def setUp(self):
+        barcode_cache.clear()
+        self.addCleanup(barcode_cache.clear)
+        self.client = APIClient()
+        self.client.force_authenticate(User.objects.create_user(username='cashier'))
+        self.medicine = Medicine.objects.create(name='Amoxicillin', barcode='6001234', price=Decimal('10.00'))
+        inventory.receive(self.medicine.pk, 10, 'LOT', date(2031, 1, 1))
+
+    def lookup(self, code='6001234'):
+        return self.client.get(f'/api/medicines/by-barcode/{code}/')
+
+    def test_hit_is_served_from_the_cache(self):
+        self.assertEqual(self.lookup().data['name'], 'Amoxicillin')
+        with CaptureQueriesContext(connection) as ctx:
+            response = self.lookup()
+        self.assertEqual((response.status_code, response.data['id']), (200, self.medicine.pk))
+        self.assertEqual(len(ctx.captured_queries), 0)
+
+    def test_miss_is_a_404(self):
+        response = self.lookup('0000000')
+        self.assertEqual(response.status_code, 404)
+        self.assertEqual(response.data, {'error': 'Medicine not found'})
+
+    def test_changes_invalidate_the_cached_row(self):
+        self.lookup()
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.patch(f'/api/medicines/{self.medicine.pk}/', {'price': '12.00'}, format='json')
+        self.assertEqual(self.lookup().data['price'], '12.00')
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.post('/api/sales/', {
+                'payment_method': 'cash',
+                'items': [{'medicine_id': self.medicine.pk, 'quantity': 4, 'unit_price': '12.00'}],
+            }, format='json')
+        self.assertEqual(self.lookup().data['stock_quantity'], 6)
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.patch(f'/api/medicines/{self.medicine.pk}/', {'is_active': False}, format='json')
+        self.assertEqual(self.lookup().status_code, 404)
+
+    def test_batch_lookup(self):
+        response = self.client.post('/api/medicines/by-barcode/', {'barcodes': ['6001234', ' 999 ']}, format='json')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(list(response.data['results']), ['6001234'])
+        self.assertEqual(response.data['missing'], ['999'])
+
+
+class ConditionalGetTests(TestCase):
+    def setUp(self):
+        self.client = APIClient()
+        self.client.force_authenticate(User.objects.create_user(username='cashier'))
+        self.a, self.b = (Medicine.objects.create(name=name, price=Decimal('1.00')) for name in ('A', 'B'))
+        Medicine.objects.update(updated_at=timezone.now() - timedelta(hours=1))
+
+    def test_list_ignores_if_modified_since_alone(self):
+        first = self.client.get('/api/medicines/')
+        since = first['Last-Modified']
+        # The newest updated_at survives the delete; only the ETag notices
+        self.b.delete()
+        response = self.client.get('/api/medicines/', HTTP_IF_MODIFIED_SINCE=since)
+        self.assertEqual((response.status_code, response.data['count']), (200, 1))
+        self.assertEqual(self.client.get('/api/medicines/', HTTP_IF_NONE_MATCH=first['ETag']).status_code, 200)
+
+    def test_if_none_match_wins_over_if_modified_since(self):
+        first = self.client.get('/api/medicines/')
+        stale = 'Thu, 01 Jan 2015 00:00:00 GMT'
+        response = self.client.get('/api/medicines/', HTTP_IF_NONE_MATCH=first['ETag'], HTTP_IF_MODIFIED_SINCE=stale)
+        self.assertEqual(response.status_code, 304)
+        self.b.delete()
+        response = self.client.get('/api/medicines/', HTTP_IF_NONE_MATCH=first['ETag'],
+                                   HTTP_IF_MODIFIED_SINCE=first['Last-Modified'])
+        self.assertEqual(response.status_code, 200)
+
+    def test_detail_answers_if_modified_since(self):
+        url = f'/api/medicines/{self.a.pk}/'
+        since = self.client.get(url)['Last-Modified']
+        self.assertEqual(self.client.get(url, HTTP_IF_MODIFIED_SINCE=since).status_code, 304)
+        self.a.delete()
+        self.assertEqual(self.client.get(url, HTTP_IF_MODIFIED_SINCE=since).status_code, 404)
+
+    def test_fresh_change_gets_no_last_modified(self):
+        # A second write within the same second would carry the same HTTP date
+        self.a.save()
+        response = self.client.get(f'/api/medicines/{self.a.pk}/')
+        self.assertNotIn('Last-Modified', response)
+        self.assertIn('ETag', response)
+        self.assertEqual(self.client.get(f'/api/medicines/{self.b.pk}/')['Last-Modified'],
+                         http_date(int(Medicine.objects.get(pk=self.b.pk).updated_at.timestamp())))
@@ -4,6 +4,8 @@ from .views import (
     CustomTokenView, CategoryViewSet, MedicineViewSet,
     SaleViewSet, MpesaViewSet
 )
+from .metrics import metrics_view
+from .streams import payment_events
 
 router = DefaultRouter()
 router.register('categories', CategoryViewSet, basename='category')
@@ -13,5 +15,7 @@ router.register('mpesa', MpesaViewSet, basename='mpesa')
 
 urlpatterns = [
     path('auth/token/', CustomTokenView.as_view(), name='token_obtain'),
+    path('mpesa/events/<str:checkout_id>/', payment_events, name='mpesa-events'),
+    path('metrics/', metrics_view, name='metrics'),
     path('', include(router.urls)),
 ]
\ No newline at end of file
@@ -1,25 +1,36 @@
 from rest_framework import viewsets, status, filters
 from rest_framework.decorators import action
+from rest_framework.exceptions import ValidationError
 from rest_framework.response import Response
-from rest_framework.permissions import IsAuthenticated, AllowAny
+from rest_framework.permissions import IsAuthenticated, IsAdminUser, AllowAny
 from rest_framework_simplejwt.views import TokenObtainPairView
 from rest_framework_simplejwt.serializers import TokenObtainPairSerializer
 from django.contrib.auth.models import User
-from django.db import transaction
-from django.db.models import Sum, Count, Q
+from django.db import IntegrityError, transaction
+from django.http import StreamingHttpResponse
+from django.db.models import Sum, Count, Max, Q, F, Case, When, IntegerField, Subquery
 from django.utils import timezone
-from datetime import timedelta
-import requests
-import base64
+from django.utils.dateparse import parse_date
+from datetime import date, datetime, timedelta, timezone as dt_timezone
+from decimal import Decimal
+import csv
 import json
 import logging
-from decouple import config
 
-from .models import Category, Medicine, Sale, SaleItem, MpesaTransaction
+from .models import Category, Medicine, Sale, SaleItem, MpesaTransaction, DailySalesSummary
+from .mpesa import (
+    DISPATCH_MODE, journal_callback, mpesa_service, new_reference, queue_stk_push, schedule_callback_apply,
+)
+from . import inventory
+from .analytics import numpy_available, sku_metrics
+from .conditional import ConditionalGetMixin
+from .metrics import InstrumentedViewMixin
+from .pagination import KeysetPagination, KnownCountPagination
+from .search import medicine_index, barcode_cache
 from .serializers import (
-    CategorySerializer, MedicineSerializer, MedicineListSerializer,
-    SaleSerializer, SaleCreateSerializer, MpesaTransactionSerializer,
-    STKPushSerializer, UserSerializer
+    CategorySerializer, MedicineSerializer, MedicineListSerializer, BarcodeBatchSerializer,
+    StockAdjustmentSerializer, StockUpdateSerializer, SaleSerializer, SaleCreateSerializer, SaleBatchSerializer,
+    MpesaTransactionSerializer, STKPushSerializer, UserSerializer
 )
 
 logger = logging.getLogger(__name__)
@@ -40,19 +51,66 @@ class CustomTokenView(TokenObtainPairView):
 
 # ─── Category ──────────────────────────────────────────────────────────────────
 
-class CategoryViewSet(viewsets.ModelViewSet):
-    queryset = Category.objects.all()
+def newest_updated_at(model):
+    """Scalar subquery for the newest updated_at of a model, for use in validators"""
+    return Subquery(model.objects.order_by('-updated_at').values('updated_at')[:1])
+
+
+class CategoryViewSet(InstrumentedViewMixin, ConditionalGetMixin, viewsets.ModelViewSet):
+    queryset = Category.objects.annotate(
+        medicine_count=Count('medicines', filter=Q(medicines__is_active=True))
+    ).order_by('name')
     serializer_class = CategorySerializer
     permission_classes = [IsAuthenticated]
+    pagination_class = KnownCountPagination
     filter_backends = [filters.SearchFilter]
     search_fields = ['name']
 
+    def get_validator_aggregates(self):
+        # medicine_count changes whenever a medicine is added, removed or (de)activated
+        active_medicines = Medicine.objects.filter(is_active=True).order_by().values('is_active').annotate(
+            n=Count('pk')).values('n')
+        return {
+            **super().get_validator_aggregates(),
+            'medicines_last': Max(newest_updated_at(Medicine)),
+            'medicines_count': Max(Subquery(active_medicines)),
+        }
+
 
 # ─── Medicine ──────────────────────────────────────────────────────────────────
 
-class MedicineViewSet(viewsets.ModelViewSet):
+POS_SEARCH_LIMIT = 20
+
+CATALOGUE_FIELDS = [
+    'id', 'name', 'generic_name', 'barcode', 'category_id', 'unit', 'price',
+    'stock_quantity', 'reorder_level', 'expiry_date', 'requires_prescription', 'reorder_point',
+]
+# Deltas also resend rows changed shortly before ``since``, in case a row with
+# an older updated_at committed after the till's last sync; tills upsert rows,
+# so the overlap is harmless
+CATALOGUE_DELTA_OVERLAP = timedelta(seconds=10)
+
+
+def catalogue_version(updated_at):
+    """Catalogue version: microseconds since the epoch of the newest updated_at"""
+    return int(updated_at.timestamp() * 1_000_000) if updated_at else 0
+
+
+def version_time(version):
+    return datetime.fromtimestamp(version / 1_000_000, tz=dt_timezone.utc)
+
+
+def catalogue_row(row):
+    return [
+        str(value) if isinstance(value, Decimal) else value.isoformat() if isinstance(value, date) else value
+        for value in row
+    ]
+
+
+class MedicineViewSet(InstrumentedViewMixin, ConditionalGetMixin, viewsets.ModelViewSet):
     queryset = Medicine.objects.select_related('category').filter(is_active=True)
     permission_classes = [IsAuthenticated]
+    pagination_class = KnownCountPagination
     filter_backends = [filters.SearchFilter, filters.OrderingFilter]
     search_fields = ['name', 'generic_name', 'barcode', 'manufacturer']
     ordering_fields = ['name', 'price', 'stock_quantity', 'created_at']
@@ -63,43 +121,357 @@ class MedicineViewSet(viewsets.ModelViewSet):
             return MedicineListSerializer
         return MedicineSerializer
 
+    def get_validator_aggregates(self):
+        # category_name is serialized too
+        return {**super().get_validator_aggregates(), 'categories_last': Max(newest_updated_at(Category))}
+
     def get_queryset(self):
         qs = super().get_queryset()
         category = self.request.query_params.get('category')
         low_stock = self.request.query_params.get('low_stock')
+        expired = self.request.query_params.get('expired')
         if category:
             qs = qs.filter(category_id=category)
         if low_stock == 'true':
-            qs = [m for m in qs if m.is_low_stock]
+            qs = qs.low_stock()
+        if expired == 'true':
+            qs = qs.expired()
         return qs
 
+    def update(self, request, *args, **kwargs):
+        # A stock count typed into the form can race a checkout on the same batches
+        try:
+            return super().update(request, *args, **kwargs)
+        except inventory.StockConflict as e:
+            return Response({'error': str(e)}, status=409)
+
     @action(detail=False, methods=['get'])
     def pos_search(self, request):
         """Fast search for POS terminal"""
         query = request.query_params.get('q', '')
-        medicines = Medicine.objects.filter(
-            Q(name__icontains=query) |
-            Q(generic_name__icontains=query) |
-            Q(barcode__iexact=query),
-            is_active=True,
-            stock_quantity__gt=0
-        )[:20]
+        # Ranking comes from the in-memory index; the database is only hit by
+        # primary key to hydrate the hits and drop anything now out of stock.
+        # If too many top hits drop out, ask the index for more and hydrate
+        # only the new ones, until the page is full or the index runs out.
+        limit = POS_SEARCH_LIMIT * 3
+        found, checked = {}, set()
+        while True:
+            ids = medicine_index.search(query, limit=limit)
+            fresh = [pk for pk in ids if pk not in checked]
+            found.update(Medicine.objects.select_related('category').filter(
+                is_active=True, stock_quantity__gt=0
+            ).in_bulk(fresh))
+            checked.update(fresh)
+            medicines = [found[pk] for pk in ids if pk in found][:POS_SEARCH_LIMIT]
+            if len(medicines) == POS_SEARCH_LIMIT or len(ids) < limit:
+                break
+            limit *= 4
         return Response(MedicineListSerializer(medicines, many=True, context={'request': request}).data)
 
+    @action(detail=False, methods=['get'], url_path='by-barcode/(?P<code>[^/]+)')
+    def by_barcode(self, request, code=None):
+        """Exact barcode lookup for scanners"""
+        medicine = barcode_cache.get(code.strip())
+        if medicine is None:
+            return Response({'error': 'Medicine not found'}, status=404)
+        return Response(MedicineListSerializer(medicine, context={'request': request}).data)
+
+    @action(detail=False, methods=['post'], url_path='by-barcode')
+    def by_barcode_batch(self, request):
+        """Resolve several buffered scans in one round-trip"""
+        serializer = BarcodeBatchSerializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        codes = [c.strip() for c in serializer.validated_data['barcodes']]
+        found = barcode_cache.get_many(codes)
+        return Response({
+            'results': {
+                code: MedicineListSerializer(med, context={'request': request}).data
+                for code, med in found.items()
+            },
+            'missing': [c for c in codes if c not in found],
+        })
+
+    @action(detail=False, methods=['post'], url_path='adjust-stock')
+    def adjust_stock(self, request):
+        """
+        Apply a whole goods-received note or stock count in one transaction.
+        Lines name a medicine by id or barcode; every line gets a result.
+        """
+        serializer = StockAdjustmentSerializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        lines = serializer.validated_data['lines']
+
+        codes = [line['barcode'].strip() for line in lines if 'barcode' in line]
+        by_code = dict(Medicine.objects.filter(barcode__in=codes).values_list('barcode', 'id')) if codes else {}
+        for line in lines:
+            if 'barcode' in line:
+                line['medicine_id'] = by_code.get(line['barcode'].strip())
+
+        try:
+            applied = inventory.adjust_many(
+                [line for line in lines if line['medicine_id'] is not None],
+                user=request.user, note=serializer.validated_data['note'],
+            )
+        except inventory.StockConflict as e:
+            return Response({'error': str(e)}, status=409)
+        stock = dict(Medicine.objects.filter(
+            pk__in=[line['medicine_id'] for line in lines if line['medicine_id'] is not None]
+        ).values_list('id', 'stock_quantity'))
+
+        results = []
+        outcomes = iter(applied)
+        for line in lines:
+            result = {'medicine_id': line['medicine_id'], 'delta': line['delta']}
+            if 'barcode' in line:
+                result['barcode'] = line['barcode']
+            outcome = next(outcomes) if line['medicine_id'] is not None else None
+            if outcome is None:
+                result['status'] = 'not_found'
+            else:
+                result['status'] = 'applied' if outcome['applied'] == line['delta'] else 'clamped'
+                result['applied'] = outcome['applied']
+                result['stock_quantity'] = stock[line['medicine_id']]
+                if outcome['batch'] is not None:
+                    result['batch_id'] = outcome['batch'].pk
+            results.append(result)
+        return Response({'results': results})
+
+    @action(detail=False, methods=['get'])
+    def catalogue(self, request):
+        """
+        Compact catalogue for tills that search offline.
+
+        Without ``since`` every active medicine is returned. With
+        ``?since=<version>`` only medicines changed after that version are
+        returned; deactivated ones are listed in ``removed``. Hard-deleted rows
+        cannot be listed, so tills should fetch a full snapshot when their
+        local row count no longer matches ``count``.
+        """
+        state = Medicine.objects.aggregate(last=Max('updated_at'), count=Count('id', filter=Q(is_active=True)))
+        version = catalogue_version(state['last'])
+        etag = f'"catalogue-{version}-{state["count"]}"'
+        if etag in request.headers.get('If-None-Match', ''):
+            return Response(status=304, headers={'ETag': etag})
+
+        since = request.query_params.get('since')
+        if since:
+            try:
+                since_at = version_time(int(since))
+            except (ValueError, OverflowError, OSError):
+                raise ValidationError({'since': 'Invalid catalogue version'})
+            changed = Medicine.objects.filter(updated_at__gt=since_at - CATALOGUE_DELTA_OVERLAP)
+            rows = changed.filter(is_active=True)
+            removed = list(changed.filter(is_active=False).values_list('id', flat=True))
+        else:
+            rows = Medicine.objects.filter(is_active=True)
+            removed = []
+
+        data = {
+            'version': version,
+            'full': not since,
+            'count': state['count'],
+            'fields': CATALOGUE_FIELDS,
+            'rows': [catalogue_row(row) for row in rows.order_by('id').values_list(*CATALOGUE_FIELDS)],
+            'removed': removed,
+        }
+        return Response(data, headers={'ETag': etag, 'Cache-Control': 'private, no-cache'})
+
     @action(detail=True, methods=['patch'])
     def update_stock(self, request, pk=None):
         medicine = self.get_object()
-        qty = request.data.get('quantity')
-        if qty is None:
-            return Response({'error': 'quantity required'}, status=400)
-        medicine.stock_quantity = max(0, medicine.stock_quantity + int(qty))
-        medicine.save()
+        serializer = StockUpdateSerializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        data = serializer.validated_data
+        qty = data['quantity']
+        user = request.user if request.user.is_authenticated else None
+        try:
+            if qty > 0 and data.get('lot_number'):
+                # A delivery with lot details becomes its own batch
+                inventory.receive(
+                    medicine.pk, qty,
+                    lot_number=data['lot_number'],
+                    expiry_date=data.get('expiry_date'),
+                    cost_price=data.get('cost_price'),
+                    user=user,
+                    note=data['note'],
+                )
+            else:
+                inventory.adjust(medicine.pk, qty, user=user, note=data['note'])
+        except inventory.StockConflict as e:
+            return Response({'error': str(e)}, status=409)
+        medicine.refresh_from_db()
         return Response(MedicineSerializer(medicine, context={'request': request}).data)
 
 
 # ─── Sales ─────────────────────────────────────────────────────────────────────
 
-class SaleViewSet(viewsets.ModelViewSet):
+def parse_day(value, field='date'):
+    """date for a YYYY-MM-DD string; ValidationError (400) naming ``field`` otherwise"""
+    try:
+        day = parse_date(value)
+    except ValueError:  # well formed but impossible, e.g. 2024-02-30
+        day = None
+    if day is None:
+        raise ValidationError({field: f"Invalid date '{value}', use YYYY-MM-DD"})
+    return day
+
+
+def start_of_day(value):
+    """Aware datetime for midnight of a date or YYYY-MM-DD string"""
+    if isinstance(value, str):
+        value = parse_day(value)
+    return timezone.make_aware(datetime.combine(value, datetime.min.time()))
+
+
+def reserve_stock(quantities):
+    """
+    Decrement stock for {medicine_id: quantity} in a single UPDATE.
+    Returns False if any row no longer has enough stock, in which case the
+    caller must roll back the surrounding transaction.
+    """
+    guard = Q()
+    whens = []
+    for med_id, qty in quantities.items():
+        guard |= Q(pk=med_id, stock_quantity__gte=qty)
+        whens.append(When(pk=med_id, then=F('stock_quantity') - qty))
+    updated = Medicine.objects.filter(guard).update(
+        stock_quantity=Case(*whens, output_field=IntegerField()),
+        updated_at=timezone.now(),
+    )
+    if updated != len(quantities):
+        return False
+    ids = list(quantities)
+    transaction.on_commit(lambda: barcode_cache.invalidate(ids))
+    return True
+
+
+def checkout(cashier, data, client_ref=None):
+    """
+    Reserve stock and record one sale from validated SaleCreateSerializer data.
+    Must run inside transaction.atomic(). Returns (sale, None) or
+    (None, (message, http_status)); on error the caller rolls back.
+    """
+    # Lock every medicine in the cart with a single query
+    items_data = data['items']
+    wanted = {}
+    for item in items_data:
+        wanted[item['medicine_id']] = wanted.get(item['medicine_id'], 0) + item['quantity']
+    medicines = Medicine.objects.select_for_update().in_bulk(list(wanted))
+
+    # Validate stock in memory
+    for med_id, qty in wanted.items():
+        med = medicines.get(med_id)
+        if med is None:
+            return None, (f"Medicine {med_id} not found", 400)
+        if med.stock_quantity < qty:
+            return None, (f"Insufficient stock for {med.name}. Available: {med.stock_quantity}", 400)
+
+    # One conditional UPDATE for the whole basket. The stock guard also
+    # protects backends where select_for_update() is a no-op (SQLite).
+    if not reserve_stock(wanted):
+        return None, ('Stock changed during checkout, please retry', 409)
+    plan = inventory.allocate(wanted)
+    if plan is None:
+        return None, ('Stock changed during checkout, please retry', 409)
+
+    subtotal = sum(i['unit_price'] * i['quantity'] for i in items_data)
+    discount = data.get('discount', 0)
+    total = subtotal - discount
+
+    sale = Sale.objects.create(
+        cashier=cashier,
+        customer_name=data.get('customer_name', 'Walk-in Customer'),
+        customer_phone=data.get('customer_phone', ''),
+        payment_method=data['payment_method'],
+        subtotal=subtotal,
+        discount=discount,
+        total_amount=total,
+        amount_paid=data.get('amount_paid', total),
+        change_amount=max(0, data.get('amount_paid', total) - total),
+        notes=data.get('notes', ''),
+        status='completed' if data['payment_method'] != 'mpesa' else 'pending',
+        client_ref=client_ref,
+    )
+
+    SaleItem.objects.bulk_create([
+        SaleItem(
+            sale=sale,
+            medicine=medicines[item['medicine_id']],
+            medicine_name=medicines[item['medicine_id']].name,
+            quantity=item['quantity'],
+            unit_price=item['unit_price'],
+            total_price=item['unit_price'] * item['quantity']
+        )
+        for item in items_data
+    ])
+    inventory.record(inventory.movements_for(plan, wanted, 'sale', sale=sale, user=cashier))
+    return sale, None
+
+
+EXPORT_CHUNK_SIZE = 500
+
+EXPORT_SALE_FIELDS = [
+    'receipt_number', 'created_at', 'cashier', 'customer_name', 'customer_phone',
+    'payment_method', 'status', 'subtotal', 'discount', 'total_amount',
+    'amount_paid', 'change_amount',
+]
+EXPORT_ITEM_FIELDS = ['medicine_id', 'medicine_name', 'quantity', 'unit_price', 'total_price']
+
+
+class _Echo:
+    """File-like object whose write() just returns the line, for streaming csv.writer output"""
+    def write(self, value):
+        return value
+
+
+def _export_sale(sale):
+    return {
+        'receipt_number': sale.receipt_number,
+        'created_at': sale.created_at.isoformat(),
+        'cashier': sale.cashier.username if sale.cashier else '',
+        'customer_name': sale.customer_name,
+        'customer_phone': sale.customer_phone,
+        'payment_method': sale.payment_method,
+        'status': sale.status,
+        'subtotal': str(sale.subtotal),
+        'discount': str(sale.discount),
+        'total_amount': str(sale.total_amount),
+        'amount_paid': str(sale.amount_paid),
+        'change_amount': str(sale.change_amount),
+    }
+
+
+def _export_item(item):
+    return {
+        'medicine_id': item.medicine_id,
+        'medicine_name': item.medicine_name,
+        'quantity': item.quantity,
+        'unit_price': str(item.unit_price),
+        'total_price': str(item.total_price),
+    }
+
+
+def export_sales_csv(sales):
+    writer = csv.writer(_Echo())
+    yield writer.writerow(EXPORT_SALE_FIELDS + ['item_' + f for f in EXPORT_ITEM_FIELDS])
+    for sale in sales:
+        head = [_export_sale(sale)[f] for f in EXPORT_SALE_FIELDS]
+        items = sale.items.all()
+        if not items:
+            yield writer.writerow(head + [''] * len(EXPORT_ITEM_FIELDS))
+        for item in items:
+            line = _export_item(item)
+            yield writer.writerow(head + [line[f] for f in EXPORT_ITEM_FIELDS])
+
+
+def export_sales_ndjson(sales):
+    for sale in sales:
+        record = _export_sale(sale)
+        record['items'] = [_export_item(item) for item in sale.items.all()]
+        yield json.dumps(record) + '\n'
+
+
+class SaleViewSet(InstrumentedViewMixin, viewsets.ModelViewSet):
     queryset = Sale.objects.prefetch_related('items').select_related('cashier')
     serializer_class = SaleSerializer
     permission_classes = [IsAuthenticated]
@@ -107,16 +479,29 @@ class SaleViewSet(viewsets.ModelViewSet):
     ordering = ['-created_at']
     http_method_names = ['get', 'post', 'patch', 'head', 'options']
 
+    @property
+    def paginator(self):
+        """Page-number pagination by default; ?pagination=keyset opts into KeysetPagination"""
+        if not hasattr(self, '_paginator'):
+            params = self.request.query_params if self.request else {}
+            if params.get('pagination') == 'keyset' or 'cursor' in params:
+                self._paginator = KeysetPagination()
+            else:
+                self._paginator = self.pagination_class() if self.pagination_class else None
+        return self._paginator
+
     def get_queryset(self):
         qs = super().get_queryset()
         date_from = self.request.query_params.get('date_from')
         date_to = self.request.query_params.get('date_to')
         payment = self.request.query_params.get('payment_method')
         status_ = self.request.query_params.get('status')
+        # Compare against day boundaries rather than created_at__date so the
+        # created_at indexes can be used
         if date_from:
-            qs = qs.filter(created_at__date__gte=date_from)
+            qs = qs.filter(created_at__gte=start_of_day(parse_day(date_from, 'date_from')))
         if date_to:
-            qs = qs.filter(created_at__date__lte=date_to)
+            qs = qs.filter(created_at__lt=start_of_day(parse_day(date_to, 'date_to')) + timedelta(days=1))
         if payment:
             qs = qs.filter(payment_method=payment)
         if status_:
@@ -126,92 +511,156 @@ class SaleViewSet(viewsets.ModelViewSet):
     def create(self, request, *args, **kwargs):
         serializer = SaleCreateSerializer(data=request.data)
         serializer.is_valid(raise_exception=True)
-        data = serializer.validated_data
 
         with transaction.atomic():
-            # Validate stock
-            items_data = data['items']
-            medicines = {}
-            for item in items_data:
-                med = Medicine.objects.select_for_update().get(pk=item['medicine_id'])
-                if med.stock_quantity < item['quantity']:
-                    return Response(
-                        {'error': f"Insufficient stock for {med.name}. Available: {med.stock_quantity}"},
-                        status=400
-                    )
-                medicines[item['medicine_id']] = med
-
-            subtotal = sum(i['unit_price'] * i['quantity'] for i in items_data)
-            discount = data.get('discount', 0)
-            total = subtotal - discount
-
-            sale = Sale.objects.create(
-                cashier=request.user,
-                customer_name=data.get('customer_name', 'Walk-in Customer'),
-                customer_phone=data.get('customer_phone', ''),
-                payment_method=data['payment_method'],
-                subtotal=subtotal,
-                discount=discount,
-                total_amount=total,
-                amount_paid=data.get('amount_paid', total),
-                change_amount=max(0, data.get('amount_paid', total) - total),
-                notes=data.get('notes', ''),
-                status='completed' if data['payment_method'] != 'mpesa' else 'pending'
-            )
-
-            for item in items_data:
-                med = medicines[item['medicine_id']]
-                SaleItem.objects.create(
-                    sale=sale,
-                    medicine=med,
-                    medicine_name=med.name,
-                    quantity=item['quantity'],
-                    unit_price=item['unit_price'],
-                    total_price=item['unit_price'] * item['quantity']
-                )
-                med.stock_quantity -= item['quantity']
-                med.save()
+            sale, error = checkout(request.user, serializer.validated_data)
+            if error:
+                transaction.set_rollback(True)
+                return Response({'error': error[0]}, status=error[1])
 
         return Response(SaleSerializer(sale, context={'request': request}).data, status=201)
 
+    @action(detail=False, methods=['post'])
+    def batch(self, request):
+        """
+        Ingest sales queued by an offline till. Each sale goes through the same
+        checkout as create() in its own savepoint, so one failure does not
+        undo the others; a client_ref already stored is reported as a
+        duplicate instead of being sold twice.
+        """
+        serializer = SaleBatchSerializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        sales = serializer.validated_data['sales']
+
+        existing = dict(Sale.objects.filter(
+            client_ref__in=[s['client_ref'] for s in sales]
+        ).values_list('client_ref', 'receipt_number'))
+
+        results = []
+        with transaction.atomic():
+            for data in sales:
+                ref = data['client_ref']
+                if ref in existing:
+                    results.append({'client_ref': ref, 'status': 'duplicate', 'receipt_number': existing[ref]})
+                    continue
+                try:
+                    with transaction.atomic():
+                        sale, error = checkout(request.user, data, client_ref=ref)
+                        if error:
+                            transaction.set_rollback(True)
+                            results.append({'client_ref': ref, 'status': 'rejected', 'error': error[0]})
+                            continue
+                except IntegrityError as e:
+                    # Same client_ref committed by a concurrent upload, or some
+                    # other constraint: only the first is a duplicate
+                    receipt = Sale.objects.filter(client_ref=ref).values_list('receipt_number', flat=True).first()
+                    if receipt is None:
+                        results.append({'client_ref': ref, 'status': 'rejected', 'error': str(e)})
+                    else:
+                        results.append({'client_ref': ref, 'status': 'duplicate', 'receipt_number': receipt})
+                    continue
+                results.append({
+                    'client_ref': ref, 'status': 'created', 'id': sale.pk, 'receipt_number': sale.receipt_number,
+                })
+        return Response({'results': results})
+
+    @action(detail=True, methods=['post'])
+    def refund(self, request, pk=None):
+        """Refund a completed sale and return its items to stock"""
+        with transaction.atomic():
+            sale = Sale.objects.select_for_update().filter(pk=pk).first()
+            if sale is None:
+                return Response({'error': 'Sale not found'}, status=404)
+            if sale.status != 'completed':
+                return Response({'error': f"Only completed sales can be refunded (this one is {sale.status})"}, status=400)
+            inventory.refund(sale, user=request.user)
+            # save() rather than update() so the sales rollup follows the status change
+            sale.status = 'refunded'
+            sale.save()
+        return Response(SaleSerializer(sale, context={'request': request}).data)
+
+    @action(detail=False, methods=['get'], url_path='export/(?P<fmt>csv|ndjson)')
+    def export(self, request, fmt=None):
+        """Stream sales and their line items as CSV (one row per item) or NDJSON (one sale per line)"""
+        sales = self.filter_queryset(self.get_queryset()).order_by('created_at', 'id')
+        rows = sales.iterator(chunk_size=EXPORT_CHUNK_SIZE)
+        if fmt == 'csv':
+            stream, content_type = export_sales_csv(rows), 'text/csv'
+        else:
+            stream, content_type = export_sales_ndjson(rows), 'application/x-ndjson'
+        response = StreamingHttpResponse(stream, content_type=content_type)
+        filename = f"sales-{timezone.localdate():%Y%m%d}.{fmt}"
+        response['Content-Disposition'] = f'attachment; filename="{filename}"'
+        return response
+
+    @action(detail=False, methods=['get'], permission_classes=[IsAdminUser])
+    def analytics(self, request):
+        """
+        Per-SKU revenue, gross margin, units per day and ABC class for completed
+        sales between ?date_from and ?date_to (inclusive, default last 30 days)
+        """
+        if not numpy_available():
+            return Response({'error': 'Sales analytics needs NumPy: pip install numpy'}, status=503)
+        params = request.query_params
+        date_to = parse_day(params['date_to'], 'date_to') if params.get('date_to') else timezone.localdate()
+        date_from = parse_day(params['date_from'], 'date_from') if params.get('date_from') else date_to - timedelta(days=29)
+        if date_from > date_to:
+            raise ValidationError({'date_from': 'date_from must not be after date_to'})
+        days = (date_to - date_from).days + 1
+
+        results, totals = sku_metrics(
+            start_of_day(date_from), start_of_day(date_to) + timedelta(days=1), days,
+        )
+        return Response({
+            'date_from': str(date_from),
+            'date_to': str(date_to),
+            'days': days,
+            'totals': totals,
+            'results': results,
+        })
+
     @action(detail=False, methods=['get'])
     def dashboard_stats(self, request):
-        today = timezone.now().date()
+        today = timezone.localdate()
         week_start = today - timedelta(days=6)
-
-        today_sales = Sale.objects.filter(created_at__date=today, status='completed')
-        today_total = today_sales.aggregate(total=Sum('total_amount'))['total'] or 0
-        today_count = today_sales.count()
+        week_start_at = start_of_day(week_start)
+
+        # Completed-sale totals come from the pre-aggregated daily rollup
+        buckets = DailySalesSummary.objects.filter(
+            date__range=(week_start, today), status='completed'
+        ).values_list('date', 'payment_method', 'sale_count', 'total_amount')
+
+        daily_totals = {}
+        payment_breakdown = {'cash': 0.0, 'mpesa': 0.0, 'card': 0.0}
+        today_total = 0
+        today_count = 0
+        for day, method, count, amount in buckets:
+            daily_totals[day] = daily_totals.get(day, 0) + amount
+            if day == today:
+                today_total += amount
+                today_count += count
+                payment_breakdown[method] = payment_breakdown.get(method, 0.0) + float(amount)
 
         # Sales last 7 days
         weekly = []
         for i in range(7):
             day = week_start + timedelta(days=i)
-            day_total = Sale.objects.filter(
-                created_at__date=day, status='completed'
-            ).aggregate(total=Sum('total_amount'))['total'] or 0
-            weekly.append({'date': str(day), 'total': float(day_total)})
+            weekly.append({'date': str(day), 'total': float(daily_totals.get(day, 0))})
 
-        total_medicines = Medicine.objects.filter(is_active=True).count()
-        low_stock = sum(1 for m in Medicine.objects.filter(is_active=True) if m.is_low_stock)
-        expired = sum(1 for m in Medicine.objects.filter(is_active=True) if m.is_expired)
+        medicine_counts = Medicine.objects.active().stock_counts(today)
+        total_medicines = medicine_counts['total']
+        low_stock = medicine_counts['low_stock']
+        expired = medicine_counts['expired']
 
         # Top 5 medicines this week
         top = SaleItem.objects.filter(
-            sale__created_at__date__gte=week_start,
+            sale__created_at__gte=week_start_at,
             sale__status='completed'
         ).values('medicine_name').annotate(
             total_qty=Sum('quantity'),
             total_revenue=Sum('total_price')
         ).order_by('-total_qty')[:5]
 
-        # Payment breakdown today
-        payment_breakdown = {}
-        for method in ['cash', 'mpesa', 'card']:
-            amt = today_sales.filter(payment_method=method).aggregate(
-                total=Sum('total_amount'))['total'] or 0
-            payment_breakdown[method] = float(amt)
-
         return Response({
             'total_sales_today': float(today_total),
             'total_transactions_today': today_count,
@@ -225,141 +674,8 @@ class SaleViewSet(viewsets.ModelViewSet):
 
 
 # ─── M-Pesa ────────────────────────────────────────────────────────────────────
-import time
-
-# Module-level token cache
-_token_cache = {'token': None, 'expires_at': 0}
-
-class MpesaService:
-    """Daraja API integration"""
-
-    CONSUMER_KEY = config('MPESA_CONSUMER_KEY', default='')
-    CONSUMER_SECRET = config('MPESA_CONSUMER_SECRET', default='')
-    SHORTCODE = config('MPESA_SHORTCODE', default='174379')
-    PASSKEY = config('MPESA_PASSKEY', default='')
-    CALLBACK_URL = config('MPESA_CALLBACK_URL', default='https://yourdomain.com/api/mpesa/callback/')
-    ENVIRONMENT = config('MPESA_ENVIRONMENT', default='sandbox')
-
-    @property
-    def base_url(self):
-        if self.ENVIRONMENT == 'production':
-            return 'https://api.safaricom.co.ke'
-        return 'https://sandbox.safaricom.co.ke'
-
-    def get_access_token(self):
-        # Return cached token if still valid (with 60s buffer)
-        if _token_cache['token'] and time.time() < _token_cache['expires_at'] - 60:
-            logger.debug("[MPESA] Using cached token")
-            return _token_cache['token']
-
-        url = f"{self.base_url}/oauth/v1/generate?grant_type=client_credentials"
-        credentials = base64.b64encode(
-            f"{self.CONSUMER_KEY}:{self.CONSUMER_SECRET}".encode()
-        ).decode()
-
-        resp = requests.get(
-            url,
-            headers={
-                'Authorization': f'Basic {credentials}',
-                'User-Agent': 'MyPharmacyApp/1.0',
-                'Accept': 'application/json',
-                'Cache-Control': 'no-cache',
-            },
-            timeout=10
-        )
-        resp.raise_for_status()
-        data = resp.json()
-
-        # Cache for ~1 hour (token expires in 3599s)
-        _token_cache['token'] = data['access_token']
-        _token_cache['expires_at'] = time.time() + int(data.get('expires_in', 3599))
-        
-        logger.debug(f"[MPESA] Fresh token cached, expires in {data.get('expires_in')}s")
-        return _token_cache['token']
-
-    def get_password(self, timestamp):
-        raw = f"{self.SHORTCODE}{self.PASSKEY}{timestamp}"
-        logger.debug(f"[MPESA] Password raw string: {self.SHORTCODE} + {self.PASSKEY} + {timestamp}")
-        logger.debug(f"[MPESA] Full raw (first 30 chars): {raw[:30]}")
-        return base64.b64encode(raw.encode()).decode()
-
-    def stk_push(self, phone: str, amount: int, account_ref: str, description: str):
-        token = self.get_access_token()
-        timestamp = timezone.now().strftime('%Y%m%d%H%M%S')
-        password = self.get_password(timestamp)
-        
-        url = f"{self.base_url}/mpesa/stkpush/v1/processrequest"
-        payload = {
-            "BusinessShortCode": self.SHORTCODE,
-            "Password": password,
-            "Timestamp": timestamp,
-            "TransactionType": "CustomerPayBillOnline",
-            "Amount": int(amount),
-            "PartyA": phone,
-            "PartyB": self.SHORTCODE,
-            "PhoneNumber": phone,
-            "CallBackURL": self.CALLBACK_URL,
-            "AccountReference": account_ref,
-            "TransactionDesc": description
-        }
-        
-        logger.debug(f"[MPESA] STK Push URL: {url}")
-        logger.debug(f"[MPESA] STK Push payload: {json.dumps({**payload, 'Password': '***HIDDEN***'})}")
-        logger.debug(f"[MPESA] Shortcode: {self.SHORTCODE}")
-        logger.debug(f"[MPESA] Passkey (first 10): {self.PASSKEY[:10] if self.PASSKEY else 'EMPTY!'}")
-        logger.debug(f"[MPESA] Timestamp: {timestamp}")
-        logger.debug(f"[MPESA] Phone: {phone}")
-        logger.debug(f"[MPESA] Amount: {amount}")
-        logger.debug(f"[MPESA] Callback URL: {self.CALLBACK_URL}")
-        logger.debug(f"[MPESA] Environment: {self.ENVIRONMENT}")
-        
-        try:
-            resp = requests.post(
-                url,
-                json=payload,
-                headers={'Authorization': f'Bearer {token}'},
-                timeout=30
-            )
-            logger.debug(f"[MPESA] STK response status: {resp.status_code}")
-            logger.debug(f"[MPESA] STK response body: {resp.text}")
-            resp.raise_for_status()
-            return resp.json()
-        except requests.exceptions.HTTPError as e:
-            logger.error(f"[MPESA] STK Push HTTP error: {e}")
-            if e.response is not None:
-                logger.error(f"[MPESA] STK error status code: {e.response.status_code}")
-                logger.error(f"[MPESA] STK error response body: {e.response.text}")
-                try:
-                    error_json = e.response.json()
-                    logger.error(f"[MPESA] STK error parsed: {error_json}")
-                except Exception:
-                    pass
-            raise
-
-    def query_stk_status(self, checkout_request_id: str):
-        token = self.get_access_token()
-        timestamp = timezone.now().strftime('%Y%m%d%H%M%S')
-        url = f"{self.base_url}/mpesa/stkpushquery/v1/query"
-        payload = {
-            "BusinessShortCode": self.SHORTCODE,
-            "Password": self.get_password(timestamp),
-            "Timestamp": timestamp,
-            "CheckoutRequestID": checkout_request_id
-        }
-        resp = requests.post(
-            url,
-            json=payload,
-            headers={'Authorization': f'Bearer {token}'},
-            timeout=30
-        )
-        resp.raise_for_status()
-        return resp.json()
-
-
-mpesa_service = MpesaService()
-
 
-class MpesaViewSet(viewsets.GenericViewSet):
+class MpesaViewSet(InstrumentedViewMixin, viewsets.GenericViewSet):
     permission_classes = [IsAuthenticated]
 
     @action(detail=False, methods=['post'], url_path='stk-push')
@@ -385,6 +701,9 @@ class MpesaViewSet(viewsets.GenericViewSet):
             logger.error(f"[MPESA] Sale {data['sale_id']} not found")
             return Response({'error': 'Sale not found'}, status=404)
 
+        if DISPATCH_MODE == 'async':
+            return self._queue_stk_push(sale, phone, amount)
+
         try:
             resp = mpesa_service.stk_push(
                 phone=phone,
@@ -402,12 +721,14 @@ class MpesaViewSet(viewsets.GenericViewSet):
                 sale=sale,
                 defaults={
                     'checkout_request_id': resp['CheckoutRequestID'],
+                    'reference': None,
                     'merchant_request_id': resp.get('MerchantRequestID', ''),
                     'phone_number': phone,
                     'amount': amount,
                     'status': 'pending',
                     'result_code': '',
                     'result_description': '',
+                    'dispatched_at': timezone.now(),
                 }
             )
             return Response({
@@ -415,43 +736,47 @@ class MpesaViewSet(viewsets.GenericViewSet):
                 'message': resp.get('CustomerMessage', 'STK push sent'),
                 'status': 'pending'
             })
-        
+
         logger.error(f"[MPESA] STK Push failed — ResponseCode: {resp.get('ResponseCode')}, error: {resp.get('errorMessage')} full: {resp}")
         return Response({'error': resp.get('errorMessage', 'STK push failed'), 'raw': resp}, status=400)
 
+    def _queue_stk_push(self, sale, phone, amount):
+        """Persist a pending transaction and hand the Daraja call to the background dispatcher"""
+        reference = new_reference()
+        with transaction.atomic():
+            txn, _ = MpesaTransaction.objects.update_or_create(
+                sale=sale,
+                defaults={
+                    'checkout_request_id': reference,
+                    'reference': reference,
+                    'merchant_request_id': '',
+                    'phone_number': phone,
+                    'amount': amount,
+                    'status': 'pending',
+                    'result_code': '',
+                    'result_description': '',
+                    'dispatched_at': None,
+                }
+            )
+            queue_stk_push(txn.pk)
+        return Response({
+            'checkout_request_id': reference,
+            'reference': reference,
+            'message': 'STK push queued',
+            'status': 'pending'
+        }, status=202)
+
     @action(detail=False, methods=['get'], url_path='status/(?P<checkout_id>[^/.]+)')
     def check_status(self, request, checkout_id=None):
-        try:
-            txn = MpesaTransaction.objects.get(checkout_request_id=checkout_id)
-        except MpesaTransaction.DoesNotExist:
+        # Async pushes are polled by their stable local reference
+        txn = MpesaTransaction.objects.filter(
+            Q(checkout_request_id=checkout_id) | Q(reference=checkout_id)
+        ).select_related('sale').first()
+        if txn is None:
             return Response({'error': 'Transaction not found'}, status=404)
 
-        # ✅ Don't call Safaricom if already resolved
-        if txn.status in ['success', 'failed', 'cancelled', 'timeout']:
-            return Response(MpesaTransactionSerializer(txn).data)
-
-        # Only query Safaricom if still pending
-        try:
-            resp = mpesa_service.query_stk_status(checkout_id)
-            result_code = str(resp.get('ResultCode', ''))
-            if result_code == '0':
-                txn.status = 'success'
-                txn.result_code = result_code
-                txn.save()
-                if txn.sale:
-                    txn.sale.status = 'completed'
-                    txn.sale.save()
-            elif result_code in ['1032', '1037']:
-                txn.status = 'cancelled'
-                txn.result_description = resp.get('ResultDesc', '')
-                txn.save()
-            elif result_code:
-                txn.status = 'failed'
-                txn.result_description = resp.get('ResultDesc', '')
-                txn.save()
-        except Exception as e:
-            logger.warning(f"Status check error: {e}")
-
+        # Pending transactions are reconciled with Safaricom by the
+        # reconcile_mpesa worker; polling only reads the stored state.
         return Response(MpesaTransactionSerializer(txn).data)
 
     @action(detail=False, methods=['post'], url_path='callback', permission_classes=[AllowAny])
@@ -459,37 +784,11 @@ class MpesaViewSet(viewsets.GenericViewSet):
         data = request.data
         logger.debug(f"[MPESA] Callback received: {json.dumps(data)}")  # ADD THIS
         
-        body = data.get('Body', {}).get('stkCallback', {})
-        checkout_id = body.get('CheckoutRequestID')
-        result_code = str(body.get('ResultCode', ''))
-        result_desc = body.get('ResultDesc', '')
-
-        logger.debug(f"[MPESA] Callback checkout_id: {checkout_id}, result_code: {result_code}")
-
-        try:
-            txn = MpesaTransaction.objects.get(checkout_request_id=checkout_id)
-            logger.debug(f"[MPESA] Found transaction: {txn.id}, current status: {txn.status}")
-        except MpesaTransaction.DoesNotExist:
-            logger.error(f"[MPESA] Transaction NOT FOUND for checkout_id: {checkout_id}")
-            return Response({'ResultCode': 0, 'ResultDesc': 'Accepted'})
-
-        if result_code == '0':
-            callback_metadata = body.get('CallbackMetadata', {}).get('Item', [])
-            meta = {item['Name']: item.get('Value') for item in callback_metadata}
-            logger.debug(f"[MPESA] Callback metadata: {meta}")
-            txn.status = 'success'
-            txn.mpesa_receipt_number = meta.get('MpesaReceiptNumber', '')
-            txn.transaction_date = timezone.now()
-            if txn.sale:
-                txn.sale.status = 'completed'
-                txn.sale.amount_paid = txn.amount
-                txn.sale.save()
+        # Journal only; the applier resolves the transaction in the background.
+        # Acknowledge even unusable payloads so Daraja does not keep retrying them.
+        if journal_callback(data):
+            schedule_callback_apply()
         else:
-            txn.status = 'cancelled' if result_code == '1032' else 'failed'
-
-        txn.result_code = result_code
-        txn.result_description = result_desc
-        txn.save()
-        logger.debug(f"[MPESA] Transaction updated to status: {txn.status}")
+            logger.error("[MPESA] Callback without CheckoutRequestID ignored")
 
         return Response({'ResultCode': 0, 'ResultDesc': 'Accepted'})
\ No newline at end of file
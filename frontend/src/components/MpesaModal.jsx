@@ -3,8 +3,9 @@ import { useState, useEffect, useRef } from 'react'
 import { mpesaApi, getErrorMessage } from '@/utils/api'
 import toast from 'react-hot-toast'
 
-const POLL_INTERVAL_MS = 5000   // 5s — safe, won't trigger WAF
-const MAX_POLLS        = 24     // 24 × 5s = 120s total wait
+const WAIT_TIMEOUT_S = 25       // server holds each long-poll open up to this long
+const MAX_WAIT_MS    = 120000   // give up after 120s total
+const RETRY_DELAY_MS = 2000     // back-off after a network error
 
 export default function MpesaModal({ sale, onSuccess, onClose }) {
   const [phone, setPhone]     = useState(sale.customer_phone || '')
@@ -12,23 +13,62 @@ export default function MpesaModal({ sale, onSuccess, onClose }) {
   const [status, setStatus]   = useState('idle')   // idle | pending | success | failed | timeout
   const [msg, setMsg]         = useState('')
   const [elapsed, setElapsed] = useState(0)        // seconds shown to user
-  const pollRef               = useRef(null)
+  const waitRef               = useRef(null)   // identifies the active wait loop
   const timerRef              = useRef(null)
-  const pollCountRef          = useRef(0)
 
   // Cleanup on unmount
   useEffect(() => () => {
-    clearInterval(pollRef.current)
+    waitRef.current = null
     clearInterval(timerRef.current)
   }, [])
 
   function stopPolling() {
-    clearInterval(pollRef.current)
+    waitRef.current = null
     clearInterval(timerRef.current)
   }
 
+  // Returns true once the transaction has left `pending`
+  function handleResult(data) {
+    if (data.status === 'success') {
+      stopPolling()
+      setStatus('success')
+      setMsg(data.mpesa_receipt_number
+        ? `Receipt: ${data.mpesa_receipt_number}`
+        : 'Payment confirmed!')
+      setTimeout(onSuccess, 1800)
+      return true
+    }
+
+    if (data.status === 'failed') {
+      stopPolling()
+      setStatus('failed')
+      setMsg(data.result_description || 'Payment failed. Please try again.')
+      return true
+    }
+
+    if (data.status === 'cancelled') {
+      stopPolling()
+      setStatus('failed')
+      setMsg('You cancelled the M-Pesa prompt. Please retry.')
+      return true
+    }
+
+    if (data.status === 'timeout') {
+      stopPolling()
+      setStatus('timeout')
+      setMsg('Payment is taking longer than expected.')
+      return true
+    }
+
+    return false
+  }
+
+  // Long-poll: the server answers as soon as the callback lands, so there is
+  // no fixed polling interval and no status query to Safaricom per tick.
   function startPolling(checkoutId) {
-    pollCountRef.current = 0
+    const token = {}
+    waitRef.current = token
+    const deadline = Date.now() + MAX_WAIT_MS
     setElapsed(0)
 
     // Elapsed seconds counter for UX
@@ -36,48 +76,24 @@ export default function MpesaModal({ sale, onSuccess, onClose }) {
       setElapsed((s) => s + 1)
     }, 1000)
 
-    pollRef.current = setInterval(async () => {
-      pollCountRef.current += 1
-
-      try {
-        const { data } = await mpesaApi.checkStatus(checkoutId)
-
-        if (data.status === 'success') {
-          stopPolling()
-          setStatus('success')
-          setMsg(data.mpesa_receipt_number
-            ? `Receipt: ${data.mpesa_receipt_number}`
-            : 'Payment confirmed!')
-          setTimeout(onSuccess, 1800)
-          return
-        }
-
-        if (data.status === 'failed') {
-          stopPolling()
-          setStatus('failed')
-          setMsg(data.result_description || 'Payment failed. Please try again.')
-          return
-        }
-
-        if (data.status === 'cancelled') {
-          stopPolling()
-          setStatus('failed')
-          setMsg('You cancelled the M-Pesa prompt. Please retry.')
-          return
-        }
-
-        // Still pending — check if we've waited long enough
-        if (pollCountRef.current >= MAX_POLLS) {
+    ;(async () => {
+      while (waitRef.current === token) {
+        if (Date.now() >= deadline) {
           stopPolling()
           setStatus('timeout')
           setMsg('Payment is taking longer than expected.')
+          return
+        }
+        try {
+          const { data } = await mpesaApi.waitStatus(checkoutId, WAIT_TIMEOUT_S)
+          if (waitRef.current !== token || handleResult(data)) return
+        } catch (err) {
+          // Network errors — don't give up, just retry shortly
+          console.warn('[MpesaModal] Status wait error:', err)
+          await new Promise((resolve) => setTimeout(resolve, RETRY_DELAY_MS))
         }
-
-      } catch (err) {
-        // Network errors — don't stop polling, just skip this tick
-        console.warn('[MpesaModal] Status check error:', err)
       }
-    }, POLL_INTERVAL_MS)
+    })()
   }
 
   async function sendSTK() {
@@ -93,7 +109,7 @@ export default function MpesaModal({ sale, onSuccess, onClose }) {
       })
       setStatus('pending')
       setMsg(data.message || 'Check your phone for the M-Pesa prompt')
-      startPolling(data.checkout_request_id)
+      startPolling(data.reference ?? data.checkout_request_id)
     } catch (err) {
       toast.error(getErrorMessage(err))
     } finally {
@@ -20,22 +20,34 @@ const STATUS_BADGE = {
 
 export default function SalesPage() {
   const [sales, setSales]     = useState([])
+  const [next, setNext]       = useState(null)
   const [loading, setLoading] = useState(true)
+  const [loadingMore, setLoadingMore] = useState(false)
   const [receipt, setReceipt] = useState(null)
   const [viewing, setViewing] = useState(false)
   const [filters, setFilters] = useState({
     date_from: '', date_to: '', payment_method: '', status: '',
   })
 
+  // Keyset pagination: every "Load more" costs the same, however far back
   const load = useCallback(() => {
     setLoading(true)
     const params = Object.fromEntries(Object.entries(filters).filter(([, v]) => v))
-    saleApi.list(params)
-      .then(({ data }) => setSales(data.results ?? data))
+    saleApi.list({ ...params, pagination: 'keyset' })
+      .then(({ data }) => { setSales(data.results ?? data); setNext(data.next ?? null) })
       .catch(() => toast.error('Failed to load sales'))
       .finally(() => setLoading(false))
   }, [filters])
 
+  function loadMore() {
+    if (!next) return
+    setLoadingMore(true)
+    saleApi.page(next)
+      .then(({ data }) => { setSales((prev) => [...prev, ...data.results]); setNext(data.next) })
+      .catch(() => toast.error('Failed to load more sales'))
+      .finally(() => setLoadingMore(false))
+  }
+
   useEffect(() => { load() }, [load])
 
   async function viewSale(id) {
@@ -68,7 +80,7 @@ export default function SalesPage() {
         <div>
           <h1 className="page-header-title">Sales History</h1>
           <p className="page-header-sub">
-            {sales.length} record{sales.length !== 1 ? 's' : ''}
+            {sales.length}{next ? '+' : ''} record{sales.length !== 1 ? 's' : ''}
             {hasFilters ? ' (filtered)' : ''}
             {sales.length > 0 && ` · KES ${totalRevenue.toLocaleString()} revenue`}
           </p>
@@ -213,6 +225,14 @@ export default function SalesPage() {
         )}
       </div>
 
+      {next && !loading && (
+        <div style={{ display: 'flex', justifyContent: 'center', marginTop: 16 }}>
+          <button className="btn btn-secondary" onClick={loadMore} disabled={loadingMore}>
+            {loadingMore ? <div className="spinner" /> : <i className="bi bi-chevron-down" />} Load more
+          </button>
+        </div>
+      )}
+
       {receipt && <ReceiptModal sale={receipt} onClose={() => setReceipt(null)} />}
     </div>
   )
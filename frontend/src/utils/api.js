@@ -81,7 +81,17 @@ export const medicineApi = {
   create:      (data)   => api.post('/medicines/', data),           // FormData
   update:      (id, data) => api.patch(`/medicines/${id}/`, data),  // FormData
   posSearch:   (q)      => api.get('/medicines/pos_search/', { params: { q } }),
+  byBarcode:   (code)   => api.get(`/medicines/by-barcode/${encodeURIComponent(code)}/`),
+  byBarcodes:  (codes)  => api.post('/medicines/by-barcode/', { barcodes: codes }),
+  // Offline catalogue: full snapshot, or only changes after `since` (a previous `version`)
+  catalogue:   (since, etag) => api.get('/medicines/catalogue/', {
+    params: since ? { since } : {},
+    headers: etag ? { 'If-None-Match': etag } : {},
+    validateStatus: (s) => s === 200 || s === 304,
+  }),
   updateStock: (id, qty) => api.patch(`/medicines/${id}/update_stock/`, { quantity: qty }),
+  // Goods-received note / stock count: [{ medicine_id or barcode, delta, lot_number?, expiry_date? }]
+  adjustStock: (lines, note) => api.post('/medicines/adjust-stock/', { lines, note }),
 }
 
 export const categoryApi = {
@@ -91,14 +101,21 @@ export const categoryApi = {
 
 export const saleApi = {
   list:           (params) => api.get('/sales/', { params }),
+  page:           (url)    => api.get(url),                          // absolute `next` link
   get:            (id)     => api.get(`/sales/${id}/`),
   create:         (data)   => api.post('/sales/', data),
+  // Upload sales queued while offline; each needs a unique `client_ref`
+  batch:          (sales)  => api.post('/sales/batch/', { sales }),
+  refund:         (id)     => api.post(`/sales/${id}/refund/`),
   dashboardStats: ()       => api.get('/sales/dashboard_stats/'),
 }
 
 export const mpesaApi = {
   stkPush:     (data)        => api.post('/mpesa/stk-push/', data),
   checkStatus: (checkoutId)  => api.get(`/mpesa/status/${checkoutId}/`),
+  // Long-poll: resolves when the payment leaves `pending` or after `wait` seconds
+  waitStatus:  (checkoutId, wait = 25) =>
+    api.get(`/mpesa/events/${checkoutId}/`, { params: { timeout: wait }, timeout: (wait + 10) * 1000 }),
 }
 
 export default api
\ No newline at end of file